@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import sys
 
 from setuptools import setup, find_packages
 
@@ -9,6 +10,11 @@ with open('README.md') as f:
 with open('LICENSE') as f:
     license = f.read()
 
+exclude_packages = ['tests', 'docs']
+if sys.version_info < (3, 5):
+    # The asyncio client can't be compiled by Python 2
+    exclude_packages.append('preseries.preseries_api.common.aio')
+
 setup(
     name='preseries_api',
     version='0.1.0',
@@ -20,7 +26,7 @@ setup(
     license=license,
     setup_requires=[],
     namespace_packages=['preseries'],
-    packages=find_packages('src', exclude=['tests', 'docs']),
+    packages=find_packages('src', exclude=exclude_packages),
     package_dir={'': 'src'},
     include_package_data=True,
     install_requires=[
@@ -30,5 +36,15 @@ setup(
         'httplib2==0.10.3',
         'xlrd==1.1.0',
         'xlwt==1.3.0'
-    ]
+    ],
+    extras_require={
+        # AsyncPreSeriesAPI (common/aio/api.py), Python 3.5+ only
+        'async': ['aiohttp>=3.3'],
+        # Parquet exports (common/writers.py)
+        'parquet': ['pyarrow'],
+        # Faster decoding of the responses (common/decoding.py)
+        'fast': ['orjson'],
+        # Brotli compressed responses (common/compression.py)
+        'brotli': ['brotli']
+    }
 )
\ No newline at end of file
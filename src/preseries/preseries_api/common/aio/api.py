@@ -0,0 +1,572 @@
+# -*- coding: utf-8 -*-
+"""Asyncio version of the PreSeries API client.
+
+It requires Python 3.5+ and the aiohttp library
+(`pip install preseries_api[async]`). The common.aio package is not
+installed with Python 2, which can't compile it.
+"""
+import asyncio
+import json
+import logging
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from common.api import (
+    get_credentials, DEFAULT_INITIAL_TIMEOUT, URL,
+    COMPANIES_SEARCH_PATH, COMPANIES_DATA_PATH, COMPANIES_COMPETITORS_PATH,
+    COMPANIES_SIMILAR_PATH, USER_PORTFOLIO_PATH, USER_PORTFOLIO_COMPANY_PATH,
+    USER_STARRED_PATH, USER_FOLLOWED_PATH, SEND_JSON, ACCEPT_JSON,
+    HTTP_OK, HTTP_CREATED, HTTP_ACCEPTED, HTTP_NO_CONTENT, HTTP_BAD_REQUEST,
+    HTTP_UNAUTHORIZED, HTTP_PAYMENT_REQUIRED, HTTP_NOT_FOUND,
+    HTTP_METHOD_NOT_ALLOWED, HTTP_INTERNAL_SERVER_ERROR,
+    HTTP_TOO_MANY_REQUESTS)
+from common.retry import RetryPolicy
+from common.throttle import parse_retry_after
+from common.request_log import RequestLogger, redact
+from common.decoding import DEFAULT_DECODER
+
+LOGGER = logging.getLogger('sky')
+
+DEFAULT_ASYNC_MAX_CONNECTIONS = 100
+
+CONNECTION_ERRORS = (asyncio.TimeoutError, OSError) + (
+    (aiohttp.ClientError,) if aiohttp else ())
+
+
+class AsyncPreSeriesAPI(object):
+    """Asyncio counterpart of PreSeriesAPI.
+
+    It exposes the same methods, as coroutines, and returns the same
+    structures. All the requests share one aiohttp session with up to
+    <max_connections> connections open, so one event loop can keep hundreds
+    of requests in flight.
+
+    It follows the retry policy, the rate limiter and the request log of
+    PreSeriesAPI, but it has no circuit breakers, response cache, hedging
+    or hooks, so its requests are not in the metrics either.
+
+    Ex.
+
+        async with AsyncPreSeriesAPI(max_connections=200) as api:
+            responses = await asyncio.gather(*[
+                api.search_companies(query_string=query)
+                for query in queries])
+    """
+
+    def __init__(self, username=None, api_key=None,
+                 timeout=DEFAULT_INITIAL_TIMEOUT,
+                 max_connections=DEFAULT_ASYNC_MAX_CONNECTIONS,
+                 max_connections_per_host=0, retry_policy=None,
+                 rate_limiter=None, request_log=None, decoder=None):
+        if aiohttp is None:
+            raise ImportError(
+                "AsyncPreSeriesAPI requires the aiohttp library")
+
+        self.username = username
+        self.api_key = api_key
+        self.with_api_key = True
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.retry_policy = retry_policy or RetryPolicy(
+            connection_errors=CONNECTION_ERRORS)
+        self.rate_limiter = rate_limiter
+        self.request_log = request_log or RequestLogger()
+        self.decoder = decoder or DEFAULT_DECODER
+
+        self._auth = None
+        self._session = None
+
+    @property
+    def auth(self):
+        """The credentials sent in the query string of the requests, checked
+        the first time they are needed
+        """
+        if self._auth is None:
+            self.username, self.api_key = get_credentials(
+                self.username, self.api_key)
+            self._auth = '?username=%s;api_key=%s;' % \
+                         (self.username, self.api_key)
+        return self._auth
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    @property
+    def session(self):
+        """The aiohttp session, created the first time it is needed inside
+        the running event loop
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_connections_per_host)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def close(self):
+        """Closes all the connections
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _request(self, url, method='GET', body=None, headers=None):
+        """Sends a request and reads the whole response, retrying it
+        following the retry policy
+
+        :return: a tuple (status, headers, content). If no response was
+            received the last connection error is raised.
+        """
+        retries = 0
+        start_time = time.time()
+        while True:
+            if self.rate_limiter is not None:
+                wait = self.rate_limiter.reserve()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            try:
+                start_request_time = self.request_log.request(
+                    method, url, body=body)
+                async with self.session.request(
+                        method, url, data=body, headers=headers) as response:
+                    content = await response.read()
+                self.request_log.response(
+                    method, url, start_request_time,
+                    {'status': response.status}, content)
+
+                retry_after = None
+                if response.status == HTTP_TOO_MANY_REQUESTS:
+                    retry_after = parse_retry_after(
+                        response.headers.get('Retry-After'))
+                    if self.rate_limiter is not None:
+                        self.rate_limiter.on_throttle(retry_after)
+                elif self.rate_limiter is not None and \
+                        response.status < HTTP_INTERNAL_SERVER_ERROR:
+                    self.rate_limiter.on_success()
+
+                delay = self.retry_policy.next_delay(
+                    method, retries, time.time() - start_time,
+                    status=response.status, min_delay=retry_after or 0)
+                if delay is None:
+                    return response.status, response.headers, content
+                LOGGER.error("[retry %d] PRESERIES.IO is failing [%s %s] %s",
+                             retries + 1, method, redact(url),
+                             response.status)
+            except CONNECTION_ERRORS as exception:
+                delay = self.retry_policy.next_delay(
+                    method, retries, time.time() - start_time,
+                    error=exception)
+                if delay is None:
+                    raise
+                LOGGER.error("[retry %d] Cannot connect to PRESERIES.IO "
+                             "[%s %s] %s", retries + 1, method, redact(url),
+                             exception)
+
+            retries += 1
+            await asyncio.sleep(delay)
+
+    def _loads(self, content):
+        return self.decoder.loads(content)
+
+    async def get(self, path, headers, query_string=''):
+        """Retrieves a resource.
+
+        """
+        internal_query_string = ''
+        if self.with_api_key:
+            internal_query_string = '%s' % self.auth
+            if len(query_string) > 0:
+                internal_query_string += "&%s" % query_string
+        elif len(query_string) > 0:
+            internal_query_string += "?%s" % query_string
+
+        if len(internal_query_string) > 0:
+            path += internal_query_string
+
+        try:
+            status, _, resource = await self._request(path, headers=headers)
+            if status in [HTTP_OK, HTTP_BAD_REQUEST]:
+                return self._loads(resource)
+            elif status in [HTTP_NOT_FOUND]:
+                return None
+            else:
+                LOGGER.error("PRESERIES.IO is severely broken! %s %s",
+                             status, self.request_log.payload(resource))
+                return None
+        except CONNECTION_ERRORS as exception:
+            LOGGER.error("Cannot connect to PRESERIES.IO [%s] %s",
+                         redact(path), exception)
+            return None
+
+    async def _list(self, url, query_string=''):
+        """List resources
+        """
+        code = HTTP_INTERNAL_SERVER_ERROR
+        meta = None
+        resources = None
+        error = {
+            "status": {
+                "code": code,
+                "message": "The resource couldn't be listed"}}
+
+        try:
+            code, _, content = await self._request(
+                url + self.auth + query_string, headers=ACCEPT_JSON)
+
+            if code == HTTP_OK:
+                resource = self._loads(content)
+                if 'meta' in resource:
+                    meta = resource['meta']
+                    resources = resource['objects']
+                else:
+                    meta = None
+                    resources = [resource]
+                error = {}
+            elif code in [HTTP_BAD_REQUEST, HTTP_UNAUTHORIZED, HTTP_NOT_FOUND]:
+                error = self._loads(content)
+            else:
+                LOGGER.error("Unexpected error (%s)" % code)
+                code = HTTP_INTERNAL_SERVER_ERROR
+
+        except ValueError:
+            LOGGER.error("Malformed response")
+        except CONNECTION_ERRORS:
+            LOGGER.error("Connection error")
+
+        return {
+            'code': code,
+            'meta': meta,
+            'resources': resources,
+            'error': error}
+
+    async def _create(self, url, body, query_string=''):
+        """Create a new resource
+        """
+        code = HTTP_INTERNAL_SERVER_ERROR
+        resource_id = None
+        location = None
+        resource = None
+        error = {
+            "status": {
+                "code": code,
+                "message": "The resource couldn't be created"}}
+
+        try:
+            code, headers, content = await self._request(
+                url + self.auth + query_string, 'POST',
+                headers=SEND_JSON, body=body)
+
+            if code in [HTTP_CREATED, HTTP_OK]:
+                error = {}
+                location = headers.get('location')
+
+                if content:
+                    resource = self._loads(content)
+                    resource_id = resource['id']
+                elif location:
+                    resource_id = location[location.rfind('/')+1:]
+            elif code in [
+                    HTTP_BAD_REQUEST,
+                    HTTP_UNAUTHORIZED,
+                    HTTP_PAYMENT_REQUIRED]:
+                error = self._loads(content)
+            else:
+                LOGGER.error("Unexpected error (%s)" % code)
+                code = HTTP_INTERNAL_SERVER_ERROR
+
+        except ValueError:
+            LOGGER.error("Malformed response")
+        except CONNECTION_ERRORS:
+            LOGGER.error("Connection error")
+
+        return {
+            'code': code,
+            'id': resource_id,
+            'location': location,
+            'resource': resource,
+            'error': error}
+
+    async def _get(self, url, query_string=''):
+        """Retrieve a resource
+        """
+        code = HTTP_INTERNAL_SERVER_ERROR
+        resource_id = None
+        location = url
+        resource = None
+        error = {
+            "status": {
+                "code": code,
+                "message": "The resource couldn't be retrieved"}}
+
+        try:
+            code, _, content = await self._request(
+                url + self.auth + query_string, headers=ACCEPT_JSON)
+
+            if code == HTTP_OK:
+                resource = self._loads(content)
+                if 'id' in resource:
+                    resource_id = resource['id']
+                error = {}
+            elif code in [HTTP_BAD_REQUEST, HTTP_UNAUTHORIZED, HTTP_NOT_FOUND]:
+                error = self._loads(content)
+            else:
+                LOGGER.error("Unexpected error (%s)" % code)
+                code = HTTP_INTERNAL_SERVER_ERROR
+
+        except ValueError:
+            LOGGER.error("Malformed response")
+        except CONNECTION_ERRORS:
+            LOGGER.error("Connection error")
+
+        return {
+            'code': code,
+            'id': resource_id,
+            'location': location,
+            'resource': resource,
+            'error': error}
+
+    async def _update(self, url, body, query_string=''):
+        """Update a resource
+        """
+        code = HTTP_INTERNAL_SERVER_ERROR
+        resource_id = None
+        location = url
+        resource = None
+        error = {
+            "status": {
+                "code": code,
+                "message": "The resource couldn't be updated"}}
+
+        try:
+            code, headers, content = await self._request(
+                url + self.auth + query_string, 'PUT',
+                headers=SEND_JSON, body=body)
+
+            if code in [HTTP_ACCEPTED, HTTP_OK, HTTP_NO_CONTENT]:
+                location = headers.get('location') or url
+                error = {}
+                if content:
+                    resource = self._loads(content)
+                    resource_id = resource['id']
+                else:
+                    # 204 No Content, the id is the last part of the url
+                    resource_id = url.rstrip('/').rsplit('/', 1)[-1]
+            elif code in [HTTP_UNAUTHORIZED,
+                          HTTP_PAYMENT_REQUIRED,
+                          HTTP_METHOD_NOT_ALLOWED]:
+                error = self._loads(content)
+            else:
+                LOGGER.error("Unexpected error (%s)" % code)
+                code = HTTP_INTERNAL_SERVER_ERROR
+
+        except ValueError:
+            LOGGER.error("Malformed response")
+        except CONNECTION_ERRORS:
+            LOGGER.error("Connection error")
+
+        return {
+            'code': code,
+            'id': resource_id,
+            'location': location,
+            'resource': resource,
+            'error': error}
+
+    async def _delete(self, url):
+        """Delete a resource
+        """
+        code = HTTP_INTERNAL_SERVER_ERROR
+        error = {
+            "status": {
+                "code": code,
+                "message": "The resource couldn't be deleted"}}
+        try:
+            code, _, content = await self._request(url + self.auth, 'DELETE')
+
+            if code == HTTP_NO_CONTENT:
+                error = {}
+            elif code in [HTTP_BAD_REQUEST, HTTP_UNAUTHORIZED, HTTP_NOT_FOUND]:
+                error = self._loads(content)
+            else:
+                LOGGER.error("Unexpected error (%s)" % code)
+                code = HTTP_INTERNAL_SERVER_ERROR
+
+        except ValueError:
+            LOGGER.error("Malformed response")
+        except CONNECTION_ERRORS:
+            LOGGER.error("Connection error")
+
+        return {
+            'code': code,
+            'error': error}
+
+    ##########################################################################
+    #
+    # Company Endpoints
+    #
+    ##########################################################################
+
+    async def search_companies(self, path=COMPANIES_SEARCH_PATH,
+                               query_string='', headers=ACCEPT_JSON):
+        """Retrieves a source using query_string.
+
+        """
+        return await self.get(URL + path, headers, query_string)
+
+    async def get_company_data(self, query_string='',
+                               path=COMPANIES_DATA_PATH):
+        """Retrieves the stats of all the companies using query_string.
+
+        """
+        return await self._list(URL + path, query_string)
+
+    async def get_companies_competitors(
+            self, query_string='',
+            path=COMPANIES_COMPETITORS_PATH):
+        """Retrieves the competitors of the requested company using
+        query_string.
+
+        """
+        return await self._list(URL + path, query_string)
+
+    async def get_companies_similar(
+            self, query_string='',
+            path=COMPANIES_SIMILAR_PATH):
+        """Retrieves the similar of the requested company using
+        query_string.
+
+        """
+        return await self._list(URL + path, query_string)
+
+    ##########################################################################
+    #
+    # User Portfolios
+    #
+    ##########################################################################
+
+    async def get_portfolios(self, path=USER_PORTFOLIO_PATH, query_string=''):
+        """Retrieves portfolios.
+
+        """
+        return await self._list(URL + path, query_string)
+
+    async def get_portfolio(self, portfolio, query_string=''):
+        """Retrieve a portfolio
+        """
+        return await self._get(
+            "%s/%s" % (URL + USER_PORTFOLIO_PATH, portfolio),
+            query_string=query_string)
+
+    async def create_portfolio(self, name, companies=None):
+        """Creates a portfolio
+        """
+        params = {'name': name}
+        if companies:
+            params['companies'] = companies
+
+        body = json.dumps(params)
+        return await self._create(URL + USER_PORTFOLIO_PATH, body)
+
+    async def delete_portfolio(self, portfolio):
+        """Deletes a portfolio
+        """
+        return await self._delete(
+            "%s/%s" % (URL + USER_PORTFOLIO_PATH, portfolio))
+
+    async def update_portfolio(self, portfolio, changes):
+        """Updates a portfolio
+        """
+        body = json.dumps(changes)
+        return await self._update(
+            "%s/%s" % (URL + USER_PORTFOLIO_PATH, portfolio), body)
+
+    async def portfolio_add_company(self, portfolio, company_id):
+        """Adds a company to portfolio
+        """
+        body = json.dumps({})
+        url = '%s/%s/companies/add/%s' % \
+              (URL + USER_PORTFOLIO_PATH, portfolio, company_id)
+        return await self._create(url, body)
+
+    async def portfolio_remove_company(self, portfolio, company_id):
+        """Removes a company from portfolio
+        """
+        url = '%s/%s/companies/delete/%s' % \
+              (URL + USER_PORTFOLIO_PATH, portfolio, company_id)
+        return await self._delete(url)
+
+    async def get_portfolio_companies(self, query_string=''):
+        """Retrieves the companies in a portfolio.
+
+        """
+        return await self._list(
+            URL + USER_PORTFOLIO_COMPANY_PATH, query_string)
+
+    ##########################################################################
+    #
+    # User Starred Companies
+    #
+    ##########################################################################
+    async def get_starred_companies(self, query_string=''):
+        """Retrieves starred companies.
+
+        """
+        return await self._list(URL + USER_STARRED_PATH, query_string)
+
+    async def create_starred(self, company_id, company_name, args=None):
+        """Create a starred company
+        """
+        if args is None:
+            args = {}
+        args.update({
+            "company_id": company_id,
+            "company_name": company_name
+        })
+
+        body = json.dumps(args)
+        return await self._create(URL + USER_STARRED_PATH, body)
+
+    async def delete_starred(self, starred):
+        """Removes a starred company
+        """
+        return await self._delete(
+            "%s/%s" % (URL + USER_STARRED_PATH, starred))
+
+    ##########################################################################
+    #
+    # User Followed Companies
+    #
+    ##########################################################################
+    async def get_followed_companies(self, query_string=''):
+        """Retrieves followed companies.
+
+        """
+        return await self._list(URL + USER_FOLLOWED_PATH, query_string)
+
+    async def create_followed(self, company_id, company_name, args=None):
+        """Create a followed company
+        """
+        if args is None:
+            args = {}
+        args.update({
+            "company_id": company_id,
+            "company_name": company_name
+        })
+
+        body = json.dumps(args)
+        return await self._create(URL + USER_FOLLOWED_PATH, body)
+
+    async def delete_followed(self, followed):
+        """Removes a followed company
+        """
+        return await self._delete(
+            "%s/%s" % (URL + USER_FOLLOWED_PATH, followed))
@@ -11,6 +11,19 @@ import httplib2
 import json
 import socket
 import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+from common.transport import PooledTransport, DEFAULT_MAX_CONNECTIONS
+from common.cache import ResponseCache
+from common.retry import RetryPolicy
+from common.breaker import CircuitBreakerRegistry, CircuitOpenError
+from common.throttle import parse_retry_after
+from common.metrics import RequestEvent
+from common.request_log import RequestLogger
+from common.decoding import DEFAULT_DECODER
+from common.compression import (
+    accept_encoding, compress, decompress_response)
 
 LOGGER = logging.getLogger('sky')
 
@@ -24,17 +37,11 @@ PRESERIES_API_VERSION = os.getenv("PRESERIES_API_VERSION", "zion")
 PRESERIES_COMPANIES_SEARCH_ENDPOINT = "/company_search"
 PRESERIES_PORTFOLIO_ENDPOINT = "/portfolio"
 
+# The credentials are checked when the first request is sent, see
+# get_credentials
 PRESERIES_USERNAME = os.getenv("PRESERIES_USERNAME", None)
 PRESERIES_API_KEY = os.getenv("PRESERIES_API_KEY", None)
 
-if not PRESERIES_USERNAME:
-    raise Exception(
-        "The PRESERIES_USERNAME environment variable must be set")
-
-if not PRESERIES_API_KEY:
-    raise Exception(
-        "The PRESERIES_API_KEY environment variable must be set")
-
 URL = (PRESERIES_PROTOCOL + '://' + PRESERIES_HOST + ':' +
        str(PRESERIES_PORT) + '/' + PRESERIES_API_VERSION + '/')
 
@@ -63,35 +70,376 @@ HTTP_FORBIDDEN = 403
 HTTP_NOT_FOUND = 404
 HTTP_METHOD_NOT_ALLOWED = 405
 HTTP_LENGTH_REQUIRED = 411
+HTTP_UNSUPPORTED_MEDIA_TYPE = 415
+HTTP_TOO_MANY_REQUESTS = 429
 HTTP_INTERNAL_SERVER_ERROR = 500
 
 CACHE_PRESERIES = True
 CACHE_PRESERIES_DIR = "preseries_cache"
-GZIP_PRESERIES_CONTENT = "preseries_cache"
+# Accept compressed responses: gzip and deflate, which httplib2 asks for
+# and decompresses, and brotli if a brotli library is installed
+GZIP_PRESERIES_CONTENT = True
 
 MAX_RETRIES = 5
 MIN_TIME_BETWEEN_RETRIES = 3
 
+# Errors raised by the transport when it can't talk to PreSeries
+CONNECTION_ERRORS = (httplib2.HttpLib2Error, socket.error)
+
+# Number of resources requested per page by the list iterators
+DEFAULT_PAGE_SIZE = 100
+
+
+class PreSeriesAPIError(Exception):
+    """Raised when a request to PreSeries fails and there is no way to
+    report the error in the returned value, like in the iterators.
+
+    The `response` attribute holds the structure returned by the request.
+    """
+
+    def __init__(self, message, response=None):
+        super(PreSeriesAPIError, self).__init__(message)
+        self.response = response
+
+
+def get_credentials(username=None, api_key=None):
+    """
+    Returns the credentials used to authenticate the requests, taken from
+    the PRESERIES_USERNAME and PRESERIES_API_KEY environment variables when
+    they are not informed
+
+    :return: a tuple (username, api_key). A PreSeriesAPIError is raised if
+        any of them is missing.
+    """
+    username = username or os.getenv("PRESERIES_USERNAME", None)
+    api_key = api_key or os.getenv("PRESERIES_API_KEY", None)
+
+    if not username:
+        raise PreSeriesAPIError(
+            "The PRESERIES_USERNAME environment variable must be set")
+
+    if not api_key:
+        raise PreSeriesAPIError(
+            "The PRESERIES_API_KEY environment variable must be set")
+
+    return username, api_key
+
 
 class PreSeriesAPI(object):
 
-    def __init__(self, username=PRESERIES_USERNAME, api_key=PRESERIES_API_KEY,
-                 cache=False, timeout=DEFAULT_INITIAL_TIMEOUT):
+    def __init__(self, username=None, api_key=None,
+                 cache=False, timeout=DEFAULT_INITIAL_TIMEOUT,
+                 transport=None, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 retry_policy=None, rate_limiter=None, breakers=True,
+                 hedging=None, hooks=None, request_log=None,
+                 decoder=None, compression=GZIP_PRESERIES_CONTENT,
+                 compress_min_size=None):
+        """
+        :param username: the PreSeries user, by default the value of the
+            PRESERIES_USERNAME environment variable
+        :param api_key: the API key of the user, by default the value of the
+            PRESERIES_API_KEY environment variable. The credentials are
+            checked when the first request is sent.
+        :param cache: True to keep the responses in a ResponseCache stored in
+            CACHE_PRESERIES_DIR, or the ResponseCache to be used.
+        :param transport: the object used to send the requests. It must have
+            a `request(uri, method, body, headers)` method compatible with
+            httplib2.Http. By default a PooledTransport, which can be shared
+            by many threads, with up to <max_connections> connections.
+        :param retry_policy: the RetryPolicy applied to all the requests
+        :param rate_limiter: the RateLimiter shared by all the threads that
+            use this instance, None to send the requests without limit. The
+            429 responses are retried after their Retry-After time anyway.
+        :param breakers: True to protect each endpoint with a CircuitBreaker
+            with the default settings, the CircuitBreakerRegistry to be used
+            or False to always send the requests.
+        :param hedging: the HedgingPolicy used to send a duplicate of the
+            slow GET requests, None to never duplicate them.
+        :param hooks: the functions called with the RequestEvent of each
+            request sent, ex. a MetricsAggregator
+        :param request_log: the RequestLogger that writes the requests and
+            responses in the log, by default one with the default settings
+        :param decoder: the JsonDecoder of the responses, by default one
+            with the fastest JSON library installed
+        :param compression: True to accept compressed responses, with
+            brotli too if it's installed, False to ask for them uncompressed.
+            httplib2 decompresses the gzip and deflate responses.
+        :param compress_min_size: the minimum size of the POST and PUT bodies
+            sent compressed with gzip, ex. DEFAULT_COMPRESS_MIN_SIZE. None to
+            never compress them. If PreSeries rejects a compressed body, it
+            is sent again uncompressed and no more bodies are compressed.
+        """
 
         socket.setdefaulttimeout(DEFAULT_INITIAL_TIMEOUT)
 
-        if CACHE_PRESERIES and cache:
-            self.http = httplib2.Http(
-                CACHE_PRESERIES_DIR, timeout=timeout)
-        else:
-            self.http = httplib2.Http(timeout=timeout)
+        if transport is None:
+            transport = PooledTransport(
+                max_connections=max_connections, timeout=timeout)
+        self.transport = transport
+
+        if cache is True:
+            cache = ResponseCache(CACHE_PRESERIES_DIR) \
+                if CACHE_PRESERIES else None
+        self.cache = cache or None
+
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.rate_limiter = rate_limiter
+
+        if breakers is True:
+            breakers = CircuitBreakerRegistry()
+        self.breakers = breakers or None
+
+        self.hedging = hedging
+        self.hooks = list(hooks or [])
+        self.request_log = request_log or RequestLogger()
+        self.decoder = decoder or DEFAULT_DECODER
+        self.accept_encoding = accept_encoding() if compression \
+            else 'identity'
+        self.compress_min_size = compress_min_size
 
         self.username = username
         self.api_key = api_key
         self.with_api_key = True
 
-        self.auth = '?username=%s;api_key=%s;' % \
-                    (self.username, self.api_key)
+        self._auth = None
+
+    @property
+    def auth(self):
+        """The credentials sent in the query string of the requests, checked
+        the first time they are needed
+        """
+        if self._auth is None:
+            self.username, self.api_key = get_credentials(
+                self.username, self.api_key)
+            self._auth = '?username=%s;api_key=%s;' % \
+                         (self.username, self.api_key)
+        return self._auth
+
+    def transport_stats(self):
+        """Returns the statistics of the transport, if it has them
+
+        """
+        if hasattr(self.transport, 'stats'):
+            return self.transport.stats()
+        return {}
+
+    def rate_limiter_stats(self):
+        """Returns the statistics of the rate limiter, if there is one
+
+        """
+        if self.rate_limiter is not None:
+            return self.rate_limiter.stats()
+        return {}
+
+    def circuit_states(self):
+        """Returns the state of the circuit breaker of each endpoint used
+
+        """
+        if self.breakers is not None:
+            return self.breakers.states()
+        return {}
+
+    def breaker_stats(self):
+        """Returns the statistics of the circuit breaker of each endpoint
+
+        """
+        if self.breakers is not None:
+            return self.breakers.stats()
+        return {}
+
+    def hedging_stats(self):
+        """Returns the statistics of the hedging policy, if there is one
+
+        """
+        if self.hedging is not None:
+            return self.hedging.stats()
+        return {}
+
+    def cache_stats(self):
+        """Returns the statistics of the response cache
+
+        """
+        if self.cache is not None:
+            return self.cache.stats()
+        return {}
+
+    def add_hook(self, hook):
+        """Adds a function to be called with the RequestEvent of each
+        request sent
+        """
+        self.hooks.append(hook)
+
+    def _send(self, method, url, query_string='', body=None, headers=None):
+        """Sends a request, retrying it following the retry policy. The GET
+        responses are taken from the cache if they are there. The hooks are
+        called with the RequestEvent of the request when it finishes.
+
+        :param method: the HTTP method
+        :param url: the url of the resource, without the query string
+        :param query_string: the query string, with the credentials
+        :return: a tuple (response, content, cached) with the last response
+            received. If no response was received the last connection error
+            is raised, or CircuitOpenError if the circuit of the endpoint is
+            open.
+        """
+        endpoint = ResponseCache.make_key(url)[0]
+        if not self.hooks:
+            return self._send_request(
+                method, endpoint, url, query_string, body, headers)
+
+        event = RequestEvent(method, endpoint)
+        try:
+            response, content, cached = self._send_request(
+                method, endpoint, url, query_string, body, headers, event)
+            event.status = int(response.get('status'))
+            event.response_size = len(content) if content else 0
+            return response, content, cached
+        except Exception as exception:
+            event.error = exception.__class__.__name__
+            raise
+        finally:
+            event.latency = time.time() - event.timestamp
+            for hook in self.hooks:
+                try:
+                    hook(event)
+                except Exception:
+                    LOGGER.exception("Error in the request hook %r", hook)
+
+    def _send_request(self, method, endpoint, url, query_string, body,
+                      headers, event=None):
+        """Sends a request as described in _send, counting its retries in
+        the event, if any
+        """
+        if method == 'GET' and self.cache is not None:
+            content = self.cache.get(url, query_string)
+            if content is not None:
+                if event is not None:
+                    event.cached = True
+                return {'status': str(HTTP_OK)}, content, True
+
+        headers = dict(headers or {})
+        if self.accept_encoding is not None:
+            headers['Accept-Encoding'] = self.accept_encoding
+        plain_body = plain_headers = None
+        if body and self.compress_min_size is not None and \
+                len(body) >= self.compress_min_size:
+            plain_body, plain_headers = body, dict(headers)
+            body = compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        if event is not None:
+            event.request_size = len(body) if body else 0
+
+        breaker = None
+        if self.breakers is not None:
+            breaker = self.breakers.get(endpoint)
+
+        def request():
+            # Every request sent, the original or its hedged duplicate, is
+            # recorded in the breaker and the rate limiter
+            try:
+                response, content = self.transport.request(
+                    url + query_string, method, body=body, headers=headers)
+            except Exception:
+                if breaker is not None:
+                    breaker.record(True)
+                raise
+            self._record_response(breaker, response)
+            return response, content
+
+        def hedge_request():
+            # The duplicate is one more request for the breaker and the
+            # rate limiter
+            if breaker is not None and not breaker.allow():
+                raise CircuitOpenError(
+                    "The circuit of [%s] is open" % breaker.name)
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            return request()
+
+        retries = 0
+        start_time = time.time()
+        while True:
+            if breaker is not None and not breaker.allow():
+                raise CircuitOpenError(
+                    "The circuit of [%s] is open" % breaker.name)
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                if method == 'GET' and self.hedging is not None:
+                    response, content = self.hedging.send(
+                        endpoint, request, hedge_request)
+                else:
+                    response, content = request()
+            except httplib2.FailedToDecompressContent:
+                # The response arrived, sending the request again would get
+                # the same content
+                raise
+            except CONNECTION_ERRORS as exception:
+                delay = self.retry_policy.next_delay(
+                    method, retries, time.time() - start_time,
+                    error=exception)
+                if delay is None:
+                    raise
+                LOGGER.error("[retry %d] Cannot connect to PRESERIES.IO "
+                             "[%s %s] %s", retries + 1, method, url,
+                             exception)
+            else:
+                status = int(response.get('status'))
+                if status == HTTP_UNSUPPORTED_MEDIA_TYPE and \
+                        plain_body is not None:
+                    LOGGER.warning("PRESERIES.IO doesn't accept compressed "
+                                   "bodies, sending them uncompressed")
+                    self.compress_min_size = None
+                    body, headers = plain_body, plain_headers
+                    plain_body = None
+                    if event is not None:
+                        event.request_size = len(body)
+                    continue
+                retry_after = None
+                if status == HTTP_TOO_MANY_REQUESTS:
+                    retry_after = parse_retry_after(
+                        response.get('retry-after'))
+                delay = self.retry_policy.next_delay(
+                    method, retries, time.time() - start_time, status=status,
+                    min_delay=retry_after or 0)
+                if delay is None:
+                    return response, decompress_response(
+                        response, content), False
+                LOGGER.error("[retry %d] PRESERIES.IO is failing [%s %s] %s",
+                             retries + 1, method, url, status)
+
+            retries += 1
+            if event is not None:
+                event.retries = retries
+            time.sleep(delay)
+
+    def _record_response(self, breaker, response):
+        """Records the status of a response in the circuit breaker of its
+        endpoint and in the rate limiter
+        """
+        status = int(response.get('status'))
+        if breaker is not None:
+            breaker.record(status >= HTTP_INTERNAL_SERVER_ERROR)
+        if self.rate_limiter is None:
+            return
+        if status == HTTP_TOO_MANY_REQUESTS:
+            self.rate_limiter.on_throttle(
+                parse_retry_after(response.get('retry-after')))
+        elif status < HTTP_INTERNAL_SERVER_ERROR:
+            self.rate_limiter.on_success()
+
+    def _store(self, url, query_string, content):
+        """Keeps the content of a successful response in the cache
+        """
+        if self.cache is not None:
+            self.cache.set(url, query_string, content)
+
+    def _invalidate(self, url):
+        """Removes from the cache the responses of the endpoint of url,
+        after changing any of its resources
+        """
+        if self.cache is not None:
+            self.cache.invalidate(ResponseCache.make_key(url)[0])
 
     def get(self, path, headers, query_string=''):
         """Retrieves a resource.
@@ -102,6 +450,7 @@ class PreSeriesAPI(object):
         # query_string += '&%s' % dummy_param if len(query_string) > 0 else \
         #     '%s' % dummy_param
 
+        url = path
         internal_query_string = ''
         if self.with_api_key:
             internal_query_string = '%s' % self.auth
@@ -110,64 +459,45 @@ class PreSeriesAPI(object):
         elif len(query_string) > 0:
             internal_query_string += "?%s" % query_string
 
-        if len(internal_query_string) > 0:
-            path += internal_query_string
-
-        retries = 0
-        while True:
-            pending_retries = MAX_RETRIES - retries
-            try:
-                if __debug__:
-                    LOGGER.info('========= PRESERIES.IO REQUEST =========')
-                    LOGGER.info(path)
-                    LOGGER.info(headers)
-
-                start_request_time = time.time()
-                response, resource = self.http.request(path, headers=headers)
-                if __debug__:
-                    LOGGER.info('========= PRESERIES.IO RESPONSE (%s seconds) '
-                                '=========' %
-                                (time.time() - start_request_time))
-                    LOGGER.info(response)
-                    LOGGER.debug(resource)
-                status = int(response.get('status'))
-                if status in [HTTP_OK, HTTP_BAD_REQUEST]:
-                    resource = json.loads(resource, 'utf-8')
-                    return resource
-                elif status in [HTTP_NOT_FOUND]:
-                    return None
-                else:
-                    LOGGER.error("[{0} retries left] PRESERIES.IO is severely "
-                                 "broken! {1} {2}".format(pending_retries,
-                                                          status, resource))
-                    return None
-            except httplib2.HttpLib2Error as exception:
-                LOGGER.error("[{0} retries left]  Cannot connect to "
-                             "PRESERIES.IO [{1}] {2} ".
-                             format(pending_retries, path, exception))
-                if retries < MAX_RETRIES:
-                    retries += 1
-                    time.sleep(retries * MIN_TIME_BETWEEN_RETRIES)
-                else:
-                    return None
-            except socket.timeout:
-                LOGGER.error(
-                    "[{0} retries left] Timeout connecting to PRESERIES.IO "
-                    "[{1}]. Almost there!".format(pending_retries, path))
-                if retries < MAX_RETRIES:
-                    retries += 1
-                    time.sleep(retries * MIN_TIME_BETWEEN_RETRIES)
-                else:
-                    return None
-            except socket.error:
-                LOGGER.error(
-                    "[{0} retries left] Cannot connect to Apian_pre_s [{1}]".
-                    format(pending_retries, path))
-                if retries < MAX_RETRIES:
-                    retries += 1
-                    time.sleep(retries * MIN_TIME_BETWEEN_RETRIES)
-                else:
-                    return None
+        try:
+            start_request_time = self.request_log.request(
+                'GET', url, internal_query_string, headers=headers)
+            response, content, cached = self._send(
+                'GET', url, internal_query_string, headers=headers)
+            self.request_log.response(
+                'GET', url, start_request_time, response, content)
+            status = int(response.get('status'))
+            if status in [HTTP_OK, HTTP_BAD_REQUEST]:
+                resource = self.decoder.loads(content)
+                if status == HTTP_OK and not cached:
+                    self._store(url, internal_query_string, content)
+                return resource
+            elif status in [HTTP_NOT_FOUND]:
+                return None
+            elif status == HTTP_TOO_MANY_REQUESTS:
+                LOGGER.error("PRESERIES.IO throttled the request [{0}] after "
+                             "all the retries".format(url))
+                return None
+            else:
+                LOGGER.error("PRESERIES.IO is severely broken! %s %s",
+                             status, self.request_log.payload(content))
+                return None
+        except CircuitOpenError as exception:
+            LOGGER.error("Request to PRESERIES.IO rejected [{0}] {1}".
+                         format(url, exception))
+            return None
+        except httplib2.HttpLib2Error as exception:
+            LOGGER.error("Cannot connect to PRESERIES.IO [{0}] {1} ".
+                         format(url, exception))
+            return None
+        except socket.timeout:
+            LOGGER.error(
+                "Timeout connecting to PRESERIES.IO [{0}]".format(url))
+            return None
+        except socket.error:
+            LOGGER.error(
+                "Cannot connect to PRESERIES.IO [{0}]".format(url))
+            return None
 
     def _list(self, url, query_string=''):
         """List resources
@@ -180,23 +510,20 @@ class PreSeriesAPI(object):
                 "code": code,
                 "message": "The resource couldn't be listed"}}
 
-        LOGGER.info('========= PRESERIES.IO REQUEST =========')
-        LOGGER.info(url + self.auth + query_string)
         try:
-            start_request_time = time.time()
-            response, content = self.http.request(
-                url + self.auth + query_string,
-                headers=ACCEPT_JSON)
-
-            LOGGER.info('========= PRESERIES.IO RESPONSE (%s seconds) '
-                        '=========' % (time.time() - start_request_time))
-            LOGGER.info(response)
-            LOGGER.debug(content)
+            start_request_time = self.request_log.request(
+                'GET', url, query_string)
+            response, content, cached = self._send(
+                'GET', url, self.auth + query_string, headers=ACCEPT_JSON)
+            self.request_log.response(
+                'GET', url, start_request_time, response, content)
 
             code = int(response.get('status'))
 
             if code == HTTP_OK:
-                resource = json.loads(content, 'utf-8')
+                resource = self.decoder.loads(content)
+                if not cached:
+                    self._store(url, self.auth + query_string, content)
                 if 'meta' in resource:
                     meta = resource['meta']
                     resources = resource['objects']
@@ -205,13 +532,15 @@ class PreSeriesAPI(object):
                     resources = [resource]
                 error = {}
             elif code in [HTTP_BAD_REQUEST, HTTP_UNAUTHORIZED, HTTP_NOT_FOUND]:
-                error = json.loads(content, 'utf-8')
+                error = self.decoder.loads(content)
             else:
                 LOGGER.error("Unexpected error (%s)" % code)
                 code = HTTP_INTERNAL_SERVER_ERROR
 
         except ValueError:
             LOGGER.error("Malformed response")
+        except CircuitOpenError as exception:
+            LOGGER.error("Request rejected: %s" % exception)
         except httplib2.HttpLib2Error:
             LOGGER.error("Connection error")
         except socket.timeout:
@@ -236,31 +565,28 @@ class PreSeriesAPI(object):
             "status": {
                 "code": code,
                 "message": "The resource couldn't be created"}}
-        LOGGER.info('+++++++++ PRESERIES.IO REQUEST +++++++++')
-        LOGGER.info('POST ' + url + ';' + query_string)
-        LOGGER.info(body)
+        auth = self.auth
         try:
-            start_request_time = time.time()
-            response, content = self.http.request(
-                url + self.auth + query_string, 'POST',
+            start_request_time = self.request_log.request(
+                'POST', url, query_string, body=body)
+            response, content, _ = self._send(
+                'POST', url, auth + query_string,
                 headers=SEND_JSON,
                 body=body)
-
-            LOGGER.info('+++++++++ PRESERIES.IO RESPONSE (%s seconds) '
-                        '+++++++++' % (time.time() - start_request_time))
-            LOGGER.info(response)
-            LOGGER.debug(content)
+            self.request_log.response(
+                'POST', url, start_request_time, response, content)
 
             code = int(response.get('status'))
 
             if code in [HTTP_CREATED, HTTP_OK]:
+                self._invalidate(url)
                 error = {}
                 location = response.get('location')
                 resource = None
                 resource_id = None
 
                 if content:
-                    resource = json.loads(content, 'utf-8')
+                    resource = self.decoder.loads(content)
                     resource_id = resource['id']
                 elif location:
                     resource_id = location[location.rfind('/')+1:]
@@ -268,10 +594,10 @@ class PreSeriesAPI(object):
                     HTTP_BAD_REQUEST,
                     HTTP_UNAUTHORIZED,
                     HTTP_PAYMENT_REQUIRED]:
-                error = json.loads(content, 'utf-8')
+                error = self.decoder.loads(content)
             elif code == HTTP_OK and \
-                    json.loads(content, 'utf-8').get('status'):
-                error = json.loads(content, 'utf-8')
+                    self.decoder.loads(content).get('status'):
+                error = self.decoder.loads(content)
                 location = None
                 resource = None
                 resource_id = None
@@ -281,6 +607,8 @@ class PreSeriesAPI(object):
 
         except ValueError:
             LOGGER.error("Malformed response")
+        except CircuitOpenError as exception:
+            LOGGER.error("Request rejected: %s" % exception)
         except httplib2.HttpLib2Error:
             LOGGER.error("Connection error")
         except socket.timeout:
@@ -310,34 +638,32 @@ class PreSeriesAPI(object):
                 "message": "The resource couldn't be retrieved"}}
 
         try:
-            LOGGER.info('========= PRESERIES.IO REQUEST =========')
-            LOGGER.info(url + self.auth + query_string)
-
-            start_request_time = time.time()
-            response, content = self.http.request(
-                url + self.auth + query_string,
-                headers=ACCEPT_JSON)
-
-            LOGGER.info('========= PRESERIES.IO RESPONSE (%s seconds) '
-                        '=========' % (time.time() - start_request_time))
-            LOGGER.info(response)
-            LOGGER.debug(content)
+            start_request_time = self.request_log.request(
+                'GET', url, query_string)
+            response, content, cached = self._send(
+                'GET', url, self.auth + query_string, headers=ACCEPT_JSON)
+            self.request_log.response(
+                'GET', url, start_request_time, response, content)
 
             code = int(response.get('status'))
 
             if code == HTTP_OK:
-                resource = json.loads(content, 'utf-8')
+                resource = self.decoder.loads(content)
+                if not cached:
+                    self._store(url, self.auth + query_string, content)
                 if 'id' in resource:
                     resource_id = resource['id']
                 error = {}
             elif code in [HTTP_BAD_REQUEST, HTTP_UNAUTHORIZED, HTTP_NOT_FOUND]:
-                error = json.loads(content, 'utf-8')
+                error = self.decoder.loads(content)
             else:
                 LOGGER.error("Unexpected error (%s)" % code)
                 code = HTTP_INTERNAL_SERVER_ERROR
 
         except ValueError:
             LOGGER.error("Malformed response")
+        except CircuitOpenError as exception:
+            LOGGER.error("Request rejected: %s" % exception)
         except httplib2.HttpLib2Error:
             LOGGER.error("Connection error")
         except socket.timeout:
@@ -365,38 +691,39 @@ class PreSeriesAPI(object):
                 "message": "The resource couldn't be updated"}}
 
         try:
-            LOGGER.info('////////// PRESERIES.IO REQUEST ///////////')
-            LOGGER.info('PUT ' + url)
-            LOGGER.info(body)
-
-            start_request_time = time.time()
-            response, content = self.http.request(
-                url + self.auth + query_string, 'PUT',
+            start_request_time = self.request_log.request(
+                'PUT', url, query_string, body=body)
+            response, content, _ = self._send(
+                'PUT', url, self.auth + query_string,
                 headers=SEND_JSON,
                 body=body)
-
-            LOGGER.info('////////// PRESERIES.IO RESPONSE (%s seconds) '
-                        '//////////' % (time.time() - start_request_time))
-            LOGGER.info(response)
-            LOGGER.debug(content)
+            self.request_log.response(
+                'PUT', url, start_request_time, response, content)
 
             code = int(response.get('status'))
 
             if code in [HTTP_ACCEPTED, HTTP_OK, HTTP_NO_CONTENT]:
-                location = response.get('location')
-                resource = json.loads(content, 'utf-8')
-                resource_id = resource['id']
+                self._invalidate(url)
+                location = response.get('location') or url
                 error = {}
+                if content:
+                    resource = self.decoder.loads(content)
+                    resource_id = resource['id']
+                else:
+                    # 204 No Content, the id is the last part of the url
+                    resource_id = url.rstrip('/').rsplit('/', 1)[-1]
             elif code in [HTTP_UNAUTHORIZED,
                           HTTP_PAYMENT_REQUIRED,
                           HTTP_METHOD_NOT_ALLOWED]:
-                error = json.loads(content, 'utf-8')
+                error = self.decoder.loads(content)
             else:
                 LOGGER.error("Unexpected error (%s)" % code)
                 code = HTTP_INTERNAL_SERVER_ERROR
 
         except ValueError:
             LOGGER.error("Malformed response")
+        except CircuitOpenError as exception:
+            LOGGER.error("Request rejected: %s" % exception)
         except httplib2.HttpLib2Error:
             LOGGER.error("Connection error")
         except socket.timeout:
@@ -420,29 +747,26 @@ class PreSeriesAPI(object):
                 "code": code,
                 "message": "The resource couldn't be deleted"}}
         try:
-            LOGGER.info('------------- PRESERIES.IO REQUEST -------------')
-            LOGGER.info('DELETE ' + url)
-
-            start_request_time = time.time()
-            response, content = self.http.request(
-                url + self.auth, 'DELETE')
+            start_request_time = self.request_log.request('DELETE', url)
+            response, content, _ = self._send('DELETE', url, self.auth)
+            self.request_log.response(
+                'DELETE', url, start_request_time, response, content)
 
             code = int(response.get('status'))
 
-            LOGGER.info('------------- PRESERIES.IO RESPONSE (%s seconds) '
-                        '-------------' % (time.time() - start_request_time))
-            LOGGER.info(code)
-
             if code == HTTP_NO_CONTENT:
+                self._invalidate(url)
                 error = {}
             elif code in [HTTP_BAD_REQUEST, HTTP_UNAUTHORIZED, HTTP_NOT_FOUND]:
-                error = json.loads(content, 'utf-8')
+                error = self.decoder.loads(content)
             else:
                 LOGGER.error("Unexpected error (%s)" % code)
                 code = HTTP_INTERNAL_SERVER_ERROR
 
         except ValueError:
             LOGGER.error("Malformed response")
+        except CircuitOpenError as exception:
+            LOGGER.error("Request rejected: %s" % exception)
         except httplib2.HttpLib2Error:
             LOGGER.error("Connection error")
         except socket.timeout:
@@ -454,6 +778,86 @@ class PreSeriesAPI(object):
             'code': code,
             'error': error}
 
+    @staticmethod
+    def _page_query(query_string, limit, offset):
+        """Returns the query_string with the limit and offset of the page
+        """
+        params = [param for param in query_string.split('&')
+                  if param and not param.startswith(('limit=', 'offset='))]
+        params.append('limit=%d' % limit)
+        params.append('offset=%d' % offset)
+        return '&'.join(params)
+
+    @staticmethod
+    def _has_next_page(meta, resources, offset, page_size):
+        """Checks if there are more pages to be requested after a page with
+        <resources> that ends at <offset>
+        """
+        if meta is None or not resources:
+            return False
+        if 'next' in meta:
+            return bool(meta['next'])
+        if 'total_count' in meta:
+            return offset < meta['total_count']
+        return len(resources) >= page_size
+
+    def iter_list(self, url, query_string='', page_size=None, prefetch=False):
+        """Iterates over all the resources that match the query_string,
+        requesting them page by page as they are consumed.
+
+        The pagination follows the `next` and `total_count` fields of the
+        `meta` of each response. Only the current page, and the next one if
+        prefetch is enabled, are kept in memory.
+
+        :param url: the url of the list endpoint
+        :param query_string: the filters of the query. If it has a limit it
+            is used as page size.
+        :param page_size: the number of resources requested per page
+        :param prefetch: if True the next page is requested in background
+            while the current one is being consumed
+        :return: a generator of resources
+        """
+        if page_size is None:
+            page_size = DEFAULT_PAGE_SIZE
+            for param in query_string.split('&'):
+                if param.startswith('limit=') and param[6:].isdigit():
+                    page_size = int(param[6:]) or DEFAULT_PAGE_SIZE
+
+        def fetch(offset):
+            response = self._list(
+                url, self._page_query(query_string, page_size, offset))
+            if response['code'] != HTTP_OK:
+                raise PreSeriesAPIError(
+                    "Error listing %s (offset %d): %s" %
+                    (url, offset, response['error']), response)
+            return response
+
+        pool = ThreadPool(1) if prefetch else None
+        try:
+            offset = 0
+            page = fetch(offset)
+            while True:
+                resources = page['resources'] or []
+                offset += len(resources)
+
+                has_next = self._has_next_page(
+                    page['meta'], resources, offset, page_size)
+                if has_next and pool:
+                    prefetched = pool.apply_async(fetch, (offset,))
+
+                for resource in resources:
+                    yield resource
+
+                if not has_next:
+                    break
+
+                # Release the current page before waiting for the next one
+                page = resources = None
+                page = prefetched.get() if pool else fetch(offset)
+        finally:
+            if pool:
+                pool.terminate()
+
     ##########################################################################
     #
     # Company Endpoints
@@ -496,6 +900,35 @@ class PreSeriesAPI(object):
         url = URL + path
         return self._list(url, query_string)
 
+    def iter_company_data(self, query_string='', page_size=None,
+                          prefetch=False, path=COMPANIES_DATA_PATH):
+        """Iterates over the stats of all the companies that match the
+        query_string, following the pagination.
+
+        """
+        return self.iter_list(URL + path, query_string, page_size=page_size,
+                              prefetch=prefetch)
+
+    def iter_companies_competitors(
+            self, query_string='', page_size=None, prefetch=False,
+            path=COMPANIES_COMPETITORS_PATH):
+        """Iterates over the competitors of the requested companies,
+        following the pagination.
+
+        """
+        return self.iter_list(URL + path, query_string, page_size=page_size,
+                              prefetch=prefetch)
+
+    def iter_companies_similar(
+            self, query_string='', page_size=None, prefetch=False,
+            path=COMPANIES_SIMILAR_PATH):
+        """Iterates over the similar of the requested companies, following
+        the pagination.
+
+        """
+        return self.iter_list(URL + path, query_string, page_size=page_size,
+                              prefetch=prefetch)
+
     ##########################################################################
     #
     # User Portfolios
@@ -508,6 +941,14 @@ class PreSeriesAPI(object):
         """
         return self._list(URL + path, query_string)
 
+    def iter_portfolios(self, query_string='', page_size=None,
+                        prefetch=False):
+        """Iterates over the portfolios, following the pagination.
+
+        """
+        return self.iter_list(URL + USER_PORTFOLIO_PATH, query_string,
+                              page_size=page_size, prefetch=prefetch)
+
     def get_portfolio(self, portfolio, query_string=''):
         """Retrieve a portfolio
         """
@@ -551,12 +992,31 @@ class PreSeriesAPI(object):
               (URL + USER_PORTFOLIO_PATH, portfolio, company_id)
         return self._delete(url)
 
+    def sync_portfolio(self, portfolio, company_ids, **kwargs):
+        """Makes the companies of the portfolio be exactly company_ids,
+        sending only the differences.
+
+        See common.sync.sync_portfolio for the optional parameters and the
+        structure returned.
+        """
+        from common.sync import sync_portfolio
+        return sync_portfolio(self, portfolio, company_ids, **kwargs)
+
     def get_portfolio_companies(self, query_string=''):
         """Retrieves the companies in a portfolio.
 
         """
         return self._list(URL + USER_PORTFOLIO_COMPANY_PATH, query_string)
 
+    def iter_portfolio_companies(self, query_string='', page_size=None,
+                                 prefetch=False):
+        """Iterates over the companies in a portfolio, following the
+        pagination.
+
+        """
+        return self.iter_list(URL + USER_PORTFOLIO_COMPANY_PATH, query_string,
+                              page_size=page_size, prefetch=prefetch)
+
     ##########################################################################
     #
     # User Starred Companies
@@ -568,6 +1028,14 @@ class PreSeriesAPI(object):
         """
         return self._list(URL + USER_STARRED_PATH, query_string)
 
+    def iter_starred_companies(self, query_string='', page_size=None,
+                               prefetch=False):
+        """Iterates over the starred companies, following the pagination.
+
+        """
+        return self.iter_list(URL + USER_STARRED_PATH, query_string,
+                              page_size=page_size, prefetch=prefetch)
+
     def create_starred(self, company_id, company_name, args=None):
         """Create a starred company
         """
@@ -586,6 +1054,16 @@ class PreSeriesAPI(object):
         """
         return self._delete("%s/%s" % (URL + USER_STARRED_PATH, starred))
 
+    def sync_starred(self, companies, **kwargs):
+        """Makes the starred companies be exactly the given companies,
+        sending only the differences.
+
+        See common.sync.sync_starred for the parameters and the structure
+        returned.
+        """
+        from common.sync import sync_starred
+        return sync_starred(self, companies, **kwargs)
+
     ##########################################################################
     #
     # User Followed Companies
@@ -597,6 +1075,14 @@ class PreSeriesAPI(object):
         """
         return self._list(URL + USER_FOLLOWED_PATH, query_string)
 
+    def iter_followed_companies(self, query_string='', page_size=None,
+                                prefetch=False):
+        """Iterates over the followed companies, following the pagination.
+
+        """
+        return self.iter_list(URL + USER_FOLLOWED_PATH, query_string,
+                              page_size=page_size, prefetch=prefetch)
+
     def create_followed(self, company_id, company_name, args=None):
         """Create a followed company
         """
@@ -614,3 +1100,31 @@ class PreSeriesAPI(object):
         """Removes a followed company
         """
         return self._delete("%s/%s" % (URL + USER_FOLLOWED_PATH, followed))
+
+    def sync_followed(self, companies, **kwargs):
+        """Makes the followed companies be exactly the given companies,
+        sending only the differences.
+
+        See common.sync.sync_followed for the parameters and the structure
+        returned.
+        """
+        from common.sync import sync_followed
+        return sync_followed(self, companies, **kwargs)
+
+
+_DEFAULT_API = None
+_DEFAULT_API_LOCK = threading.Lock()
+
+
+def get_default_api():
+    """Returns the PreSeriesAPI shared by the whole process, created the
+    first time it is used
+    """
+    global _DEFAULT_API
+
+    if _DEFAULT_API is None:
+        with _DEFAULT_API_LOCK:
+            if _DEFAULT_API is None:
+                _DEFAULT_API = PreSeriesAPI()
+
+    return _DEFAULT_API
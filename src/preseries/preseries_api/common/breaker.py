@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+import collections
+import logging
+import threading
+import time
+import httplib2
+
+LOGGER = logging.getLogger('sky')
+
+# States of a circuit breaker
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Fraction of failed requests in the window that opens the circuit
+DEFAULT_FAILURE_RATE = 0.5
+# Minimum number of requests in the window before the circuit can be opened
+DEFAULT_MIN_REQUESTS = 10
+# Seconds of requests taken into account to compute the failure rate
+DEFAULT_WINDOW = 60.0
+# Seconds the circuit stays open before letting probe requests through
+DEFAULT_RESET_TIMEOUT = 30.0
+# Number of probe requests in flight at the same time while half-open
+DEFAULT_HALF_OPEN_PROBES = 1
+
+
+class CircuitOpenError(httplib2.HttpLib2Error):
+    """Raised, without sending the request, when the circuit of the endpoint
+    is open because PreSeries is failing
+    """
+    pass
+
+
+class CircuitBreaker(object):
+    """This class encapsulates the circuit breaker of one endpoint of
+    PreSeries, shared by all the threads that send requests to it.
+
+    While closed, the outcome of every request is recorded. When at least
+    <min_requests> requests were sent in the last <window> seconds and the
+    rate of failures (connection errors and 5xx statuses) reaches
+    <failure_rate>, the circuit opens and the requests are rejected without
+    being sent.
+
+    After <reset_timeout> seconds the circuit gets half-open and lets
+    <half_open_probes> requests through. The first successful probe closes
+    the circuit again, a failed one opens it for another <reset_timeout>.
+    """
+
+    def __init__(self, name='', failure_rate=DEFAULT_FAILURE_RATE,
+                 min_requests=DEFAULT_MIN_REQUESTS, window=DEFAULT_WINDOW,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT,
+                 half_open_probes=DEFAULT_HALF_OPEN_PROBES):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+
+        self.opened = 0
+        self.rejected = 0
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._outcomes = collections.deque()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+
+    @property
+    def state(self):
+        """The current state: CLOSED, OPEN or HALF_OPEN
+        """
+        with self._lock:
+            self._update_state(time.time())
+            return self._state
+
+    def _update_state(self, now):
+        if self._state == OPEN and now - self._opened_at >= self.reset_timeout:
+            LOGGER.warning("Circuit [%s] half-open, sending probe requests",
+                           self.name)
+            self._state = HALF_OPEN
+            self._probes = 0
+
+    def _open(self, now):
+        LOGGER.error("Circuit [%s] open, PRESERIES.IO is failing. Requests "
+                     "rejected during %s seconds", self.name,
+                     self.reset_timeout)
+        self._state = OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+        self._failures = 0
+        self.opened += 1
+
+    def _close(self):
+        LOGGER.warning("Circuit [%s] closed", self.name)
+        self._state = CLOSED
+        self._outcomes.clear()
+        self._failures = 0
+
+    def allow(self):
+        """
+        Checks if a request can be sent, taking a probe slot if half-open
+
+        :return: True if the request can be sent. Its outcome must be
+            reported with record().
+        """
+        with self._lock:
+            self._update_state(time.time())
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and \
+                    self._probes < self.half_open_probes:
+                self._probes += 1
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, failed):
+        """
+        Records the outcome of a request allowed by the breaker
+
+        :param failed: True if PreSeries failed to answer the request
+        """
+        now = time.time()
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probes = max(0, self._probes - 1)
+                if failed:
+                    self._open(now)
+                else:
+                    self._close()
+                return
+
+            if self._state == OPEN:
+                # A request sent before the circuit was opened
+                return
+
+            self._outcomes.append((now, failed))
+            self._failures += failed
+            while self._outcomes and \
+                    self._outcomes[0][0] < now - self.window:
+                self._failures -= self._outcomes.popleft()[1]
+
+            total = len(self._outcomes)
+            if total >= self.min_requests and \
+                    self._failures >= self.failure_rate * total:
+                self._open(now)
+
+    def stats(self):
+        """Returns the state of the breaker for monitoring
+
+        :return: a map with the state, the requests and failures in the
+            window, the times it was opened and the requests rejected
+        """
+        with self._lock:
+            self._update_state(time.time())
+            return {
+                'state': self._state,
+                'requests': len(self._outcomes),
+                'failures': self._failures,
+                'opened': self.opened,
+                'rejected': self.rejected}
+
+
+class CircuitBreakerRegistry(object):
+    """This class keeps one CircuitBreaker per endpoint of PreSeries, so a
+    failing endpoint doesn't stop the requests sent to the others.
+
+    It receives the same parameters as CircuitBreaker, used to build the
+    breaker of each endpoint the first time it is needed.
+    """
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def get(self, endpoint):
+        """Returns the breaker of the endpoint
+        """
+        breaker = self._breakers.get(endpoint)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(endpoint)
+                if breaker is None:
+                    breaker = CircuitBreaker(name=endpoint, **self.kwargs)
+                    self._breakers[endpoint] = breaker
+        return breaker
+
+    def states(self):
+        """Returns a map with the state of the breaker of each endpoint
+        """
+        return dict((endpoint, breaker.state)
+                    for endpoint, breaker in list(self._breakers.items()))
+
+    def stats(self):
+        """Returns a map with the statistics of the breaker of each endpoint
+        """
+        return dict((endpoint, breaker.stats())
+                    for endpoint, breaker in list(self._breakers.items()))
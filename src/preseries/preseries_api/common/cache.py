@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+import collections
+import hashlib
+import os
+import re
+import threading
+import time
+
+DEFAULT_CACHE_DIR = "preseries_cache"
+DEFAULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Seconds a response is valid by endpoint. The responses of the endpoints
+# not informed here use the default ttl. A ttl of 0 disables the cache for
+# the endpoint, that is the case of the user data that can be changed
+# from the PreSeries dashboard.
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+DEFAULT_CACHE_TTLS = {
+    'company_search': 7 * 24 * 60 * 60,
+    'company_data': 24 * 60 * 60,
+    'company_competitor': 7 * 24 * 60 * 60,
+    'company_similar': 7 * 24 * 60 * 60,
+    'portfolio': 0,
+    'portfolio_company': 0,
+    'starred': 0,
+    'following_company': 0
+}
+
+# Query params that must never be part of the cache key
+AUTH_PARAMS = ('username', 'api_key')
+
+REGEX_MATCHER_URL = re.compile(r"^(?:[a-z]+://[^/]+)?/*[^/]+/([^/?]*)(.*)$")
+REGEX_MATCHER_ENTRY = re.compile(r"^([A-Za-z0-9_]*)-([0-9a-f]{40})$")
+
+
+class ResponseCache(object):
+    """This class encapsulates a persistent cache of the responses sent by
+    PreSeries.
+
+    The responses are stored in <directory>, one file per response. They are
+    keyed by endpoint plus the normalized query string, without the
+    credentials, so the same cache can be shared by different users and the
+    api key never ends in the file names. Each endpoint has its own ttl, and
+    the least recently used responses are removed when the total size of the
+    cache is over <max_bytes>.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR,
+                 max_bytes=DEFAULT_CACHE_MAX_BYTES, ttls=None,
+                 default_ttl=DEFAULT_CACHE_TTL):
+        """
+        :param directory: the directory where the responses are stored
+        :param max_bytes: the maximum size of all the responses stored
+        :param ttls: map with the seconds a response is valid by endpoint,
+            it extends DEFAULT_CACHE_TTLS
+        :param default_ttl: the ttl of the endpoints not in ttls
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.ttls = dict(DEFAULT_CACHE_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        # file name -> (endpoint, created, size), least recently used first
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._load()
+
+    def _load(self):
+        """Rebuilds the index of the cache from the files in the directory
+        """
+        entries = []
+        for file_name in os.listdir(self.directory):
+            matcher = REGEX_MATCHER_ENTRY.match(file_name)
+            if not matcher:
+                continue
+            stat = os.stat(os.path.join(self.directory, file_name))
+            entries.append(
+                (stat.st_mtime, file_name, matcher.group(1), stat.st_size))
+
+        for created, file_name, endpoint, size in sorted(entries):
+            self._entries[file_name] = (endpoint, created, size)
+            self._bytes += size
+
+    @staticmethod
+    def make_key(url, query_string=''):
+        """
+        Builds the key of a request
+
+        :param url: the url of the request, with or without the host
+        :param query_string: the query string of the request
+        :return: a tuple (endpoint, key). The key is the sha1 of the path and
+            the sorted query params, without the credentials.
+        """
+        path = url
+        if '?' in path:
+            path, url_query = path.split('?', 1)
+            query_string = '%s&%s' % (url_query, query_string)
+
+        endpoint = ''
+        matcher = REGEX_MATCHER_URL.match(path)
+        if matcher:
+            endpoint = matcher.group(1)
+            path = '%s%s' % (endpoint, matcher.group(2))
+
+        params = sorted(
+            param for param in re.split('[&;]', query_string.lstrip('?'))
+            if param and param.split('=', 1)[0] not in AUTH_PARAMS)
+
+        key = hashlib.sha1(
+            ('%s?%s' % (path.strip('/'), '&'.join(params))).encode('utf-8'))
+        return endpoint, key.hexdigest()
+
+    def ttl(self, endpoint):
+        """Returns the seconds the responses of the endpoint are valid
+        """
+        return self.ttls.get(endpoint, self.default_ttl)
+
+    def _path(self, file_name):
+        return os.path.join(self.directory, file_name)
+
+    def _remove(self, file_name):
+        endpoint, created, size = self._entries.pop(file_name)
+        self._bytes -= size
+        try:
+            os.remove(self._path(file_name))
+        except OSError:
+            pass
+
+    def get(self, url, query_string=''):
+        """
+        Looks for the response of a request in the cache
+
+        :return: the content of the response, None if it isn't in the cache
+            or has expired
+        """
+        endpoint, key = self.make_key(url, query_string)
+        file_name = '%s-%s' % (endpoint, key)
+
+        with self._lock:
+            entry = self._entries.get(file_name)
+            if entry is not None and \
+                    time.time() - entry[1] > self.ttl(endpoint):
+                self._remove(file_name)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            # Most recently used
+            del self._entries[file_name]
+            self._entries[file_name] = entry
+
+        try:
+            with open(self._path(file_name), 'rb') as cache_file:
+                content = cache_file.read()
+        except IOError:
+            with self._lock:
+                if file_name in self._entries:
+                    self._remove(file_name)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return content
+
+    def set(self, url, query_string, content):
+        """
+        Stores the content of the response of a request
+
+        """
+        endpoint, key = self.make_key(url, query_string)
+        if self.ttl(endpoint) <= 0 or len(content) > self.max_bytes:
+            return
+
+        file_name = '%s-%s' % (endpoint, key)
+        tmp_path = '%s.%s.tmp' % (self._path(file_name),
+                                  threading.current_thread().ident)
+        with open(tmp_path, 'wb') as cache_file:
+            cache_file.write(content)
+
+        with self._lock:
+            if file_name in self._entries:
+                self._remove(file_name)
+            try:
+                os.rename(tmp_path, self._path(file_name))
+            except OSError:
+                os.remove(tmp_path)
+                return
+
+            self._entries[file_name] = (endpoint, time.time(), len(content))
+            self._bytes += len(content)
+
+            # Remove the least recently used responses
+            while self._bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, endpoint=None):
+        """Removes all the responses of the endpoint, or all the responses
+        if endpoint is None
+        """
+        with self._lock:
+            for file_name, entry in list(self._entries.items()):
+                if endpoint is None or entry[0] == endpoint:
+                    self._remove(file_name)
+
+    def stats(self):
+        """Returns the usage statistics of the cache
+
+        :return: a map with the hits, misses, evictions, number of responses
+            and total size of the cache
+        """
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (float(self.hits) / requests
+                             if requests else 0.0),
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes}
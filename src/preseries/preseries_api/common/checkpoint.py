@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import threading
+
+LOGGER = logging.getLogger('sky')
+
+# Kinds of work recorded by the pipelines
+SEARCH_CHECKPOINT = 'search'
+BATCH_CHECKPOINT = 'batch'
+
+
+class CheckpointJournal(object):
+    """This class encapsulates an append-only journal of the work completed
+    by a long process, so the work can be skipped when the process is run
+    again after a failure.
+
+    Each completed unit of work is written as one JSON line with its kind,
+    its key and its result, and flushed right away. A line cut by a crash
+    is ignored when the journal is read again.
+
+    Only the position of each line in the file is kept in memory. The
+    results are read again from the file when they are requested.
+
+    It can be shared by many threads.
+    """
+
+    def __init__(self, file_name, resume=False):
+        """
+        :param file_name: the path of the journal
+        :param resume: True to load the work recorded by a previous run.
+            Otherwise the journal is started again.
+        """
+        self.file_name = file_name
+        self.skipped = 0
+
+        self._lock = threading.Lock()
+        self._offsets = {}
+        self._reader = None
+        cut_line = False
+
+        if resume and os.path.exists(file_name):
+            cut_line = self._load()
+            LOGGER.info("Checkpoint %s: %d completed tasks loaded",
+                        file_name, len(self._offsets))
+
+        self._file = open(file_name, 'ab' if resume else 'wb')
+        if cut_line:
+            # The new entries must not be appended to the cut line
+            self._file.write(b'\n')
+            self._file.flush()
+        self._end = os.path.getsize(file_name)
+
+    def _load(self):
+        """Loads the position of the entries of the journal
+
+        :return: True if the last line was cut
+        """
+        line = b''
+        offset = 0
+        with open(self.file_name, 'rb') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    LOGGER.warning("Checkpoint %s: ignoring a malformed "
+                                   "line", self.file_name)
+                else:
+                    self._offsets[(entry['kind'], entry['key'])] = offset
+                offset += len(line)
+        return bool(line) and not line.endswith(b'\n')
+
+    def _read(self, offset):
+        """Reads the result of the entry at the offset of the file
+        """
+        if self._reader is None:
+            self._reader = open(self.file_name, 'rb')
+        self._reader.seek(offset)
+        return json.loads(self._reader.readline().decode('utf-8'))['value']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def has(self, kind, key):
+        """Checks if the work was completed
+        """
+        return (kind, key) in self._offsets
+
+    def get(self, kind, key, default=None):
+        """Returns the result of the completed work, default if it wasn't
+        completed
+        """
+        with self._lock:
+            offset = self._offsets.get((kind, key))
+            if offset is None:
+                return default
+            self.skipped += 1
+            return self._read(offset)
+
+    def record(self, kind, key, value):
+        """
+        Records a completed unit of work
+
+        :param kind: the kind of work, ex. SEARCH_CHECKPOINT
+        :param key: the text that identifies the work within its kind
+        :param value: the result of the work. It must be serializable as
+            JSON.
+        """
+        line = json.dumps({'kind': kind, 'key': key, 'value': value})
+        line = (line + '\n').encode('utf-8')
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self._offsets[(kind, key)] = self._end
+            self._end += len(line)
+
+    def close(self):
+        """Closes the journal file
+        """
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""Compression of the bodies exchanged with PreSeries.
+
+httplib2 asks for gzip and deflate responses and decompresses them by
+itself. This module adds the brotli responses, when a brotli library is
+installed, and the gzip compression of the bodies of the requests.
+"""
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+# Compression level of the bodies of the requests, the default of zlib
+DEFAULT_COMPRESS_LEVEL = 6
+
+# Minimum size of a body to be compressed
+DEFAULT_COMPRESS_MIN_SIZE = 16 * 1024
+
+# Window bits of zlib for the gzip format
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def accept_encoding():
+    """Returns the value of the Accept-Encoding header with the content
+    codings that can be decompressed, None to keep the one of httplib2
+    """
+    if brotli is not None:
+        return 'gzip, deflate, br'
+    return None
+
+
+def decompress_response(response, content):
+    """
+    Decompresses the body of a brotli response, which httplib2 doesn't,
+    and removes its Content-Encoding header
+
+    :param response: the headers of the response, as returned by httplib2
+    :param content: the body of the response
+    :return: the decompressed body. A ValueError is raised if the body is
+        corrupted or no brotli library is installed.
+    """
+    coding = (response.get('content-encoding') or '').strip().lower()
+    if coding != 'br' or not content:
+        return content
+    if brotli is None:
+        raise ValueError("The response is compressed with brotli, which is "
+                         "not installed")
+    try:
+        content = brotli.decompress(content)
+    except brotli.error as exception:
+        raise ValueError("Corrupted br content: %s" % exception)
+    del response['content-encoding']
+    response['-content-encoding'] = coding
+    return content
+
+
+def compress(body, level=DEFAULT_COMPRESS_LEVEL):
+    """Returns the body compressed with gzip
+    """
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(body) + compressor.flush()
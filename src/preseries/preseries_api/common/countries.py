@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import threading
+import unicodedata
+from Levenshtein import jaro_winkler
+
+from common.memo import LRUMemo
+
+COUNTRIES_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'countries.csv')
+
+# Number of fuzzy matches kept in memory
+DEFAULT_FUZZY_MEMO_SIZE = 5000
+
+# Usual names of countries that are not the ISO 3166 name in countries.csv,
+# by ISO 3166-1 alfa-3 code
+COUNTRY_ALIASES = {
+    'USA': ['usa', 'united states of america', 'america'],
+    'GBR': ['uk', 'great britain', 'britain', 'england', 'scotland', 'wales',
+            'northern ireland'],
+    'KOR': ['south korea', 'korea', 'republic of korea'],
+    'PRK': ['north korea'],
+    'RUS': ['russia'],
+    'IRN': ['iran'],
+    'VNM': ['vietnam'],
+    'CZE': ['czechia'],
+    'TWN': ['taiwan'],
+    'SYR': ['syria'],
+    'LAO': ['laos'],
+    'MDA': ['moldova'],
+    'MKD': ['macedonia', 'north macedonia'],
+    'VAT': ['vatican', 'vatican city'],
+    'PSE': ['palestine'],
+    'TZA': ['tanzania'],
+    'CIV': ['ivory coast'],
+    'SWZ': ['eswatini'],
+    'CPV': ['cabo verde'],
+    'BRN': ['brunei'],
+    'FSM': ['micronesia'],
+    'COD': ['dr congo', 'drc', 'congo kinshasa'],
+    'COG': ['congo brazzaville'],
+    'MMR': ['burma'],
+    'NLD': ['holland', 'the netherlands'],
+    'ARE': ['uae', 'emirates'],
+    'MAC': ['macau'],
+}
+
+REGEX_MATCHER_NON_ALPHANUMERIC = re.compile(r"[^a-z0-9]+")
+
+
+class CountryIndex(object):
+    """This class encapsulates the ISO 3166 country table and resolves
+    free text into ISO 3166-1 alfa-3 codes.
+
+    The codes, names and aliases are indexed in dictionaries by their
+    normalized form (lower case, without diacritics or punctuation), so the
+    exact matches are a dictionary lookup. The rest of the texts are
+    resolved with the closest name by the Jaro-Winkler distance, and the
+    result is memoized.
+    """
+
+    def __init__(self, file_name=COUNTRIES_FILE, aliases=COUNTRY_ALIASES,
+                 fuzzy_memo_size=DEFAULT_FUZZY_MEMO_SIZE):
+        self.names = []
+        self.codes_2letter = []
+        self.codes_3letter = []
+
+        with open(file_name, 'rb') as f:
+            for line in f:
+                country = line.decode('utf-8').rstrip('\r\n').split('\t')
+                if len(country) < 3:
+                    continue
+                self.names.append(self.normalize(country[0]))
+                self.codes_2letter.append(country[1].lower())
+                self.codes_3letter.append(country[2].lower())
+
+        self.by_code_3letter = dict(
+            (code, code.upper()) for code in self.codes_3letter)
+        self.by_code_2letter = dict(
+            (code, self.codes_3letter[index].upper())
+            for index, code in enumerate(self.codes_2letter))
+        self.by_name = dict(
+            (name, self.codes_3letter[index].upper())
+            for index, name in enumerate(self.names))
+        for code, names in aliases.items():
+            for name in names:
+                self.by_name.setdefault(self.normalize(name), code)
+
+        self._fuzzy_memo = LRUMemo(fuzzy_memo_size)
+
+    @staticmethod
+    def normalize(text):
+        """
+        Normalizes a text to compare it with the names and codes of the
+        countries: lower case, without diacritics and with the punctuation
+        replaced by single spaces. Ex. u'Côte d’Ivoire' -> u'cote d ivoire'
+
+        :param text: the text to normalize (str, unicode or number)
+        :return: the unicode normalized text
+        """
+        if isinstance(text, bytes):
+            try:
+                text = text.decode('utf-8')
+            except UnicodeDecodeError:
+                text = text.decode('cp1252', 'ignore')
+        else:
+            text = u'%s' % text
+
+        text = unicodedata.normalize('NFKD', text.lower())
+        text = u''.join(char for char in text
+                        if not unicodedata.combining(char))
+
+        return REGEX_MATCHER_NON_ALPHANUMERIC.sub(u' ', text).strip()
+
+    def closest(self, normalized_text):
+        """
+        Looks for the country name closest to the text using the
+        Jaro-Winkler distance
+
+        :param normalized_text: the normalized text
+        :return: the ISO 3166-1 alfa-3 code of the closest country
+        """
+        best_index = 0
+        best_ratio = -1.0
+        for index, name in enumerate(self.names):
+            ratio = jaro_winkler(name, normalized_text)
+            if ratio > best_ratio:
+                best_index, best_ratio = index, ratio
+
+        return self.codes_3letter[best_index].upper()
+
+    def resolve(self, country_text):
+        """
+        We are going to look for the best match between the country_text
+        informed and the ISO 3166-1 alfa-3 code. The text can be an ISO
+        3166-1 alfa-3 or alfa-2 code, a country name or one of its aliases.
+
+        :param country_text: the text about the country
+        :return: the ISO 3166-1 alfa-3 code
+        """
+        text = self.normalize(country_text)
+        # Codes written with dots, like U.S.A.
+        compact_text = text.replace(u' ', u'')
+
+        code = self.by_code_3letter.get(compact_text) or \
+            self.by_code_2letter.get(compact_text) or \
+            self.by_name.get(text) or \
+            self.by_name.get(compact_text)
+        if code:
+            return code
+
+        return self._fuzzy_memo.get_or_compute(
+            text, lambda: self.closest(text))
+
+
+_COUNTRY_INDEX = None
+_COUNTRY_INDEX_LOCK = threading.Lock()
+
+
+def get_country_index():
+    """Returns the CountryIndex shared by the whole process, loading the
+    countries the first time it is used
+    """
+    global _COUNTRY_INDEX
+
+    if _COUNTRY_INDEX is None:
+        with _COUNTRY_INDEX_LOCK:
+            if _COUNTRY_INDEX is None:
+                _COUNTRY_INDEX = CountryIndex()
+
+    return _COUNTRY_INDEX
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""Decoding of the JSON documents returned by PreSeries.
+
+The documents are decoded with the fastest library installed: orjson, ujson
+or the json module of the standard library. The PRESERIES_JSON_BACKEND
+environment variable forces one of them.
+"""
+import json
+import os
+import re
+from json.decoder import scanstring
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+# Libraries used to decode JSON, from the fastest
+JSON_BACKENDS = ('orjson', 'ujson', 'json')
+
+# The library used by default, 'auto' for the fastest installed
+PRESERIES_JSON_BACKEND = os.getenv("PRESERIES_JSON_BACKEND", "auto")
+
+# Whitespace allowed between the tokens of a JSON document
+REGEX_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def _to_text(content):
+    if isinstance(content, bytes):
+        return content.decode('utf-8')
+    return content
+
+
+def _loads_function(backend):
+    """Returns the function that decodes a document with the backend, and
+    the name of the backend. An ImportError is raised if it isn't installed.
+    """
+    if backend == 'orjson':
+        import orjson
+        return orjson.loads, backend
+    if backend == 'ujson':
+        import ujson
+        return lambda content: ujson.loads(_to_text(content)), backend
+    if backend == 'json':
+        return lambda content: json.loads(_to_text(content)), backend
+    raise ValueError("Unknown JSON backend: %s" % backend)
+
+
+def _fastest_loads_function():
+    for backend in JSON_BACKENDS:
+        try:
+            return _loads_function(backend)
+        except ImportError:
+            continue
+
+
+class LazyDocument(Mapping):
+    """A JSON object whose top-level values are decoded when they are read.
+
+    The entries are decoded in the order of the document, up to the one
+    read, so reading the 'meta' of a page, which comes before its
+    'objects', doesn't decode the objects. It is read like a dict.
+    dict(document) decodes all the values, ex. to serialize it again.
+
+    The values are decoded with the C scanner of the json module, whatever
+    the backend of the decoder.
+    """
+
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, text):
+        """
+        :param text: the document, a JSON object
+        """
+        whitespace = REGEX_JSON_WHITESPACE.match(text).end()
+        if text[whitespace:whitespace + 1] != '{':
+            raise ValueError("Expecting a JSON object")
+        self._text = text
+        self._position = whitespace + 1
+        self._values = {}
+        self._done = False
+
+    def _skip_whitespace(self, position):
+        return REGEX_JSON_WHITESPACE.match(self._text, position).end()
+
+    def _decode_next(self):
+        """Decodes the next entry of the document
+
+        :return: its key, None at the end of the document
+        """
+        text = self._text
+        position = self._skip_whitespace(self._position)
+        char = text[position:position + 1]
+        if char == '}':
+            self._done = True
+            return None
+        if self._values:
+            if char != ',':
+                raise ValueError("Expecting ',' at %d" % position)
+            position = self._skip_whitespace(position + 1)
+            char = text[position:position + 1]
+        if char != '"':
+            raise ValueError("Expecting a key at %d" % position)
+
+        key, position = scanstring(text, position + 1)
+        position = self._skip_whitespace(position)
+        if text[position:position + 1] != ':':
+            raise ValueError("Expecting ':' at %d" % position)
+        position = self._skip_whitespace(position + 1)
+        value, self._position = self._decoder.raw_decode(text, position)
+        self._values[key] = value
+        return key
+
+    def _decode_until(self, key):
+        while key not in self._values and not self._done:
+            self._decode_next()
+
+    def __getitem__(self, key):
+        self._decode_until(key)
+        return self._values[key]
+
+    def __contains__(self, key):
+        self._decode_until(key)
+        return key in self._values
+
+    def __iter__(self):
+        self._decode_until(None)
+        return iter(self._values)
+
+    def __len__(self):
+        self._decode_until(None)
+        return len(self._values)
+
+    def __repr__(self):
+        return 'LazyDocument(%s%s)' % (
+            ', '.join(repr(key) for key in self._values),
+            '' if self._done else ', ...')
+
+    def select(self, keys):
+        """Returns a dict with the entries of the keys, decoding the
+        document only up to the last of them
+        """
+        keys = set(keys)
+        while not keys.issubset(self._values) and not self._done:
+            self._decode_next()
+        return dict((key, value) for key, value in self._values.items()
+                    if key in keys)
+
+
+class JsonDecoder(object):
+    """This class decodes the responses of PreSeries with a JSON backend,
+    the fastest installed by default.
+
+    With <lazy>, the JSON objects are returned as LazyDocuments, which only
+    decode the top-level values up to the ones read.
+    """
+
+    def __init__(self, backend=PRESERIES_JSON_BACKEND, lazy=False):
+        """
+        :param backend: 'orjson', 'ujson', 'json' or 'auto' for the fastest
+            installed
+        :param lazy: True to return the objects as LazyDocuments
+        """
+        if backend == 'auto':
+            self._loads, self.backend = _fastest_loads_function()
+        else:
+            self._loads, self.backend = _loads_function(backend)
+        self.lazy = lazy
+
+    def loads(self, content, keys=None):
+        """
+        Decodes a document
+
+        :param content: the document, as bytes or text
+        :param keys: the top-level keys to decode, None for all of them. The
+            document is decoded up to the last of them, and the rest of the
+            keys are not returned.
+        :return: the decoded document. A ValueError is raised if it isn't
+            valid JSON.
+        """
+        if not (self.lazy or keys):
+            return self._loads(content)
+
+        text = _to_text(content)
+        try:
+            document = LazyDocument(text)
+        except ValueError:
+            # Not an object, there are no keys to select
+            return self._loads(text)
+
+        if keys:
+            return document.select(keys)
+        return document
+
+
+DEFAULT_DECODER = JsonDecoder()
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+import collections
+import logging
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+LOGGER = logging.getLogger('sky')
+
+# Percentile of the latency of the endpoint after which a duplicate request
+# is sent
+DEFAULT_HEDGE_PERCENTILE = 95
+# Maximum fraction of the requests that can be duplicated
+DEFAULT_HEDGE_BUDGET = 0.05
+# Latencies observed in an endpoint before sending any duplicate
+DEFAULT_MIN_SAMPLES = 20
+# Latencies kept per endpoint to compute the percentile
+DEFAULT_MAX_SAMPLES = 500
+# Maximum number of threads kept to send the requests that can be hedged
+DEFAULT_MAX_WORKERS = 32
+
+
+class _WorkerPool(object):
+    """Threads reused to run functions. A thread is only started when all
+    the ones started are busy, up to <max_workers>.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._tasks = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = 0
+        self._idle = 0
+
+    def submit(self, function):
+        """
+        Runs the function in one of the threads. It must not raise any
+        exception.
+
+        :return: False if all the threads are busy and no more can be
+            started, and then the function is not run
+        """
+        with self._lock:
+            if self._idle:
+                self._idle -= 1
+            elif self._workers < self.max_workers:
+                self._workers += 1
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+            else:
+                return False
+            self._tasks.put(function)
+        return True
+
+    def _work(self):
+        while True:
+            function = self._tasks.get()
+            function()
+            with self._lock:
+                self._idle += 1
+
+
+class HedgingPolicy(object):
+    """This class encapsulates when a duplicate of a slow GET request must be
+    sent to PreSeries, so the caller takes the first response that arrives.
+
+    It keeps the last <max_samples> latencies of each endpoint. When a
+    request hasn't been answered after the <percentile> of the latencies of
+    its endpoint, a duplicate is sent, as long as the duplicates sent are no
+    more than <budget> of all the requests.
+
+    The requests that can be hedged are sent from a pool of up to
+    <max_workers> threads shared by all the requests, while the caller waits
+    for the first response. If all the threads are busy, the request is sent
+    from the caller's thread without a duplicate.
+    """
+
+    def __init__(self, percentile=DEFAULT_HEDGE_PERCENTILE,
+                 budget=DEFAULT_HEDGE_BUDGET, min_samples=DEFAULT_MIN_SAMPLES,
+                 max_samples=DEFAULT_MAX_SAMPLES,
+                 max_workers=DEFAULT_MAX_WORKERS):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.max_workers = max_workers
+
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._pool = _WorkerPool(max_workers)
+
+    def record(self, endpoint, latency):
+        """Keeps the latency of a request answered by the endpoint
+        """
+        with self._lock:
+            latencies = self._latencies.get(endpoint)
+            if latencies is None:
+                latencies = collections.deque(maxlen=self.max_samples)
+                self._latencies[endpoint] = latencies
+            latencies.append(latency)
+
+    def delay(self, endpoint):
+        """
+        Returns the seconds to wait for a response of the endpoint before
+        sending a duplicate request
+
+        :param endpoint: the endpoint of the request
+        :return: the seconds, None if there aren't enough latencies yet
+        """
+        with self._lock:
+            self.requests += 1
+            latencies = self._latencies.get(endpoint)
+            if latencies is None or len(latencies) < self.min_samples:
+                return None
+            latencies = sorted(latencies)
+        index = int(round(self.percentile / 100.0 * (len(latencies) - 1)))
+        return latencies[index]
+
+    def try_hedge(self):
+        """Takes a duplicate request from the budget
+
+        :return: True if the duplicate can be sent
+        """
+        with self._lock:
+            if self.hedged + 1 > self.budget * self.requests:
+                return False
+            self.hedged += 1
+            return True
+
+    def _untake_hedge(self):
+        with self._lock:
+            self.hedged -= 1
+
+    def _send_inline(self, endpoint, request):
+        start_time = time.time()
+        result = request()
+        self.record(endpoint, time.time() - start_time)
+        return result
+
+    def send(self, endpoint, request, hedge_request=None):
+        """
+        Sends a request, and a duplicate of it if it's slower than the
+        deadline of its endpoint
+
+        :param endpoint: the endpoint of the request
+        :param request: the function that sends the request and returns its
+            response. It's called from other threads.
+        :param hedge_request: the function that sends the duplicate, by
+            default request. It must take its own token from the rate
+            limiter and check the circuit breaker, if any, as the duplicate
+            is one more request to the server.
+        :return: the first response received. If all the requests sent
+            failed the last exception is raised.
+        """
+        if hedge_request is None:
+            hedge_request = request
+        deadline = self.delay(endpoint)
+        if deadline is None:
+            # Not enough latencies to compute the deadline, the request is
+            # sent from the current thread
+            return self._send_inline(endpoint, request)
+
+        results = queue.Queue()
+
+        def attempt(hedge):
+            start_time = time.time()
+            try:
+                result = hedge_request() if hedge else request()
+            except Exception as exception:
+                results.put((hedge, False, exception))
+            else:
+                self.record(endpoint, time.time() - start_time)
+                results.put((hedge, True, result))
+
+        if not self._pool.submit(lambda: attempt(False)):
+            return self._send_inline(endpoint, request)
+        pending = 1
+        try:
+            hedge, succeeded, result = results.get(timeout=deadline)
+        except queue.Empty:
+            if self.try_hedge():
+                if self._pool.submit(lambda: attempt(True)):
+                    LOGGER.info("No response of [%s] after %.3f seconds, "
+                                "sending a duplicate request", endpoint,
+                                deadline)
+                    pending += 1
+                else:
+                    self._untake_hedge()
+            hedge, succeeded, result = results.get()
+        pending -= 1
+
+        # If the first request that finished failed, we wait for the other
+        while not succeeded and pending:
+            hedge, succeeded, result = results.get()
+            pending -= 1
+
+        if not succeeded:
+            raise result
+        if hedge:
+            with self._lock:
+                self.hedge_wins += 1
+        return result
+
+    def stats(self):
+        """Returns the usage statistics of the policy
+
+        :return: a map with the requests that could be duplicated, the
+            duplicates sent, the duplicates answered before the original
+            request and the current deadline of each endpoint
+        """
+        deadlines = {}
+        with self._lock:
+            for endpoint, latencies in self._latencies.items():
+                if len(latencies) >= self.min_samples:
+                    latencies = sorted(latencies)
+                    deadlines[endpoint] = latencies[int(round(
+                        self.percentile / 100.0 * (len(latencies) - 1)))]
+            return {
+                'requests': self.requests,
+                'hedged': self.hedged,
+                'hedge_wins': self.hedge_wins,
+                'deadlines': deadlines}
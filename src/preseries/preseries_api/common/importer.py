@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+from multiprocessing.pool import ThreadPool
+
+from common.api import PreSeriesAPIError
+from common.sync import unique_ids
+from common.utils import PreSeriesUtils
+
+LOGGER = logging.getLogger('sky')
+
+# Number of companies of each chunk. The first chunk is sent in the body of
+# the request that creates the portfolio.
+DEFAULT_CHUNK_SIZE = 100
+
+# Number of chunks added to the portfolio at the same time
+DEFAULT_IMPORT_CONCURRENCY = 8
+
+
+class PortfolioImporter(object):
+    """This class encapsulates the import of a large list of companies into a
+    new portfolio.
+
+    The portfolio is created with the first <chunk_size> companies, so the
+    body of the request is bounded. The rest of the companies are split in
+    chunks of <chunk_size>, and each chunk adds only its own companies with
+    the add-only portfolio_add_company request. Up to <concurrency> chunks
+    are added at the same time.
+
+    Each time a chunk has been answered, the progress is reported and the
+    chunk is recorded as done in the <state_file>, if any. If the import is
+    interrupted, running it again with the same state file, name and
+    companies adds only the chunks that weren't done, without creating the
+    portfolio again, and tries again the companies that couldn't be added.
+    """
+
+    def __init__(self, api, chunk_size=DEFAULT_CHUNK_SIZE,
+                 concurrency=DEFAULT_IMPORT_CONCURRENCY, state_file=None,
+                 progress=None):
+        """
+        :param api: the PreSeriesAPI
+        :param chunk_size: the number of companies of each chunk
+        :param concurrency: the maximum number of chunks in flight
+        :param state_file: the path of the JSON file where the progress is
+            kept to resume the import
+        :param progress: the function called with the number of companies
+            confirmed and the total after each chunk
+        """
+        self.api = api
+        self.chunk_size = max(1, chunk_size)
+        self.concurrency = max(1, concurrency)
+        self.state_file = state_file
+        self.progress = progress
+
+    def _load_state(self):
+        if self.state_file and os.path.exists(self.state_file):
+            with open(self.state_file) as state_file:
+                return json.load(state_file)
+        return None
+
+    def _save_state(self, state):
+        if not self.state_file:
+            return
+        tmp_path = '%s.tmp' % self.state_file
+        with open(tmp_path, 'w') as state_file:
+            json.dump(state, state_file)
+        # The previous state is kept until the new one replaces it
+        PreSeriesUtils.replace_file(tmp_path, self.state_file)
+
+    def _confirm(self, state):
+        self._save_state(state)
+        LOGGER.info("Portfolio [%s]: %d/%d companies imported, %d errors",
+                    state['portfolio'], state['confirmed'], state['total'],
+                    len(state['errors']))
+        if self.progress is not None:
+            self.progress(state['confirmed'], state['total'])
+
+    def _add_chunk(self, portfolio, chunk):
+        """
+        Adds the companies of a chunk to the portfolio, one request each
+
+        :param chunk: the companies to be added
+        :return: the map with the error of each company that couldn't be
+            added
+        """
+        errors = {}
+        for company_id in chunk:
+            response = self.api.portfolio_add_company(portfolio, company_id)
+            if response['error']:
+                errors[company_id] = response['error']
+        return errors
+
+    def run(self, name, company_ids):
+        """
+        Creates the portfolio and adds the companies to it
+
+        :param name: the name of the portfolio
+        :param company_ids: the ids of the companies
+        :return: a map with the id of the 'portfolio', the 'total' number of
+            companies, the number of companies 'confirmed' and the map of
+            'errors' with the error of each company that couldn't be added.
+            A PreSeriesAPIError is raised if the portfolio can't be created.
+        """
+        company_ids = unique_ids(company_ids)
+        ids_hash = hashlib.sha1(
+            ','.join(company_ids).encode('utf-8')).hexdigest()
+
+        state = self._load_state()
+        if state is not None:
+            if state['name'] != name or state['ids_hash'] != ids_hash:
+                raise ValueError(
+                    "The state file %s belongs to another import" %
+                    self.state_file)
+            LOGGER.info("Portfolio [%s]: resuming the import after %d "
+                        "companies, %d to try again", state['portfolio'],
+                        state['confirmed'], len(state['errors']))
+        else:
+            first_chunk = company_ids[:self.chunk_size]
+            response = self.api.create_portfolio(name, first_chunk)
+            if response['error']:
+                raise PreSeriesAPIError(
+                    "The portfolio %s couldn't be created" % name, response)
+
+            state = {
+                'name': name,
+                'ids_hash': ids_hash,
+                'portfolio': response['id'],
+                'total': len(company_ids),
+                'chunk_size': self.chunk_size,
+                'confirmed': len(first_chunk),
+                'done': [],
+                'errors': {}}
+            self._confirm(state)
+
+        portfolio = state['portfolio']
+        # The chunks are the ones of the first run, even if the chunk size
+        # changed since then
+        chunk_size = state['chunk_size']
+        done = set(state['done'])
+
+        # The companies that failed in a previous run are sent again in
+        # their own chunks, before the chunks not done yet
+        retry_ids = [company_id for company_id in company_ids
+                     if company_id in state['errors']]
+        tasks = [(None, retry_ids[start:start + chunk_size])
+                 for start in range(0, len(retry_ids), chunk_size)]
+        tasks.extend((start, company_ids[start:start + chunk_size])
+                     for start in range(chunk_size, len(company_ids),
+                                        chunk_size)
+                     if start not in done)
+
+        def add(task):
+            start, chunk = task
+            return start, chunk, self._add_chunk(portfolio, chunk)
+
+        if self.concurrency > 1 and len(tasks) > 1:
+            pool = ThreadPool(min(self.concurrency, len(tasks)))
+            results = pool.imap_unordered(add, tasks)
+        else:
+            pool = None
+            results = (add(task) for task in tasks)
+
+        try:
+            for start, chunk, errors in results:
+                for company_id in chunk:
+                    state['errors'].pop(company_id, None)
+                state['errors'].update(errors)
+                if start is not None:
+                    state['done'].append(start)
+                    state['confirmed'] += len(chunk)
+                self._confirm(state)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        return {
+            'portfolio': portfolio,
+            'total': state['total'],
+            'confirmed': state['confirmed'],
+            'errors': state['errors']}
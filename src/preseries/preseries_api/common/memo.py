@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import collections
+import threading
+
+DEFAULT_MEMO_SIZE = 10000
+
+
+class _PendingCall(object):
+    """A computation in progress that other threads can wait for
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class LRUMemo(object):
+    """This class encapsulates a thread-safe memo of the results of a
+    computation, bounded to the <max_size> most recently used keys.
+
+    If many threads ask for the same key at the same time, only the first
+    one computes the value; the others wait for it and get the same result.
+    None results are not stored, so they are computed again the next time.
+    """
+
+    def __init__(self, max_size=DEFAULT_MEMO_SIZE):
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+        self._lock = threading.Lock()
+        self._values = collections.OrderedDict()
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._values)
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the value stored for the key, computing it if it isn't in
+        the memo
+
+        :param key: the key of the value
+        :param compute: function without parameters that computes the value
+        :return: the value
+        """
+        with self._lock:
+            if key in self._values:
+                value = self._values.pop(key)
+                self._values[key] = value
+                self.hits += 1
+                return value
+
+            pending = self._pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = _PendingCall()
+                self._pending[key] = pending
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.value
+
+        try:
+            pending.value = compute()
+        except Exception as ex:
+            pending.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+                if pending.error is None and pending.value is not None:
+                    self._values[key] = pending.value
+                    while len(self._values) > self.max_size:
+                        self._values.popitem(last=False)
+            pending.event.set()
+
+        return pending.value
+
+    def clear(self):
+        """Removes all the values
+        """
+        with self._lock:
+            self._values.clear()
+
+    def stats(self):
+        """Returns the usage statistics of the memo
+
+        :return: a map with the hits, misses, requests coalesced with
+            another one in progress and the number of values stored
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'size': len(self._values),
+                'max_size': self.max_size}
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""Metrics of the requests sent to PreSeries.
+
+PreSeriesAPI calls each of its hooks with a RequestEvent after every
+request. MetricsAggregator is a hook that keeps counters and latency
+histograms in memory, and PrometheusExporter and OpenTelemetryExporter
+publish them.
+"""
+import bisect
+import logging
+import threading
+import time
+
+from common.utils import PreSeriesUtils
+
+LOGGER = logging.getLogger('sky')
+
+# Upper bounds, in seconds, of the buckets of the latency histograms
+DEFAULT_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Prefix of the names of the metrics exported
+DEFAULT_METRICS_PREFIX = 'preseries'
+
+# Name of the service that reports the metrics in OpenTelemetry
+DEFAULT_SERVICE_NAME = 'preseries_api'
+
+# Aggregation temporality of the OpenTelemetry sums and histograms
+OTEL_CUMULATIVE = 2
+
+
+class RequestEvent(object):
+    """The outcome of a request sent to PreSeries, with its retries.
+
+    The status is None if no response was received, and then error holds
+    the name of the exception raised. The latency includes the retries.
+    """
+    __slots__ = ('method', 'endpoint', 'status', 'latency', 'request_size',
+                 'response_size', 'retries', 'cached', 'error', 'timestamp')
+
+    def __init__(self, method, endpoint, request_size=0):
+        self.method = method
+        self.endpoint = endpoint
+        self.status = None
+        self.latency = 0.0
+        self.request_size = request_size
+        self.response_size = 0
+        self.retries = 0
+        self.cached = False
+        self.error = None
+        self.timestamp = time.time()
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class _Histogram(object):
+    """Counts the values falling in each bucket, and their sum
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, percentile):
+        """Returns the upper bound of the bucket where the percentile falls,
+        None if it is above the last bound
+        """
+        if not self.count:
+            return None
+        rank = self.count * percentile / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.bounds[index] if index < len(self.bounds) \
+                    else None
+        return None
+
+
+class MetricsAggregator(object):
+    """This class keeps in memory the metrics of the requests, by endpoint
+    and method:
+
+    - the requests answered with each status, or failed with each error
+    - the retries, the responses taken from the cache and the bytes sent and
+      received
+    - the histogram of the latencies, with the bounds in <buckets>
+
+    It is a hook of PreSeriesAPI, and can be shared by many threads and many
+    instances.
+    """
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.start_time = time.time()
+
+        self._lock = threading.Lock()
+        self._outcomes = {}
+        self._series = {}
+
+    def __call__(self, event):
+        self.record(event)
+
+    def record(self, event):
+        """Adds the RequestEvent to the metrics
+        """
+        series_key = (event.endpoint, event.method)
+        outcome_key = series_key + (
+            '%s' % event.status if event.status is not None else '',
+            event.error or '')
+        with self._lock:
+            self._outcomes[outcome_key] = \
+                self._outcomes.get(outcome_key, 0) + 1
+            series = self._series.get(series_key)
+            if series is None:
+                series = {
+                    'retries': 0,
+                    'cache_hits': 0,
+                    'bytes_sent': 0,
+                    'bytes_received': 0,
+                    'latency': _Histogram(self.buckets)}
+                self._series[series_key] = series
+            series['retries'] += event.retries
+            series['cache_hits'] += 1 if event.cached else 0
+            series['bytes_sent'] += event.request_size
+            series['bytes_received'] += event.response_size
+            series['latency'].observe(event.latency)
+
+    def reset(self):
+        """Forgets all the metrics
+        """
+        with self._lock:
+            self._outcomes = {}
+            self._series = {}
+            self.start_time = time.time()
+
+    def outcomes(self):
+        """Returns a list of tuples (endpoint, method, status, error, count)
+        """
+        with self._lock:
+            return sorted(key + (count,)
+                          for key, count in self._outcomes.items())
+
+    def series(self):
+        """Returns a list of maps with the endpoint, method, retries,
+        cache_hits, bytes_sent, bytes_received and the 'latency' histogram,
+        as a map with its 'bounds', the 'counts' of each bucket, the 'count'
+        and the 'sum'
+        """
+        with self._lock:
+            result = []
+            for (endpoint, method), series in sorted(self._series.items()):
+                histogram = series['latency']
+                entry = dict(series)
+                entry.update({
+                    'endpoint': endpoint,
+                    'method': method,
+                    'latency': {
+                        'bounds': histogram.bounds,
+                        'counts': list(histogram.counts),
+                        'count': histogram.count,
+                        'sum': histogram.sum}})
+                result.append(entry)
+            return result
+
+    def stats(self):
+        """Returns a map with the statistics of each endpoint: the requests,
+        the errors (no response or a status of 500 or more), the retries,
+        the cache hits, the bytes and the approximate p50 and p95 latencies
+        """
+        with self._lock:
+            stats = {}
+            for (endpoint, method), series in self._series.items():
+                histogram = series['latency']
+                stats['%s %s' % (method, endpoint)] = {
+                    'requests': histogram.count,
+                    'errors': 0,
+                    'retries': series['retries'],
+                    'cache_hits': series['cache_hits'],
+                    'bytes_sent': series['bytes_sent'],
+                    'bytes_received': series['bytes_received'],
+                    'latency_avg': histogram.sum / histogram.count,
+                    'latency_p50': histogram.percentile(50),
+                    'latency_p95': histogram.percentile(95)}
+            for (endpoint, method, status, error), count in \
+                    self._outcomes.items():
+                if error or int(status) >= 500:
+                    stats['%s %s' % (method, endpoint)]['errors'] += count
+            return stats
+
+
+def _escape_label(value):
+    return ('%s' % value).replace('\\', '\\\\').replace(
+        '\n', '\\n').replace('"', '\\"')
+
+
+def _labels(**labels):
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, _escape_label(value))
+        for name, value in sorted(labels.items()))
+
+
+def _format_bound(bound):
+    return '%g' % bound
+
+
+class PrometheusExporter(object):
+    """Publishes the metrics of a MetricsAggregator in the Prometheus text
+    exposition format, to be served by an HTTP endpoint or written for the
+    textfile collector of the node exporter.
+    """
+
+    def __init__(self, aggregator, prefix=DEFAULT_METRICS_PREFIX):
+        self.aggregator = aggregator
+        self.prefix = prefix
+
+    def render(self):
+        """Returns the metrics as text
+        """
+        prefix = self.prefix
+        lines = []
+
+        name = '%s_requests_total' % prefix
+        lines.append('# HELP %s Requests sent to PreSeries.' % name)
+        lines.append('# TYPE %s counter' % name)
+        for endpoint, method, status, error, count in \
+                self.aggregator.outcomes():
+            lines.append('%s%s %d' % (name, _labels(
+                endpoint=endpoint, method=method, status=status,
+                error=error), count))
+
+        series = self.aggregator.series()
+        counters = (
+            ('retries', 'request_retries_total',
+             'Requests sent again after a failure.'),
+            ('cache_hits', 'cache_hits_total',
+             'Responses taken from the cache.'),
+            ('bytes_sent', 'request_bytes_total',
+             'Bytes sent in the body of the requests.'),
+            ('bytes_received', 'response_bytes_total',
+             'Bytes received in the body of the responses.'))
+        for field, suffix, description in counters:
+            name = '%s_%s' % (prefix, suffix)
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s counter' % name)
+            for entry in series:
+                lines.append('%s%s %d' % (name, _labels(
+                    endpoint=entry['endpoint'], method=entry['method']),
+                    entry[field]))
+
+        name = '%s_request_duration_seconds' % prefix
+        lines.append('# HELP %s Latency of the requests, with their '
+                     'retries.' % name)
+        lines.append('# TYPE %s histogram' % name)
+        for entry in series:
+            latency = entry['latency']
+            labels = {'endpoint': entry['endpoint'],
+                      'method': entry['method']}
+            cumulative = 0
+            for bound, count in zip(latency['bounds'] + ('+Inf',),
+                                    latency['counts']):
+                cumulative += count
+                labels['le'] = bound if bound == '+Inf' else \
+                    _format_bound(bound)
+                lines.append('%s_bucket%s %d' % (
+                    name, _labels(**labels), cumulative))
+            del labels['le']
+            lines.append('%s_sum%s %s' % (
+                name, _labels(**labels), repr(latency['sum'])))
+            lines.append('%s_count%s %d' % (
+                name, _labels(**labels), latency['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, file_name):
+        """Writes the metrics to the file, replacing it at once so the
+        collector never reads it half written
+        """
+        tmp_path = '%s.tmp' % file_name
+        with open(tmp_path, 'w') as metrics_file:
+            metrics_file.write(self.render())
+        PreSeriesUtils.replace_file(tmp_path, file_name)
+
+
+def _attributes(**attributes):
+    return [{'key': key, 'value': {'stringValue': '%s' % value}}
+            for key, value in sorted(attributes.items())]
+
+
+class OpenTelemetryExporter(object):
+    """Publishes the metrics of a MetricsAggregator with the structure of
+    the OpenTelemetry protocol (OTLP) in JSON, so they can be posted to the
+    /v1/metrics endpoint of a collector.
+
+    The sums and histograms are cumulative since the aggregator was created
+    or reset.
+    """
+
+    def __init__(self, aggregator, service_name=DEFAULT_SERVICE_NAME,
+                 prefix=DEFAULT_METRICS_PREFIX):
+        self.aggregator = aggregator
+        self.service_name = service_name
+        self.prefix = prefix
+
+    def _sum(self, name, unit, data_points):
+        return {
+            'name': '%s.%s' % (self.prefix, name),
+            'unit': unit,
+            'sum': {
+                'dataPoints': data_points,
+                'aggregationTemporality': OTEL_CUMULATIVE,
+                'isMonotonic': True}}
+
+    def export(self):
+        """Returns the metrics as a map with the OTLP 'resourceMetrics'
+        """
+        start = '%d' % (self.aggregator.start_time * 1e9)
+        now = '%d' % (time.time() * 1e9)
+
+        def point(attributes, value):
+            return {'attributes': attributes,
+                    'startTimeUnixNano': start,
+                    'timeUnixNano': now,
+                    'asInt': '%d' % value}
+
+        metrics = [self._sum('requests', '{request}', [
+            point(_attributes(endpoint=endpoint, method=method,
+                              status=status, error=error), count)
+            for endpoint, method, status, error, count in
+            self.aggregator.outcomes()])]
+
+        series = self.aggregator.series()
+        for field, name, unit in (
+                ('retries', 'request.retries', '{request}'),
+                ('cache_hits', 'cache.hits', '{request}'),
+                ('bytes_sent', 'request.size', 'By'),
+                ('bytes_received', 'response.size', 'By')):
+            metrics.append(self._sum(name, unit, [
+                point(_attributes(endpoint=entry['endpoint'],
+                                  method=entry['method']), entry[field])
+                for entry in series]))
+
+        metrics.append({
+            'name': '%s.request.duration' % self.prefix,
+            'unit': 's',
+            'histogram': {
+                'dataPoints': [{
+                    'attributes': _attributes(endpoint=entry['endpoint'],
+                                              method=entry['method']),
+                    'startTimeUnixNano': start,
+                    'timeUnixNano': now,
+                    'count': '%d' % entry['latency']['count'],
+                    'sum': entry['latency']['sum'],
+                    'bucketCounts': ['%d' % count for count in
+                                     entry['latency']['counts']],
+                    'explicitBounds': list(entry['latency']['bounds'])}
+                    for entry in series],
+                'aggregationTemporality': OTEL_CUMULATIVE}})
+
+        return {'resourceMetrics': [{
+            'resource': {'attributes': _attributes(
+                **{'service.name': self.service_name})},
+            'scopeMetrics': [{
+                'scope': {'name': 'common.metrics'},
+                'metrics': metrics}]}]}
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+import csv
+import io
+import logging
+import os
+import sys
+import urllib
+
+from common.utils import PreSeriesUtils
+
+CSV_EXTENSIONS = ('.csv', '.tsv', '.txt')
+XLSX_EXTENSIONS = ('.xlsx', '.xlsm')
+
+
+def _decode(value):
+    """Returns the text read from a CSV file as unicode
+    """
+    if isinstance(value, bytes):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value.decode('cp1252', 'ignore')
+    return value
+
+
+def _iter_csv_rows(file_name):
+    delimiter = '\t' if file_name.lower().endswith('.tsv') else ','
+    if sys.version_info[0] < 3:
+        csv_file = open(file_name, 'rb')
+    else:
+        csv_file = io.open(file_name, 'r', newline='', encoding='utf-8',
+                           errors='replace')
+    with csv_file:
+        for row in csv.reader(csv_file, delimiter=delimiter):
+            yield [_decode(value) for value in row]
+
+
+def _iter_xlsx_rows(file_name):
+    from openpyxl import load_workbook
+
+    # In read only mode the rows are parsed while they are iterated
+    workbook = load_workbook(file_name, read_only=True, data_only=True)
+    try:
+        first_sheet = workbook.worksheets[0]
+        logging.debug("Sheet name [%s]." % first_sheet.title)
+        for row in first_sheet.iter_rows():
+            yield [cell.value for cell in row]
+    finally:
+        if hasattr(workbook, 'close'):
+            workbook.close()
+
+
+def _iter_xls_rows(file_name):
+    from xlrd import open_workbook
+
+    workbook = open_workbook(file_name, on_demand=True)
+    try:
+        first_sheet = workbook.sheet_by_index(0)
+        logging.debug("Sheet name [%s]." % first_sheet.name)
+        for row in range(first_sheet.nrows):
+            yield first_sheet.row_values(row)
+    finally:
+        workbook.release_resources()
+
+
+def iter_rows(file_name, skip_rows=0):
+    """
+    Iterates over the rows of the first sheet of an Excel file (xls, xlsx)
+    or the rows of a CSV file, reading them as they are consumed.
+
+    :param file_name: the path of the file
+    :param skip_rows: the number of rows to skip at the beginning
+    :return: a generator of tuples (row number, list of cell values). The
+        row number starts with 0 for the first row of the file.
+    """
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension in CSV_EXTENSIONS:
+        rows = _iter_csv_rows(file_name)
+    elif extension in XLSX_EXTENSIONS:
+        rows = _iter_xlsx_rows(file_name)
+    else:
+        rows = _iter_xls_rows(file_name)
+
+    for row, values in enumerate(rows):
+        if row >= skip_rows:
+            yield row, values
+
+
+def _cell_value(values, column):
+    """Returns the value of the cell in the column letter, '' if the row
+    doesn't have it
+    """
+    index = PreSeriesUtils.excel2num(column)
+    if index < len(values) and values[index] is not None:
+        return values[index]
+    return ''
+
+
+def _encode(value):
+    try:
+        return value.encode('cp1252')
+    except UnicodeEncodeError:
+        return value.encode('utf-8')
+
+
+def iter_search_data(file_name, column_id=None, column_name=None,
+                     column_country=None, column_domain=None, skip_rows=0,
+                     summary_columns=None):
+    """
+    This method is responsible for build, row by row, the query parameters
+    that we are going to use to look for the companies in PreSeries
+    informed in an Excel or CSV file.
+
+    The query string will have only the id criteria or the name of the
+     company if the id is not informed. The domain and country_code won't
+     be used in the query, we will use them later for select the best
+     match from all the candidates that matched the query.
+
+    The values of the summary columns are kept in the "summary" parameter,
+    so the output files can be written without reading the file again.
+
+    :return: a generator of tuples with two items, the query string to look
+        in preseries for the company and the map with all the parameters
+        used in the query
+    """
+    for row, values in iter_rows(file_name, skip_rows=skip_rows):
+
+        logging.debug("Processing row: %d" % row)
+
+        query_params = {"row": row}
+        if summary_columns:
+            query_params["summary"] = [
+                _cell_value(values, column) for column in summary_columns]
+
+        if column_id:
+            company_id = _cell_value(values, column_id)
+            query_params["id"] = company_id
+            yield "id=%s" % company_id, query_params
+            continue
+
+        query_string = {}
+
+        if column_name and _cell_value(values, column_name):
+            company_name = _encode(u'%s' % _cell_value(values, column_name))
+
+            query_string['name__icontains'] = company_name
+            query_params["name"] = company_name
+
+        if column_domain:
+            company_domain = PreSeriesUtils.resolve_domain(
+                _cell_value(values, column_domain))
+
+            if company_domain:
+                # We only use the domain after the search to select the
+                # best candidate
+                query_params["domain"] = company_domain
+
+        if column_country and _cell_value(values, column_country):
+            country_code = PreSeriesUtils.resolve_country(
+                _cell_value(values, column_country))
+
+            if country_code:
+                # We only use the country_code after the search to
+                # select the best candidate
+                query_params['country_code'] = country_code
+
+        yield urllib.urlencode(query_string), query_params
+
+
+class SearchDataReader(object):
+    """An iterable over the search data of a file that reads the file again
+    each time it is iterated, so it never holds all the rows in memory.
+
+    It receives the same parameters as iter_search_data.
+    """
+
+    def __init__(self, file_name, **kwargs):
+        self.file_name = file_name
+        self.kwargs = kwargs
+
+    def __iter__(self):
+        return iter_search_data(self.file_name, **self.kwargs)
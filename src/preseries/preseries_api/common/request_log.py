@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import logging
+import random
+import re
+import time
+
+from common.cache import REGEX_MATCHER_URL
+
+LOGGER = logging.getLogger('sky')
+
+# Maximum number of characters of a body written in the log
+DEFAULT_MAX_PAYLOAD = 2000
+
+# Fraction of the requests whose bodies are written in the log, when the
+# DEBUG level is enabled
+DEFAULT_PAYLOAD_SAMPLE_RATE = 1.0
+
+# Level of the lines written for each request and response
+DEFAULT_REQUEST_LEVEL = logging.INFO
+
+# Level of the bodies and headers of the requests and responses
+PAYLOAD_LEVEL = logging.DEBUG
+
+# Banner of the lines of each method
+BANNERS = {
+    'GET': '=========',
+    'POST': '+++++++++',
+    'PUT': '//////////',
+    'DELETE': '-------------'}
+
+REGEX_MATCHER_CREDENTIALS = re.compile(r"(api_key=)[^;&]*")
+
+
+def redact(text):
+    """Returns the text with the api keys it contains replaced by ***
+    """
+    if not isinstance(text, str):
+        text = '%s' % text
+    return REGEX_MATCHER_CREDENTIALS.sub(r"\1***", text)
+
+
+class _Redacted(object):
+    """Formats a text without credentials, only if it is written
+    """
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        return redact(self.text)
+
+
+class _Truncated(object):
+    """Formats a body cut to <limit> characters, only if it is written
+    """
+    __slots__ = ('payload', 'limit')
+
+    def __init__(self, payload, limit):
+        self.payload = payload
+        self.limit = limit
+
+    def __str__(self):
+        payload = self.payload
+        if self.limit:
+            payload = payload[:self.limit + 1]
+        if isinstance(payload, bytes):
+            payload = payload.decode('utf-8', 'replace')
+        payload = redact(payload)
+        if self.limit and len(payload) > self.limit:
+            return '%s... (%d bytes)' % (payload[:self.limit],
+                                         len(self.payload))
+        return payload
+
+
+class RequestLogger(object):
+    """This class writes the requests sent to PreSeries and their responses
+    in the log.
+
+    Nothing is formatted unless the line is written, the api key is never
+    written, and the bodies are only written at the DEBUG level, cut to
+    <max_payload> characters (0 for no limit) and for a <sample_rate>
+    fraction of the requests. The level of the lines of each endpoint can be
+    set in <levels>, ex. {'company_search': logging.DEBUG} to hide the
+    searches unless debugging.
+    """
+
+    def __init__(self, logger=LOGGER, level=DEFAULT_REQUEST_LEVEL,
+                 levels=None, max_payload=DEFAULT_MAX_PAYLOAD,
+                 sample_rate=DEFAULT_PAYLOAD_SAMPLE_RATE):
+        self.logger = logger
+        self.level = level
+        self.levels = dict(levels or {})
+        self.max_payload = max_payload
+        self.sample_rate = sample_rate
+
+    def level_of(self, url):
+        """Returns the level of the lines of the endpoint of the url
+        """
+        if self.levels:
+            matcher = REGEX_MATCHER_URL.match(url)
+            if matcher:
+                return self.levels.get(matcher.group(1), self.level)
+        return self.level
+
+    def payload(self, payload):
+        """Returns the body to be written in a log line, cut to
+        <max_payload> characters when the line is formatted
+        """
+        return _Truncated(payload, self.max_payload)
+
+    def _sampled(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def request(self, method, url, query_string='', body=None,
+                headers=None):
+        """Writes a request about to be sent, and returns the time it is
+        sent to compute the elapsed time of its response
+        """
+        level = self.level_of(url)
+        logger = self.logger
+        if logger.isEnabledFor(level):
+            logger.log(level, "%s PRESERIES.IO REQUEST %s %s %s%s",
+                       BANNERS.get(method, '========='),
+                       BANNERS.get(method, '========='), method,
+                       _Redacted(url), _Redacted(query_string))
+        if logger.isEnabledFor(PAYLOAD_LEVEL) and \
+                (body or headers) and self._sampled():
+            logger.log(PAYLOAD_LEVEL, "%s %s headers: %s body: %s", method,
+                       _Redacted(url), headers, self.payload(body or ''))
+        return time.time()
+
+    def response(self, method, url, start_time, response, content=None):
+        """Writes the response received to a request sent at start_time
+        """
+        level = self.level_of(url)
+        logger = self.logger
+        if logger.isEnabledFor(level):
+            logger.log(level, "%s PRESERIES.IO RESPONSE (%.3f seconds) %s "
+                       "%s %s %s", BANNERS.get(method, '========='),
+                       time.time() - start_time,
+                       BANNERS.get(method, '========='), method,
+                       _Redacted(url), response.get('status'))
+        if logger.isEnabledFor(PAYLOAD_LEVEL) and self._sampled():
+            logger.log(PAYLOAD_LEVEL, "%s %s headers: %s content: %s",
+                       method, _Redacted(url), response,
+                       self.payload(content or ''))
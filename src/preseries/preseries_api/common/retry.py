@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import errno
+import random
+import socket
+import httplib2
+
+# Seconds of the first retry, doubled in each new retry
+DEFAULT_BASE_DELAY = 1.0
+# Maximum seconds between two retries
+DEFAULT_MAX_DELAY = 30.0
+# Maximum seconds spent in a request, including all its retries
+DEFAULT_TOTAL_BUDGET = 300.0
+DEFAULT_MAX_RETRIES = 5
+
+HTTP_TOO_MANY_REQUESTS = 429
+HTTP_INTERNAL_SERVER_ERROR = 500
+HTTP_BAD_GATEWAY = 502
+HTTP_SERVICE_UNAVAILABLE = 503
+HTTP_GATEWAY_TIMEOUT = 504
+
+# Statuses of the transient errors of the server
+RETRYABLE_STATUSES = (
+    HTTP_TOO_MANY_REQUESTS,
+    HTTP_INTERNAL_SERVER_ERROR,
+    HTTP_BAD_GATEWAY,
+    HTTP_SERVICE_UNAVAILABLE,
+    HTTP_GATEWAY_TIMEOUT)
+
+# Statuses that guarantee that the server didn't process the request, so it
+# can be sent again even if it isn't idempotent
+NOT_PROCESSED_STATUSES = (HTTP_TOO_MANY_REQUESTS, HTTP_SERVICE_UNAVAILABLE)
+
+# Methods that can be sent many times with the same effect
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+# Errors raised by the transport when it can't talk to PreSeries
+CONNECTION_ERRORS = (httplib2.HttpLib2Error, socket.error)
+
+
+def is_not_sent_error(error):
+    """Checks if the connection error happened before the request could be
+    sent, like an unknown host or a refused connection
+    """
+    if isinstance(error, httplib2.ServerNotFoundError):
+        return True
+    return isinstance(error, socket.error) and \
+        getattr(error, 'errno', None) in (errno.ECONNREFUSED,)
+
+
+class RetryPolicy(object):
+    """This class encapsulates when and how long to wait before sending
+    again a request to PreSeries that failed.
+
+    It uses exponential backoff with "full jitter": the n-th retry waits a
+    random time between 0 and min(max_delay, base_delay * 2^n), so the
+    workers that failed at the same time don't retry at the same time. No
+    retry is done if it would end after the total_budget of the request.
+
+    Only idempotent methods are retried after a connection error or a 5xx
+    status. A POST is only retried if the server didn't process it (429,
+    503, refused connection, unknown host), unless retry_post is True.
+    """
+
+    def __init__(self, max_retries=DEFAULT_MAX_RETRIES,
+                 base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY,
+                 total_budget=DEFAULT_TOTAL_BUDGET, jitter=True,
+                 retry_statuses=RETRYABLE_STATUSES, retry_post=False,
+                 connection_errors=CONNECTION_ERRORS):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.total_budget = total_budget
+        self.jitter = jitter
+        self.retry_statuses = retry_statuses
+        self.retry_post = retry_post
+        self.connection_errors = connection_errors
+
+    def backoff(self, retries):
+        """Returns the seconds to wait before the retry number <retries>,
+        starting in 1
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (retries - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def is_retryable(self, method, status=None, error=None):
+        """Checks if a request that got the status, or raised the error, can
+        be sent again
+        """
+        idempotent = method.upper() in IDEMPOTENT_METHODS or self.retry_post
+
+        if error is not None:
+            return isinstance(error, self.connection_errors) and (
+                idempotent or is_not_sent_error(error))
+
+        return status in self.retry_statuses and (
+            idempotent or status in NOT_PROCESSED_STATUSES)
+
+    def next_delay(self, method, retries, elapsed, status=None, error=None,
+                   min_delay=0):
+        """
+        Decides if a failed request must be sent again
+
+        :param method: the HTTP method of the request
+        :param retries: the number of retries already done
+        :param elapsed: the seconds since the first attempt
+        :param status: the status of the response, if any
+        :param error: the exception raised, if any
+        :param min_delay: the minimum seconds to wait, ex. asked by the server
+        :return: the seconds to wait before the retry, None if the request
+            must not be retried
+        """
+        if retries >= self.max_retries or \
+                not self.is_retryable(method, status=status, error=error):
+            return None
+
+        delay = max(min_delay, self.backoff(retries + 1))
+        if elapsed + delay > self.total_budget:
+            return None
+
+        return delay
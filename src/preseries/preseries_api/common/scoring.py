@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import logging
+from Levenshtein import jaro_winkler
+
+# Weight of each field of the company when we compare the values we are
+# looking for with the values of the candidates. The fields not informed
+# here are not used in the comparison.
+DEFAULT_FIELD_WEIGHTS = {
+    'name': 1.0,
+    'domain': 1.0,
+    'country_code': 1.0
+}
+
+
+def _to_text(value):
+    """Returns the value as unicode text to compare it with Jaro-Winkler
+    """
+    if isinstance(value, bytes):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value.decode('cp1252', 'ignore')
+    return u'%s' % value
+
+
+class CandidateScorer(object):
+    """This class encapsulates the logic to select, from all the companies
+    returned by a search, the candidate that better matches the values we
+    are looking for.
+
+    The score of a candidate is the weighted average of the Jaro-Winkler
+    similarity between each value we are looking for and the value of the
+    candidate for the same field. A field that the candidate doesn't have
+    counts as 0.
+    """
+
+    def __init__(self, weights=None):
+        """
+        :param weights: map with the weight of each field, by default
+            DEFAULT_FIELD_WEIGHTS
+        """
+        self.weights = dict(DEFAULT_FIELD_WEIGHTS if weights is None
+                            else weights)
+
+    def score(self, query_params, candidates):
+        """
+        Scores all the candidates in one pass and selects the best one
+
+        :param query_params: the values to check
+        :param candidates: all the companies that matched with the
+                previous params
+        :return: a tuple (candidate, score, margin) with the best candidate,
+            its score and the difference with the score of the second best
+            candidate. (None, 0.0, 0.0) if there are no candidates.
+        """
+
+        # The values we are looking for are converted only once per row
+        fields = [(field, _to_text(value), self.weights[field])
+                  for field, value in query_params.items()
+                  if value and self.weights.get(field)]
+        total_weight = float(sum(weight for _, _, weight in fields)) or 1.0
+
+        best_candidate = None
+        best_score = second_score = None
+
+        for index, candidate in enumerate(candidates):
+            score = 0.0
+            for field, expected_value, weight in fields:
+                value = candidate.get(field)
+                if value:
+                    score += weight * jaro_winkler(
+                        expected_value, _to_text(value))
+            score /= total_weight
+
+            logging.debug("Candidate #%d (%f): %s", index, score, candidate)
+
+            # With the same score, the last candidate wins
+            if best_score is None or score >= best_score:
+                second_score = best_score
+                best_candidate, best_score = candidate, score
+            elif second_score is None or score > second_score:
+                second_score = score
+
+        if best_candidate is None:
+            return None, 0.0, 0.0
+
+        return best_candidate, best_score, \
+            best_score - (second_score if second_score is not None else 0.0)
+
+
+DEFAULT_SCORER = CandidateScorer()
@@ -1,33 +1,27 @@
-import csv
-import os
 import re
 import logging
-import urllib
-from Levenshtein import jaro_winkler
-from xlrd import open_workbook
+import threading
+from multiprocessing.pool import ThreadPool
 
-from common.api import PreSeriesAPI
+from common.api import get_default_api
 from common.utils import PreSeriesUtils
+from common.memo import LRUMemo, DEFAULT_MEMO_SIZE
+from common.scoring import DEFAULT_SCORER
+from common.readers import SearchDataReader
+from common.checkpoint import SEARCH_CHECKPOINT
 
 REGEX_MATCHER_UUID = re.compile(r"[a-zA-Z0-9_]{24}")
 REGEX_MATCHER_DOMAIN = re.compile(r"(.*://)?(?:www\.)?(.[^/]+).*")
+REGEX_MATCHER_SPACES = re.compile(r"(?:\+|%20)+")
 
-COUNTRIES_NAME = []
-COUNTRIES_2LETTER_CODE = []
-COUNTRIES_3LETTER_CODE = []
+# Query params compared ignoring the case by PreSeries
+CASE_INSENSITIVE_LOOKUPS = ('__icontains', '__iexact', '__istartswith')
 
-script_path = os.path.dirname(os.path.abspath(__file__))
+# Number of search requests in flight when the caller doesn't say otherwise
+DEFAULT_CONCURRENCY = 1
 
-# Loading the Country ISO codes
-with open('%s/countries.csv' % script_path, 'rb') as f:
-    reader = csv.reader(f, delimiter='\t')
-    for country in reader:
-        COUNTRIES_NAME.append(country[0].lower())
-        COUNTRIES_2LETTER_CODE.append(country[1].lower())
-        COUNTRIES_3LETTER_CODE.append(country[2].lower())
-
-
-DEFAULT_API = PreSeriesAPI()
+# Rows read in advance by each search request in flight
+SEARCH_WINDOW_FACTOR = 4
 
 
 class PreSeriesSearcher(object):
@@ -35,134 +29,171 @@ class PreSeriesSearcher(object):
     based on some basic information about them
     """
 
-    def __init__(self, preseries_api=DEFAULT_API):
-        self.api = preseries_api
+    def __init__(self, preseries_api=None, memo_size=DEFAULT_MEMO_SIZE,
+                 scorer=DEFAULT_SCORER):
+        """
+        :param preseries_api: the PreSeriesAPI used to look for the companies,
+            by default the one shared by the process (get_default_api)
+        :param memo_size: the number of search responses kept in memory to
+            be reused by the rows with the same query. 0 to disable it.
+        :param scorer: the CandidateScorer used to select the best candidate
+            when a search returns more than one company
+        """
+        self.api = preseries_api if preseries_api is not None \
+            else get_default_api()
         self.companies_query = []
+        self.memo = LRUMemo(memo_size) if memo_size else None
+        self.scorer = scorer
 
     @staticmethod
-    def select_best_company(query_params, candidates):
+    def memo_key(query_string):
         """
-        We are going to calculate the avg distance between the expected value
-         for each parameter (name, domain) and the values of the candidates
-         for them
+        Builds the key used to memoize the response of a search. Queries
+        that only differ in the order of the params, the case of the case
+        insensitive lookups or the whitespaces share the same key.
 
-        :param query_params: the values to check
-        :param candidates: all the companies that matched with the
-                previous params
-        :return: the selected candidate that better match
+        :param query_string: the url encoded query string of the search
+        :return: the key of the search
         """
+        params = []
+        for param in query_string.split('&'):
+            if not param:
+                continue
+            name, _, value = param.partition('=')
+            if name.endswith(CASE_INSENSITIVE_LOOKUPS):
+                value = REGEX_MATCHER_SPACES.sub('+', value).strip('+').lower()
+            params.append('%s=%s' % (name, value))
 
-        logging.debug("Looking for the best match...")
-
-        # All the distances for each param for each candidate
-        ratios = []
+        return '&'.join(sorted(params))
 
-        for index, candidate in enumerate(candidates):
-            logging.debug("Candidate #%d: %s" % (index, candidate))
-            candidate_ratios = []
-            for param_name, param_value in query_params.iteritems():
-                if param_name in candidate and candidate[param_name]:
-                    candidate_ratios.append(
-                        jaro_winkler(
-                            str(param_value),
-                            str(candidate[param_name].encode('utf-8'))))
+    def _search(self, query):
+        """Sends the search query to PreSeries, reusing the response of a
+        previous identical search if it is in the memo
+        """
+        if self.memo is None:
+            return self.api.search_companies(query_string=query)
 
-            # Calculate the distance ratio as the AVG between all the computed
-            # ratios for the candidate
-            ratios.append(
-                (float(sum(candidate_ratios)) / (len(query_params) - 1),
-                 candidate))
+        return self.memo.get_or_compute(
+            self.memo_key(query),
+            lambda: self.api.search_companies(query_string=query))
 
-        # The best match first
-        ratios = reversed(sorted(ratios, key=lambda x: x[0]))
+    @staticmethod
+    def select_best_company(query_params, candidates, scorer=DEFAULT_SCORER):
+        """
+        Selects from all the candidates the company that better matches the
+        values we are looking for. See PreSeriesUtils.select_best_company
 
-        # Return the select candidate being the best match
-        return ratios.next()[1]
+        :param query_params: the values to check
+        :param candidates: all the companies that matched with the
+                previous params
+        :param scorer: the CandidateScorer with the weights of each field
+        :return: the selected candidate that better match
+        """
+        return PreSeriesUtils.select_best_company(
+            query_params, candidates, scorer=scorer)
 
     def read_search_data_from_excel(
             self, file_name, column_id=None, column_name=None,
-            column_country=None, column_domain=None, skip_rows=False):
+            column_country=None, column_domain=None, skip_rows=False,
+            summary_columns=None):
         """
-        This method is responsible for extract from an Excel file all the
-        companies we will need to find in PreSeries.
+        This method is responsible for prepare the extraction from an Excel
+        (xls, xlsx) or CSV file of all the companies we will need to find in
+        PreSeries.
 
-        for build the query parameters that
-        we are going to use to look for the companies in PreSeries informed
-        in an Excel file.
+        The rows are not read here, they are read one by one while the
+        companies are searched, so the first search is sent as soon as the
+        first row is read and the file is never fully loaded in memory.
 
         The query string will have only the id criteria or the name of the
          company if the id is not informed. The domain and country_code won't
          be used in the query, we will use them later for select the best
          match from all the candidates that matched the query.
 
-        :return: a list where each row is one company which contains a tuple
-            with two items, the query string to look in preseries for the
-            company and the map with all the parameters used in the query
+        See common.readers.iter_search_data
         """
+        self.companies_query = SearchDataReader(
+            file_name, column_id=column_id, column_name=column_name,
+            column_country=column_country, column_domain=column_domain,
+            skip_rows=skip_rows, summary_columns=summary_columns)
 
-        logging.debug("Looking for the first sheet in the Excel.")
-        wb = open_workbook(file_name)
-        first_sheet = wb.sheets()[0]
-        logging.debug("Sheet name [%s]." % first_sheet.name)
+    def find_company(self, query_string, company_details):
+        """
+        Look for one single company in PreSeries and selects the best
+        candidate.
+
+        :param query_string: the query string to do the REST query
+        :param company_details: the map with all the field-values of the
+            company we want to look for in PreSeries.
+        :return: the company of PreSeries selected, None if there was no
+            company matching the query
+        """
+        # We download a maximum of 100 companies from the total that
+        # matches the search criteria (limit=100)
+        query = "limit=100&%s" % query_string
+        logging.debug("Query: %s" % query)
 
-        self.companies_query = []
-        for row in range(skip_rows, first_sheet.nrows):
+        resp = self._search(query)
 
-            logging.debug("Processing row: %d" % row)
+        # We get multiple companies as a response.
+        if resp['meta']['total_count'] > 1:
+            best_candidate, score, margin = PreSeriesUtils.rank_candidates(
+                company_details, resp['objects'], scorer=self.scorer)
 
-            if column_id:
-                company_id = first_sheet.cell_value(
-                    row, PreSeriesUtils.excel2num(column_id))
-                self.companies_query.append((
-                    "id=%s" % company_id, {"row": row, "id": company_id}))
-                continue
+            logging.warn("More than one match!\n"
+                         "Params: %s \n"
+                         "Selected candidate (score %.3f, margin %.3f): %s" %
+                         (company_details, score, margin, best_candidate))
+
+            return best_candidate
+
+        elif resp['meta']['total_count'] == 0:
+            logging.warn("Unknown company: %s" % company_details)
+            return None
+
+        return resp["objects"][0]
+
+    def search_company(self, query_string, company_details, checkpoint=None):
+        """
+        Look for one single company in PreSeries.
+
+        :param query_string: the query string to do the REST query
+        :param company_details: the map with all the field-values of the
+            company we want to look for in PreSeries.
+        :param checkpoint: the CheckpointJournal where the result of the
+            search is recorded. If the search was already recorded it isn't
+            sent again.
+        :return: a tuple (found, company) where found is True if the company
+            was found in PreSeries. In that case company is the data of the
+            selected candidate, otherwise it is the company_details informed.
+        """
+        if checkpoint is None:
+            company = self.find_company(query_string, company_details)
+        else:
+            key = '%s:%s' % (company_details.get('row'), query_string)
+            if checkpoint.has(SEARCH_CHECKPOINT, key):
+                company = checkpoint.get(SEARCH_CHECKPOINT, key)
+            else:
+                company = self.find_company(query_string, company_details)
+                checkpoint.record(SEARCH_CHECKPOINT, key, company)
 
-            query_string = {}
-            query_params = {"row": row}
-
-            if column_name and \
-                    first_sheet.cell_value(
-                        row, PreSeriesUtils.excel2num(column_name)):
-
-                try:
-                    company_name = first_sheet.cell_value(
-                        row,
-                        PreSeriesUtils.excel2num(column_name)).encode('cp1252')
-                except UnicodeEncodeError:
-                    company_name = first_sheet.cell_value(
-                        row,
-                        PreSeriesUtils.excel2num(column_name)).encode('utf-8')
-                    pass
-
-                query_string['name__icontains'] = company_name
-                query_params["name"] = company_name
-
-            if column_domain:
-                company_domain = PreSeriesUtils.resolve_domain(
-                    first_sheet.cell_value(
-                        row, PreSeriesUtils.excel2num(column_domain)))
-
-                if company_domain:
-                    # We only use the domain after the search to select the
-                    # best candidate
-                    query_params["domain"] = company_domain
-
-            if column_country and \
-                    first_sheet.cell_value(
-                        row, PreSeriesUtils.excel2num(column_country)):
-                country_code = PreSeriesUtils.resolve_country(
-                    first_sheet.cell_value(
-                        row, PreSeriesUtils.excel2num(column_country)))
-
-                if country_code:
-                    # We only use the country_code after the search to
-                    # select the best candidate
-                    query_params['country_code'] = country_code
-
-            self.companies_query.append(
-                (urllib.urlencode(query_string), query_params))
-
-    def search_companies(self):
+        if company is None:
+            return False, company_details
+        return True, self._company_data(company_details, company)
+
+    @staticmethod
+    def _company_data(company_details, company):
+        """Builds the data of a company found in PreSeries, with the row and
+        the summary values of the original file
+        """
+        company_data = {"row": company_details["row"]}
+        if "summary" in company_details:
+            company_data["summary"] = company_details["summary"]
+        company_data.update(company)
+        return PreSeriesUtils.encoding_conversion(company_data)
+
+    def search_companies(self, concurrency=DEFAULT_CONCURRENCY,
+                         checkpoint=None):
         """
         We are going to get all the Companies from PreSeries using the search
         url calculated for each Company.
@@ -190,43 +221,56 @@ class PreSeriesSearcher(object):
         (country_code, domain, etc) to decide which company is more likely to
         be the company we are looking for.
 
+        When concurrency is greater than 1 the searches are sent from a pool
+        of threads, with up to <concurrency> requests in flight. The results
+        are always returned in the same order of the rows in companies_query.
+
+        :param concurrency: the maximum number of search requests in flight
+        :param checkpoint: the CheckpointJournal where each completed search
+            is recorded. The searches already recorded are not sent again.
         :return: the companies found and the ones that were not found
         """
         found_companies = []
         unknown_companies = []
 
-        for query_string, company_details in self.companies_query:
-            # We download a maximum of 100 companies from the total that
-            # matches the search criteria (limit=100)
-            query = "limit=100&%s" % query_string
-            logging.debug("Query: %s" % query)
-
-            resp = self.api.search_companies(query_string=query)
-
-            # We get multiple companies as a response.
-            if resp['meta']['total_count'] > 1:
-                best_candidate = PreSeriesUtils.select_best_company(
-                    company_details, resp['objects'])
-
-                logging.warn("More than one match!\n"
-                             "Params: %s \n"
-                             "Selected candidate: %s" %
-                             (company_details, best_candidate))
-
-                company_data = {"row": company_details["row"]}
-                company_data.update(best_candidate)
-
-                found_companies.append(
-                    PreSeriesUtils.encoding_conversion(company_data))
-
-            elif resp['meta']['total_count'] == 0:
-                logging.warn("Unknown company: %s" % company_details)
-                unknown_companies.append(company_details)
-
-            else:
-                company_data = {"row": company_details["row"]}
-                company_data.update(resp["objects"][0])
-                found_companies.append(
-                    PreSeriesUtils.encoding_conversion(company_data))
+        def search(query):
+            query_string, company_details = query
+            return self.search_company(query_string, company_details,
+                                       checkpoint=checkpoint)
+
+        # Maximum number of rows read and not yet consumed, to keep the
+        # memory flat with huge files
+        window = threading.Semaphore(concurrency * SEARCH_WINDOW_FACTOR)
+        stopped = threading.Event()
+
+        def read_queries():
+            for query in self.companies_query:
+                window.acquire()
+                if stopped.is_set():
+                    return
+                yield query
+
+        pool = None
+        if concurrency > 1:
+            pool = ThreadPool(concurrency)
+            # imap keeps the results in the same order of the queries
+            results = pool.imap(search, read_queries())
+        else:
+            results = (search(query) for query in read_queries())
+
+        try:
+            for found, company in results:
+                window.release()
+                if found:
+                    found_companies.append(company)
+                else:
+                    unknown_companies.append(company)
+        finally:
+            if pool:
+                # Unblock the reading of the rows if we stopped before the end
+                stopped.set()
+                window.release()
+                pool.close()
+                pool.join()
 
         return found_companies, unknown_companies
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+
+from common.utils import PreSeriesUtils
+
+LOGGER = logging.getLogger('sky')
+
+# Field of the company data that changes each time PreSeries updates it
+SNAPSHOT_VERSION_FIELD = 'updated_on'
+
+
+def snapshot_version(resource, field=SNAPSHOT_VERSION_FIELD):
+    """
+    Returns the version of the data of a company, its <field> or the hash of
+    all its values if it doesn't have the field
+
+    :param resource: the data of the company
+    :return: the version, as text
+    """
+    value = resource.get(field)
+    if value:
+        return '%s' % value
+    return hashlib.sha1(
+        json.dumps(resource, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class SnapshotStore(object):
+    """This class keeps, between executions, the last details downloaded of
+    each company with the version of its data when they were downloaded, so
+    the details are only downloaded again when the version changes. The
+    competitors and the similar companies downloaded with them are kept
+    too.
+
+    The snapshots are kept in a JSON lines file, one company per line, that
+    is rewritten by save().
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._snapshots = {}
+
+        if os.path.exists(file_name):
+            with open(file_name) as snapshots_file:
+                for line in snapshots_file:
+                    try:
+                        snapshot = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._snapshots[snapshot['id']] = snapshot
+            LOGGER.info("Snapshots %s: %d companies loaded", file_name,
+                        len(self._snapshots))
+
+    def __len__(self):
+        return len(self._snapshots)
+
+    def __contains__(self, company_id):
+        return self.get(company_id) is not None
+
+    def _snapshot(self, company_id):
+        company_id = '%s' % company_id
+        if company_id not in self._snapshots:
+            self._snapshots[company_id] = {'id': company_id}
+        return self._snapshots[company_id]
+
+    def version(self, company_id):
+        """Returns the version of the details kept of the company, None if
+        there are none
+        """
+        return self._snapshots.get('%s' % company_id, {}).get('version')
+
+    def get(self, company_id):
+        """Returns the details kept of the company, None if there are none
+        """
+        return self._snapshots.get('%s' % company_id, {}).get('details')
+
+    def put(self, company_id, version, details):
+        """Keeps the details of the company downloaded with the version
+        """
+        snapshot = self._snapshot(company_id)
+        snapshot['version'] = version
+        snapshot['details'] = details
+
+    def get_related(self, company_id, kind):
+        """Returns the list of related companies of the <kind> kept of the
+        company, 'competitors' or 'similar', None if there are none
+        """
+        return self._snapshots.get('%s' % company_id, {}).get(kind)
+
+    def put_related(self, company_id, kind, resources):
+        """Keeps the list of related companies of the <kind> of the company,
+        'competitors' or 'similar'
+        """
+        self._snapshot(company_id)[kind] = resources
+
+    def save(self):
+        """Writes all the snapshots to the file
+        """
+        tmp_path = '%s.tmp' % self.file_name
+        with open(tmp_path, 'w') as snapshots_file:
+            for snapshot in self._snapshots.values():
+                snapshots_file.write(json.dumps(snapshot) + '\n')
+        PreSeriesUtils.replace_file(tmp_path, self.file_name)
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+import logging
+from multiprocessing.pool import ThreadPool
+
+LOGGER = logging.getLogger('sky')
+
+# Number of requests sent at the same time while applying the changes
+DEFAULT_SYNC_CONCURRENCY = 8
+
+# Number of changes from which the companies of a portfolio are replaced with
+# one update_portfolio request instead of one request per company
+DEFAULT_BULK_THRESHOLD = 20
+
+# Maximum number of companies sent in the body of one update_portfolio
+DEFAULT_MAX_BULK_SIZE = 5000
+
+# Filter of the portfolio_company endpoint to get the companies of a portfolio
+PORTFOLIO_COMPANIES_FILTER = 'portfolio_id=%s'
+
+
+def unique_ids(ids):
+    """Returns the ids as text, without duplicates and in the same order
+    """
+    seen = set()
+    unique = []
+    for item in ids:
+        item = '%s' % item
+        if item not in seen:
+            seen.add(item)
+            unique.append(item)
+    return unique
+
+
+def diff_ids(current_ids, desired_ids):
+    """
+    Compares the ids we have with the ids we want to have
+
+    :param current_ids: the ids we have now
+    :param desired_ids: the ids we want to have
+    :return: a tuple (to_add, to_remove, unchanged) with the ids to add, in
+        the order of desired_ids, the ids to remove and the number of ids
+        that are already in place
+    """
+    current = set(unique_ids(current_ids))
+    desired = unique_ids(desired_ids)
+    desired_set = set(desired)
+
+    to_add = [item for item in desired if item not in current]
+    to_remove = sorted(current - desired_set)
+    return to_add, to_remove, len(current & desired_set)
+
+
+def apply_all(operation, items, concurrency=DEFAULT_SYNC_CONCURRENCY):
+    """
+    Applies an operation of the API to all the items from a pool of threads
+
+    :param operation: the function called with each item. It must return
+        the structure returned by the API verbs, with the 'error' field.
+    :param items: the items
+    :param concurrency: the maximum number of operations in flight
+    :return: the list of tuples (item, response), in the order of items
+    """
+    def run(item):
+        return item, operation(item)
+
+    if concurrency > 1 and len(items) > 1:
+        pool = ThreadPool(min(concurrency, len(items)))
+        try:
+            return pool.map(run, items)
+        finally:
+            pool.close()
+            pool.join()
+    return [run(item) for item in items]
+
+
+def get_portfolio_company_ids(api, portfolio):
+    """
+    Returns the ids of all the companies in a portfolio
+
+    :param api: the PreSeriesAPI
+    :param portfolio: the id of the portfolio
+    :return: the list of company ids, as text
+    """
+    return ['%s' % resource['company_id']
+            for resource in api.iter_portfolio_companies(
+                PORTFOLIO_COMPANIES_FILTER % portfolio)]
+
+
+def sync_portfolio(api, portfolio, company_ids,
+                   concurrency=DEFAULT_SYNC_CONCURRENCY,
+                   bulk_threshold=DEFAULT_BULK_THRESHOLD,
+                   max_bulk_size=DEFAULT_MAX_BULK_SIZE):
+    """
+    Makes the companies of a portfolio be exactly company_ids.
+
+    The current companies are read page by page and compared with the
+    desired ones, so only the differences are sent. With <bulk_threshold>
+    changes or more, the companies are replaced with one update_portfolio
+    request, if there are no more than <max_bulk_size>. Otherwise, or if the
+    update fails, the companies are added and removed one by one from a pool
+    of <concurrency> threads.
+
+    :param api: the PreSeriesAPI
+    :param portfolio: the id of the portfolio
+    :param company_ids: the ids of the companies the portfolio must have
+    :return: a map with the ids 'added' and 'removed', the number of
+        companies 'unchanged', the map of 'errors' with the response of each
+        id that couldn't be added or removed, and 'bulk', True if the
+        changes were sent in one request. A PreSeriesAPIError is raised if
+        the current companies can't be read.
+    """
+    desired_ids = unique_ids(company_ids)
+    to_add, to_remove, unchanged = diff_ids(
+        get_portfolio_company_ids(api, portfolio), desired_ids)
+
+    result = {
+        'added': [],
+        'removed': [],
+        'unchanged': unchanged,
+        'errors': {},
+        'bulk': False}
+
+    LOGGER.info("Portfolio [%s]: %d companies to add, %d to remove, %d "
+                "unchanged", portfolio, len(to_add), len(to_remove),
+                unchanged)
+
+    if not to_add and not to_remove:
+        return result
+
+    if len(to_add) + len(to_remove) >= bulk_threshold and \
+            len(desired_ids) <= max_bulk_size:
+        response = api.update_portfolio(portfolio,
+                                        {'companies': desired_ids})
+        # Any 2xx means PreSeries applied the update, even if its body
+        # couldn't be read
+        if not response['error'] or 200 <= response['code'] < 300:
+            result.update(added=to_add, removed=to_remove, bulk=True)
+            return result
+        LOGGER.warning("Portfolio [%s]: the bulk update failed, changing "
+                       "the companies one by one. %s", portfolio,
+                       response['error'])
+
+    def change(task):
+        add, company_id = task
+        if add:
+            return api.portfolio_add_company(portfolio, company_id)
+        return api.portfolio_remove_company(portfolio, company_id)
+
+    tasks = [(True, company_id) for company_id in to_add] + \
+        [(False, company_id) for company_id in to_remove]
+
+    for (add, company_id), response in apply_all(change, tasks, concurrency):
+        if response['error']:
+            result['errors'][company_id] = response
+        else:
+            result['added' if add else 'removed'].append(company_id)
+
+    return result
+
+
+def _desired_companies(companies):
+    """Returns the map of company id (as text) to company name of the
+    companies, given as a map or as a list of companies with 'id' and 'name'
+    """
+    if isinstance(companies, dict):
+        items = companies.items()
+    else:
+        items = [(company['id'], company.get('name', ''))
+                 for company in companies]
+    return dict(('%s' % company_id, name) for company_id, name in items)
+
+
+def _reconcile(resources, companies, create, delete, concurrency, remove):
+    """
+    Makes the companies of a list (starred, followed) be exactly the
+    desired companies
+
+    :param resources: the iterator over the current resources of the list
+    :param companies: the desired companies, see _desired_companies
+    :param create: the function that adds a company, called with its id and
+        its name
+    :param delete: the function that removes a resource, called with its id
+    :param concurrency: the maximum number of requests in flight
+    :param remove: False to keep the companies that are not desired
+    :return: the map returned by sync_starred
+    """
+    desired = _desired_companies(companies)
+
+    # The id of the resource of each company, needed to remove it
+    current = {}
+    for resource in resources:
+        current.setdefault('%s' % resource['company_id'], resource['id'])
+
+    to_add, to_remove, unchanged = diff_ids(current, desired)
+    if not remove:
+        to_remove = []
+
+    tasks = [(True, company_id) for company_id in to_add] + \
+        [(False, company_id) for company_id in to_remove]
+
+    def change(task):
+        add, company_id = task
+        if add:
+            return create(company_id, desired[company_id])
+        return delete(current[company_id])
+
+    result = {
+        'added': [],
+        'removed': [],
+        'unchanged': unchanged,
+        'errors': {},
+        'results': []}
+
+    for (add, company_id), response in apply_all(change, tasks, concurrency):
+        result['results'].append({
+            'company_id': company_id,
+            'action': 'add' if add else 'remove',
+            'code': response['code'],
+            'error': response['error']})
+        if response['error']:
+            result['errors'][company_id] = response
+        else:
+            result['added' if add else 'removed'].append(company_id)
+
+    return result
+
+
+def sync_starred(api, companies, concurrency=DEFAULT_SYNC_CONCURRENCY,
+                 remove=True):
+    """
+    Makes the starred companies of the user be exactly the given companies.
+
+    The current starred companies are read page by page and compared with
+    the desired ones, and the differences are applied from a pool of
+    <concurrency> threads.
+
+    :param api: the PreSeriesAPI
+    :param companies: the desired companies, a map of company id to company
+        name or a list of companies with their 'id' and 'name'
+    :param concurrency: the maximum number of requests in flight
+    :param remove: False to only add the missing companies
+    :return: a map with the ids 'added' and 'removed', the number of
+        companies 'unchanged', the map of 'errors' with the response of each
+        id that couldn't be changed, and the list of 'results' with the
+        company_id, action, code and error of each change. A
+        PreSeriesAPIError is raised if the current companies can't be read.
+    """
+    result = _reconcile(
+        api.iter_starred_companies(), companies, api.create_starred,
+        api.delete_starred, concurrency, remove)
+    LOGGER.info("Starred companies: %d added, %d removed, %d unchanged, "
+                "%d errors", len(result['added']), len(result['removed']),
+                result['unchanged'], len(result['errors']))
+    return result
+
+
+def sync_followed(api, companies, concurrency=DEFAULT_SYNC_CONCURRENCY,
+                  remove=True):
+    """
+    Makes the followed companies of the user be exactly the given companies.
+
+    It works as sync_starred and returns the same structure.
+    """
+    result = _reconcile(
+        api.iter_followed_companies(), companies, api.create_followed,
+        api.delete_followed, concurrency, remove)
+    LOGGER.info("Followed companies: %d added, %d removed, %d unchanged, "
+                "%d errors", len(result['added']), len(result['removed']),
+                result['unchanged'], len(result['errors']))
+    return result
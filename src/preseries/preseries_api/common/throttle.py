@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import email.utils
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger('sky')
+
+HTTP_TOO_MANY_REQUESTS = 429
+
+# Requests per second allowed by default
+DEFAULT_RATE = 10.0
+# Minimum requests per second after the rate has been reduced
+DEFAULT_MIN_RATE = 0.5
+# Factor applied to the rate each time PreSeries throttles a request
+DEFAULT_DECREASE_FACTOR = 0.5
+# Fraction of the maximum rate recovered after each successful request
+DEFAULT_RECOVERY = 0.01
+
+
+def parse_retry_after(value):
+    """
+    Parses the value of a Retry-After header
+
+    :param value: the number of seconds or the HTTP date to wait until
+    :return: the seconds to wait, None if the value isn't valid
+    """
+    if not value:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+
+class RateLimiter(object):
+    """This class encapsulates a token bucket that limits the rate of the
+    requests sent to PreSeries by all the threads or tasks that share it.
+
+    The bucket holds up to <burst> tokens and is refilled at <rate> tokens
+    per second. Every request takes a token, waiting if there are none.
+
+    The rate adapts to the server: each throttled request (429) multiplies it
+    by <decrease_factor>, a number between 0 and 1 (0.5 halves it), down to
+    <min_rate>, and stops all the requests during the Retry-After time; each
+    successful request recovers a fraction of the maximum rate.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=None,
+                 min_rate=DEFAULT_MIN_RATE,
+                 decrease_factor=DEFAULT_DECREASE_FACTOR,
+                 recovery=DEFAULT_RECOVERY):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst or max(1.0, rate))
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.decrease_factor = decrease_factor
+        self.recovery = recovery
+
+        self.requests = 0
+        self.throttled = 0
+        self.wait_time = 0.0
+
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._blocked_until = 0.0
+
+    def reserve(self):
+        """
+        Takes a token from the bucket, borrowing it if there are none
+
+        :return: the seconds the caller must wait before sending its request
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(
+                self.burst,
+                self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            wait = max(wait, self._blocked_until - now)
+
+            self.requests += 1
+            self.wait_time += wait
+            return wait
+
+    def acquire(self):
+        """Waits until the request can be sent
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_throttle(self, retry_after=None):
+        """Reduces the rate after PreSeries throttled a request
+
+        :param retry_after: the seconds PreSeries asked to wait, if any
+        """
+        with self._lock:
+            self.throttled += 1
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self._tokens = min(self._tokens, 0.0)
+            if retry_after:
+                self._blocked_until = max(
+                    self._blocked_until, time.time() + retry_after)
+            LOGGER.warning("Throttled by PRESERIES.IO, rate reduced to %.2f "
+                           "requests per second", self.rate)
+
+    def on_success(self):
+        """Recovers part of the rate after a successful request
+        """
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(
+                    self.max_rate, self.rate + self.max_rate * self.recovery)
+
+    def stats(self):
+        """Returns the usage statistics of the limiter
+
+        :return: a map with the current and maximum rate, the requests sent,
+            the requests throttled by the server and the time waited
+        """
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'max_rate': self.max_rate,
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'wait_time': self.wait_time}
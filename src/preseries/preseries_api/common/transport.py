@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+import httplib2
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+LOGGER = logging.getLogger('sky')
+
+DEFAULT_MAX_CONNECTIONS = 10
+DEFAULT_TIMEOUT = 180  # seconds
+
+
+class PoolTimeoutError(httplib2.HttpLib2Error):
+    """Raised when there is no free connection after waiting block_timeout
+    seconds for it
+    """
+    pass
+
+
+class PooledTransport(object):
+    """This class encapsulates a bounded pool of keep-alive connections to
+    PreSeries that can be shared by many threads.
+
+    Each connection of the pool is an httplib2.Http object. These objects are
+    not thread-safe, so every request takes one of them out of the pool and
+    gives it back when the response has been read. httplib2 keeps the
+    underlying sockets open between requests, so reusing the same objects we
+    avoid the TCP/TLS handshakes in each request.
+
+    Any other object with a compatible `request` method can be used as
+    transport by PreSeriesAPI.
+    """
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, cache=None,
+                 timeout=DEFAULT_TIMEOUT, block_timeout=None):
+        """
+        :param max_connections: the maximum number of connections to open
+        :param cache: the directory used by httplib2 to cache the responses,
+            None for no cache.
+        :param timeout: the socket timeout of each connection
+        :param block_timeout: the maximum number of seconds to wait for a
+            free connection. None to wait forever.
+        """
+        self.max_connections = max_connections
+        self.cache = cache
+        self.timeout = timeout
+        self.block_timeout = block_timeout
+
+        # LIFO, the last connection used is the one most likely still alive
+        self._pool = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+        self._created = 0
+        self._requests = 0
+        self._reused = 0
+        self._waits = 0
+        self._wait_time = 0.0
+
+    def _new_connection(self):
+        http = httplib2.Http(self.cache, timeout=self.timeout)
+        # Number of requests done with this connection
+        http.preseries_requests = 0
+        return http
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.max_connections:
+                self._created += 1
+                return self._new_connection()
+            self._waits += 1
+
+        start_time = time.time()
+        try:
+            return self._pool.get(timeout=self.block_timeout)
+        except queue.Empty:
+            raise PoolTimeoutError(
+                "No free connection after %s seconds" % self.block_timeout)
+        finally:
+            with self._lock:
+                self._wait_time += time.time() - start_time
+
+    def _release(self, http):
+        self._pool.put(http)
+
+    def request(self, uri, method='GET', body=None, headers=None):
+        """Sends a request using one of the connections of the pool
+
+        :return: a tuple (response, content) as httplib2.Http.request
+        """
+        http = self._acquire()
+        try:
+            with self._lock:
+                self._requests += 1
+                if http.preseries_requests > 0:
+                    self._reused += 1
+            http.preseries_requests += 1
+            return http.request(uri, method, body=body, headers=headers)
+        except Exception:
+            # We don't know the state of the sockets after an error
+            for connection in http.connections.values():
+                connection.close()
+            http.connections.clear()
+            raise
+        finally:
+            self._release(http)
+
+    def stats(self):
+        """Returns the usage statistics of the pool
+
+        :return: a map with the number of requests sent, the connections
+            opened, the connections reused and the waits for a free
+            connection
+        """
+        with self._lock:
+            return {
+                'requests': self._requests,
+                'connections': self._created,
+                'max_connections': self.max_connections,
+                'idle_connections': self._pool.qsize(),
+                'reused': self._reused,
+                'reuse_rate': (float(self._reused) / self._requests
+                               if self._requests else 0.0),
+                'waits': self._waits,
+                'wait_time': self._wait_time}
@@ -1,33 +1,13 @@
-import csv
-import os
 import re
+import os
 import logging
-import urllib
-from Levenshtein import jaro_winkler
-from xlrd import open_workbook
 
-from common.api import PreSeriesAPI
+from common.countries import get_country_index
+from common.scoring import DEFAULT_SCORER
 
 REGEX_MATCHER_UUID = re.compile(r"[a-zA-Z0-9_]{24}")
 REGEX_MATCHER_DOMAIN = re.compile(r"(.*://)?(?:www\.)?(.[^/]+).*")
 
-COUNTRIES_NAME = []
-COUNTRIES_2LETTER_CODE = []
-COUNTRIES_3LETTER_CODE = []
-
-script_path = os.path.dirname(os.path.abspath(__file__))
-
-# Loading the Country ISO codes
-with open('%s/countries.csv' % script_path, 'rb') as f:
-    reader = csv.reader(f, delimiter='\t')
-    for row in reader:
-        COUNTRIES_NAME.append(row[0].lower())
-        COUNTRIES_2LETTER_CODE.append(row[1].lower())
-        COUNTRIES_3LETTER_CODE.append(row[2].lower())
-
-
-DEFAULT_API = PreSeriesAPI()
-
 
 class PreSeriesUtils(object):
     """This class encapsulates some common utility methods
@@ -45,6 +25,49 @@ class PreSeriesUtils(object):
         return reduce(lambda s, a: s * 26 + ord(a) - ord('A') + 1, col_name,
                       0) - 1
 
+    @staticmethod
+    def replace_file(source, destination):
+        """
+        Renames a file over another one at once, so the destination is
+        always either the old file or the new one
+
+        :param source: the path of the new file, ex. a temporary file
+        :param destination: the path of the file to be replaced
+        """
+        if hasattr(os, 'replace'):
+            os.replace(source, destination)
+        else:
+            # Python 2, rename replaces the destination atomically on POSIX
+            os.rename(source, destination)
+
+    @staticmethod
+    def chunks(items, size, max_length=None):
+        """
+        Splits a list into consecutive chunks
+
+        :param items: the list to split
+        :param size: the maximum number of items of each chunk
+        :param max_length: if informed, the maximum length of the items of
+            each chunk joined by commas. Useful to keep the list of ids used
+            in a query string under the url length limit.
+        :return: a generator of lists with up to <size> items
+        """
+        chunk = []
+        chunk_length = 0
+        for item in items:
+            item_length = len(str(item)) + (1 if chunk else 0)
+            if chunk and (len(chunk) >= size or (
+                    max_length and chunk_length + item_length > max_length)):
+                yield chunk
+                chunk = []
+                chunk_length = 0
+                item_length = len(str(item))
+            chunk.append(item)
+            chunk_length += item_length
+
+        if chunk:
+            yield chunk
+
     @staticmethod
     def encoding_conversion(company_data):
         """
@@ -69,43 +92,7 @@ class PreSeriesUtils(object):
         :return: the ISO 3166-1 alfa-3 code
         """
 
-        country_text = str(country_text.lower())
-
-        # Check if the country_text is an ISO 3166-1 alfa-3 code
-        try:
-            if COUNTRIES_3LETTER_CODE.index(country_text):
-                return country_text.upper()
-        except ValueError:
-            pass
-
-        # Check if the country_text is an ISO 3166-1 alfa-2 code
-        try:
-            if COUNTRIES_2LETTER_CODE.index(country_text):
-                return COUNTRIES_3LETTER_CODE[
-                    COUNTRIES_2LETTER_CODE.index(country_text)].upper()
-        except ValueError:
-            pass
-
-        # Check if the country_text is a recognized name
-        try:
-            if COUNTRIES_NAME.index(country_text):
-                return COUNTRIES_3LETTER_CODE[
-                    COUNTRIES_NAME.index(country_text)].upper()
-        except ValueError:
-            pass
-
-        # Look for the closest name to the one informed using
-        # the levenshtein distance
-        similarity_ratios = []
-        for index, valid_country_name in enumerate(COUNTRIES_NAME):
-            similarity_ratios.append((
-                COUNTRIES_3LETTER_CODE[index].upper(),
-                jaro_winkler(valid_country_name, str(country_text))))
-
-        similarity_ratios = reversed(
-            sorted(similarity_ratios, key=lambda x: x[1]))
-
-        return similarity_ratios.next()[0]
+        return get_country_index().resolve(country_text)
 
     @staticmethod
     def resolve_domain(url):
@@ -127,44 +114,36 @@ class PreSeriesUtils(object):
         return None
 
     @staticmethod
-    def select_best_company(query_params, candidates):
+    def select_best_company(query_params, candidates, scorer=DEFAULT_SCORER):
         """
         We are going to calculate the avg distance between the expected value
-         for each parameter (name, domain) and the values of the candidates
-         for them
+         for each parameter (name, domain, country_code) and the values of
+         the candidates for them
 
         :param query_params: the values to check
         :param candidates: all the companies that matched with the
                 previous params
+        :param scorer: the CandidateScorer with the weights of each field
         :return: the selected candidate that better match
         """
+        return PreSeriesUtils.rank_candidates(
+            query_params, candidates, scorer=scorer)[0]
 
-        logging.debug("Looking for the best match...")
-
-        # All the distances for each param for each candidate
-        ratios = []
-
-        for index, candidate in enumerate(candidates):
-            logging.debug("Candidate #%d: %s" % (index, candidate))
-            candidate_ratios = []
-            for param_name, param_value in query_params.iteritems():
-                if param_name in candidate and candidate[param_name]:
-                    candidate_ratios.append(
-                        jaro_winkler(
-                            str(param_value),
-                            str(candidate[param_name].encode('utf-8'))))
-
-            # Calculate the distance ratio as the AVG between all the computed
-            # ratios for the candidate
-            ratios.append(
-                (float(sum(candidate_ratios)) / (len(query_params) - 1),
-                 candidate))
+    @staticmethod
+    def rank_candidates(query_params, candidates, scorer=DEFAULT_SCORER):
+        """
+        Scores all the candidates and selects the one that better match
 
-        # The best match first
-        ratios = reversed(sorted(ratios, key=lambda x: x[0]))
+        :param query_params: the values to check
+        :param candidates: all the companies that matched with the
+                previous params
+        :param scorer: the CandidateScorer with the weights of each field
+        :return: a tuple (candidate, score, margin) with the best candidate,
+            its score and the difference with the score of the second best
+        """
+        logging.debug("Looking for the best match...")
 
-        # Return the select candidate being the best match
-        return ratios.next()[1]
+        return scorer.score(query_params, candidates)
 
     @staticmethod
     def get_search_data(file_name, column_id=None, column_name=None,
@@ -180,74 +159,21 @@ class PreSeriesUtils(object):
          be used in the query, we will use them later for select the best
          match from all the candidates that matched the query.
 
+        It builds the whole list, common.readers.iter_search_data builds the
+        same queries reading the rows as they are needed. The file can be a
+        xls, xlsx or csv file.
+
         :return: a list where each row is one company which contains a tuple
             with two items, the query string to look in preseries for the
             company and the map with all the parameters used in the query
         """
+        # Imported here because the readers module depends on this one
+        from common.readers import iter_search_data
 
-        logging.debug("Looking for the first sheet in the Excel.")
-        wb = open_workbook(file_name)
-        first_sheet = wb.sheets()[0]
-        logging.debug("Sheet name [%s]." % first_sheet.name)
-
-        companies_query = []
-        for row in range(skip_rows, first_sheet.nrows):
-
-            logging.debug("Processing row: %d" % row)
-
-            if column_id:
-                company_id = first_sheet.cell_value(
-                    row, PreSeriesUtils.excel2num(column_id))
-                companies_query.append((
-                    "id=%s" % company_id, {"row": row, "id": company_id}))
-                continue
-
-            query_string = {}
-            query_params = {"row": row}
-
-            if column_name and \
-                    first_sheet.cell_value(
-                        row, PreSeriesUtils.excel2num(column_name)):
-
-                try:
-                    company_name = first_sheet.cell_value(
-                        row,
-                        PreSeriesUtils.excel2num(column_name)).encode('cp1252')
-                except UnicodeEncodeError:
-                    company_name = first_sheet.cell_value(
-                        row,
-                        PreSeriesUtils.excel2num(column_name)).encode('utf-8')
-                    pass
-
-                query_string['name__icontains'] = company_name
-                query_params["name"] = company_name
-
-            if column_domain:
-                company_domain = PreSeriesUtils.resolve_domain(
-                    first_sheet.cell_value(
-                        row, PreSeriesUtils.excel2num(column_domain)))
-
-                if company_domain:
-                    # We only use the domain after the search to select the
-                    # best candidate
-                    query_params["domain"] = company_domain
-
-            if column_country and \
-                    first_sheet.cell_value(
-                        row, PreSeriesUtils.excel2num(column_country)):
-                country_code = PreSeriesUtils.resolve_country(
-                    first_sheet.cell_value(
-                        row, PreSeriesUtils.excel2num(column_country)))
-
-                if country_code:
-                    # We only use the country_code after the search to
-                    # select the best candidate
-                    query_params['country_code'] = country_code
-
-            companies_query.append(
-                (urllib.urlencode(query_string), query_params))
-
-        return companies_query, first_sheet
+        return list(iter_search_data(
+            file_name, column_id=column_id, column_name=column_name,
+            column_country=column_country, column_domain=column_domain,
+            skip_rows=skip_rows))
 
     @staticmethod
     def xpath_get(mydict, path, default=""):
@@ -264,21 +190,29 @@ class PreSeriesUtils(object):
     @staticmethod
     def dump_opbjects(headers, fields, resources):
 
-        rows = []
-        rows.append(headers)
+        return list(PreSeriesUtils.iter_objects(headers, fields, resources))
+
+    @staticmethod
+    def iter_objects(headers, fields, resources):
+        """
+        Generates the rows of a sheet with the fields of the resources, as
+        the resources are consumed
+
+        :param headers: the first row
+        :param fields: the xpath of the field of each column
+        :param resources: the resources, one per row
+        :return: a generator of rows, lists of values
+        """
+        yield headers
 
         for resource in resources:
-            row = [field_value.encode('utf-8').decode('utf-8', 'ignore')
+            yield [field_value.encode('utf-8').decode('utf-8', 'ignore')
                    if isinstance(field_value, (str, unicode))
                    else '|'.join([
                         item.encode('utf-8').decode('utf-8', 'ignore')
                         if isinstance(item, (str, unicode))
                         else item for item in field_value])
-            if isinstance(field_value, (list))
-            else field_value for field_value in [
-                PreSeriesUtils.xpath_get(resource, field_name)
-                for field_name in fields]]
-
-            rows.append(row)
-
-        return rows
+                   if isinstance(field_value, (list))
+                   else field_value for field_value in [
+                       PreSeriesUtils.xpath_get(resource, field_name)
+                       for field_name in fields]]
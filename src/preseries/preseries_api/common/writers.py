@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""Writers of the exports, sheet by sheet and row by row.
+
+Each writer receives the rows of a sheet, the first row being the header,
+and writes them as they arrive, so the rows never need to be all in
+memory. The rows are passed as an iterable to write_sheet, or one by one to
+the sheets returned by open_sheet, which can be filled at the same time.
+"""
+import csv
+import io
+import logging
+import numbers
+import os
+import sys
+
+PY2 = sys.version_info[0] < 3
+
+# Maximum number of rows of a sheet in the xls format
+XLS_MAX_ROWS = 65536
+
+# Number of rows written in each row group of a Parquet file
+PARQUET_BATCH_SIZE = 10000
+
+if PY2:
+    TEXT_TYPES = (str, unicode)
+else:
+    TEXT_TYPES = (str, bytes)
+
+
+def _to_unicode(value):
+    """Returns the text values as unicode, and the rest as they are
+    """
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'ignore')
+    return value
+
+
+class SheetWriter(object):
+    """Base class of the writers. Each writer defines open_sheet(name),
+    which returns an object whose append(row) writes a row and whose close()
+    ends the sheet. Several sheets can be open at the same time, so they can
+    be filled as the data arrives.
+    """
+
+    def write_sheet(self, name, rows):
+        sheet = self.open_sheet(name)
+        try:
+            for row in rows:
+                sheet.append(row)
+        finally:
+            sheet.close()
+
+    def close(self):
+        pass
+
+
+class _XlsSheet(object):
+
+    def __init__(self, workbook, name):
+        self.workbook = workbook
+        self.name = name
+        self.header = None
+        self.part = 1
+        self.sheet = workbook.add_sheet(name)
+        self.index = 0
+
+    def _write(self, row):
+        for value_index, value in enumerate(row):
+            self.sheet.write(self.index, value_index, value)
+        self.index += 1
+
+    def append(self, row):
+        if self.header is None:
+            self.header = row
+        if self.index >= XLS_MAX_ROWS:
+            self.part += 1
+            self.sheet = self.workbook.add_sheet(
+                '%s (%d)' % (self.name, self.part))
+            self.index = 0
+            self._write(self.header)
+        self._write(row)
+
+    def close(self):
+        pass
+
+
+class XlsWriter(SheetWriter):
+    """Writes the sheets in an Excel 97 (xls) file with xlwt.
+
+    The format only supports 65,536 rows per sheet. The rows after it are
+    written in new sheets with the same header, named "<name> (2)" and so
+    on.
+    """
+
+    def __init__(self, file_name):
+        from xlwt import Workbook
+
+        self.file_name = file_name
+        self.workbook = Workbook()
+
+    def open_sheet(self, name):
+        return _XlsSheet(self.workbook, name)
+
+    def close(self):
+        self.workbook.save(self.file_name)
+
+
+class _XlsxSheet(object):
+
+    def __init__(self, sheet):
+        self.sheet = sheet
+
+    def append(self, row):
+        self.sheet.append([_to_unicode(value) for value in row])
+
+    def close(self):
+        pass
+
+
+class XlsxWriter(SheetWriter):
+    """Writes the sheets in an Excel 2007+ (xlsx) file with openpyxl in
+    write-only mode, which keeps in memory only the row being written.
+    """
+
+    def __init__(self, file_name):
+        from openpyxl import Workbook
+
+        self.file_name = file_name
+        self.workbook = Workbook(write_only=True)
+
+    def open_sheet(self, name):
+        return _XlsxSheet(self.workbook.create_sheet(title=name))
+
+    def close(self):
+        self.workbook.save(self.file_name)
+
+
+class _CsvSheet(object):
+
+    def __init__(self, file_name):
+        if PY2:
+            self.file = open(file_name, 'wb')
+        else:
+            self.file = io.open(file_name, 'w', newline='',
+                                encoding='utf-8')
+        self.writer = csv.writer(self.file)
+
+    def append(self, row):
+        if PY2:
+            row = [value.encode('utf-8')
+                   if isinstance(value, unicode) else value
+                   for value in row]
+        else:
+            row = [_to_unicode(value) for value in row]
+        self.writer.writerow(row)
+
+    def close(self):
+        self.file.close()
+
+
+class CsvWriter(SheetWriter):
+    """Writes each sheet in its own CSV file, encoded in utf-8, named
+    "<base name>_<sheet name>.csv" after the file name of the export.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.base_name = os.path.splitext(file_name)[0]
+        self.file_names = []
+
+    def sheet_file_name(self, name):
+        return '%s_%s.csv' % (self.base_name, name.replace(' ', '_'))
+
+    def open_sheet(self, name):
+        file_name = self.sheet_file_name(name)
+        sheet = _CsvSheet(file_name)
+        self.file_names.append(file_name)
+        return sheet
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Number) and not isinstance(value, bool)
+
+
+def _is_empty(value):
+    return value is None or value == '' or value == b''
+
+
+class _ParquetSheet(object):
+
+    def __init__(self, pyarrow, name, file_name, batch_size):
+        self.pyarrow = pyarrow
+        self.name = name
+        self.file_name = file_name
+        self.batch_size = batch_size
+        self.header = None
+        self.schema = None
+        self.writer = None
+        self.batch = []
+
+    def _schema(self):
+        pyarrow = self.pyarrow
+        fields = []
+        for index, name in enumerate(self.header):
+            values = [row[index] for row in self.batch
+                      if index < len(row) and not _is_empty(row[index])]
+            numeric = bool(values) and all(
+                _is_number(value) for value in values)
+            fields.append(pyarrow.field(
+                _to_unicode(name),
+                pyarrow.float64() if numeric else pyarrow.string()))
+        return pyarrow.schema(fields)
+
+    def _table(self):
+        pyarrow = self.pyarrow
+        columns = []
+        for index, field in enumerate(self.schema):
+            values = [row[index] if index < len(row) else None
+                      for row in self.batch]
+            if field.type == pyarrow.float64():
+                for value in values:
+                    if not (_is_empty(value) or _is_number(value)):
+                        raise ValueError(
+                            "The column %s of the sheet %s is numeric, but "
+                            "it has the value %r" %
+                            (field.name, self.name, value))
+                values = [None if _is_empty(value) else float(value)
+                          for value in values]
+            else:
+                values = [None if value is None else
+                          _to_unicode(value)
+                          if isinstance(value, TEXT_TYPES)
+                          else u'%s' % value
+                          for value in values]
+            columns.append(pyarrow.array(values, type=field.type))
+        return pyarrow.Table.from_arrays(columns, schema=self.schema)
+
+    def _flush(self):
+        if self.writer is None:
+            self.schema = self._schema()
+            self.writer = self.pyarrow.parquet.ParquetWriter(
+                self.file_name, self.schema)
+        if self.batch:
+            self.writer.write_table(self._table())
+        del self.batch[:]
+
+    def append(self, row):
+        if self.header is None:
+            self.header = row
+            return
+        self.batch.append(row)
+        if len(self.batch) >= self.batch_size:
+            self._flush()
+
+    def close(self):
+        try:
+            if self.header is not None:
+                self._flush()
+        finally:
+            if self.writer is not None:
+                self.writer.close()
+
+
+class ParquetWriter(SheetWriter):
+    """Writes each sheet in its own Parquet file, named
+    "<base name>_<sheet name>.parquet", with pyarrow.
+
+    The rows are written in row groups of PARQUET_BATCH_SIZE rows. The type
+    of each column is decided with the first group: numeric if all its
+    values are numbers, text otherwise. The empty values are written as
+    nulls. If a value of a numeric column is not a number in the next
+    groups, a ValueError is raised instead of losing it.
+    """
+
+    def __init__(self, file_name, batch_size=PARQUET_BATCH_SIZE):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("The Parquet exports require the pyarrow "
+                              "library (pip install preseries_api[parquet])")
+        self.pyarrow = pyarrow
+        self.file_name = file_name
+        self.base_name = os.path.splitext(file_name)[0]
+        self.batch_size = batch_size
+        self.file_names = []
+
+    def sheet_file_name(self, name):
+        return '%s_%s.parquet' % (self.base_name, name.replace(' ', '_'))
+
+    def open_sheet(self, name):
+        file_name = self.sheet_file_name(name)
+        self.file_names.append(file_name)
+        return _ParquetSheet(self.pyarrow, name, file_name, self.batch_size)
+
+
+# Writer of each format, by file extension
+WRITERS = {
+    '.xls': XlsWriter,
+    '.xlsx': XlsxWriter,
+    '.csv': CsvWriter,
+    '.parquet': ParquetWriter
+}
+
+
+def get_writer(file_name):
+    """
+    Returns the writer of the format of the file, by its extension
+
+    :param file_name: the name of the export, with extension .xls, .xlsx,
+        .csv or .parquet
+    :return: the writer. Its sheets are written with
+        write_sheet(name, rows), or row by row with open_sheet(name), and
+        close() must be called at the end.
+    """
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension not in WRITERS:
+        raise ValueError("Unsupported export format: %s" % file_name)
+    logging.debug("Exporting to %s" % file_name)
+    return WRITERS[extension](file_name)
@@ -2,172 +2,310 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import json
 import argparse
 import logging
 import traceback
+from multiprocessing.pool import ThreadPool
 
 from common.api import PreSeriesAPI
+from common.cache import ResponseCache
+from common.checkpoint import CheckpointJournal, BATCH_CHECKPOINT
+from common.snapshots import SnapshotStore, snapshot_version
+from common.writers import get_writer, WRITERS
+from common.hedging import HedgingPolicy
+from common.metrics import MetricsAggregator, PrometheusExporter
+from common.throttle import RateLimiter
 from common.utils import PreSeriesUtils
-from common.searcher import PreSeriesSearcher
+from common.searcher import PreSeriesSearcher, DEFAULT_CONCURRENCY
 
-from xlrd import open_workbook
 from xlwt import Workbook
 
 API = PreSeriesAPI()
 
 
-def get_company_details(known_companies):
-    """
-    This method is responsible for obtain from PreSeries all the details
-    associated to each of the companies we have in the known_companies
-    parameter
-
-    :param known_companies: the companies from which we want to obtain the data
-    :return: the known_companies extended with all the details obtained from
-    the server
-    """
+# Number of companies requested in each query to PreSeries
+COMPANIES_BATCH_SIZE = 10
 
-    offset = 0
-    limit = 10
-
-    companies_filter_template = \
-        "only_last_snapshot=true&company_id__in=%s&" \
-        "add_details=stages,company,founders,board_members,score_evolution"
+# Maximum length of the list of ids sent in one query string. It keeps the
+# urls under the ~2000 characters supported by most servers and proxies.
+MAX_IDS_LENGTH = 1500
 
-    companies_filter = companies_filter_template % (
-        ','.join([company['id']
-                  for company in known_companies[offset:offset+limit]
-                  if 'id' in company]))
+# Number of competitors or similar companies requested in each page
+RELATED_PAGE_SIZE = 100
 
-    companies = []
+# File where the data of the companies is exported by default
+DEFAULT_EXPORT_FILE = "Companies_export.xls"
 
-    while True:
-        response = API.get_company_data(companies_filter)
 
-        # Adding the companies to the list
-        companies.extend(response["resources"])
+def get_company_ids(known_companies):
+    """
+    Returns the PreSeries ID of the known companies that have it
 
-        # check if there are more companies to be queried
-        if offset + limit >= len(known_companies):
-            return companies
+    :param known_companies: the companies found in PreSeries
+    :return: the list of ids
+    """
+    return [company['id'] for company in known_companies if 'id' in company]
 
-        # Next page
-        offset = offset + limit
 
-        # Check the limits
-        limit = limit \
-            if len(known_companies) - len(companies) >= limit \
-            else len(known_companies) - len(companies)
+def get_batches(known_companies, batch_size=COMPANIES_BATCH_SIZE):
+    """
+    Splits the ids of the known companies in the batches that will be
+    requested to PreSeries in each query
 
-        companies_filter = companies_filter_template % (
-            ','.join([company['id']
-                      for company in known_companies[offset:offset + limit]
-                      if 'id' in company]))
+    :param known_companies: the companies found in PreSeries
+    :param batch_size: the maximum number of companies of each batch
+    :return: a list of lists of ids
+    """
+    return list(PreSeriesUtils.chunks(
+        get_company_ids(known_companies), batch_size,
+        max_length=MAX_IDS_LENGTH))
 
 
-def get_competitors(known_companies):
+def fetch_company_details(company_ids):
     """
-    This method is responsible for obtain from Competitors of the companies
-    we have in the known_companies parameter
+    Requests to PreSeries all the details of a batch of companies
 
-    :param known_companies: the companies from which we want to obtain the data
-    :return: a map with all the competitors by company id
+    :param company_ids: the ids of the companies
+    :return: the list of companies with their details
     """
+    companies_filter_template = \
+        "only_last_snapshot=true&company_id__in=%s&" \
+        "add_details=stages,company,founders,board_members,score_evolution"
 
-    offset = 0
-    limit = 10
-
-    companies_filter_template = "limit=%d&company_id__in=%s"
+    return list(API.iter_company_data(
+        companies_filter_template % ','.join(company_ids)))
 
-    companies_filter = companies_filter_template % (
-        limit * 10,
-        ','.join([company['id']
-                  for company in known_companies[offset:offset+limit]
-                  if 'id' in company]))
 
-    by_company = {}
+def fetch_competitors(company_ids):
+    """
+    Requests to PreSeries the competitors of a batch of companies
 
-    while True:
-        response = API.get_companies_competitors(companies_filter)
+    :param company_ids: the ids of the companies
+    :return: the list of competitors
+    """
+    return list(API.iter_companies_competitors(
+        "company_id__in=%s" % ','.join(company_ids),
+        page_size=RELATED_PAGE_SIZE))
 
-        for resource in response["resources"]:
-            if resource["company_id"] not in by_company:
-                by_company[resource["company_id"]] = []
 
-            by_company[resource["company_id"]].append(resource)
+def fetch_similar(company_ids):
+    """
+    Requests to PreSeries the similar companies of a batch of companies
 
-        # check if there are more companies to be queried
-        if offset + limit >= len(known_companies):
-            return by_company
+    :param company_ids: the ids of the companies
+    :return: the list of similar companies
+    """
+    return list(API.iter_companies_similar(
+        "company_id__in=%s" % ','.join(company_ids),
+        page_size=RELATED_PAGE_SIZE))
 
-        # Next page
-        offset = offset + limit
 
-        # Check the limits
-        limit = limit \
-            if len(known_companies) - len(by_company) >= limit \
-            else len(known_companies) - len(by_company)
+def fetch_company_summaries(company_ids):
+    """
+    Requests to PreSeries the last data of a batch of companies, without
+    their details, to know which ones changed
 
-        companies_filter = companies_filter_template % (
-            limit * 10,
-            ','.join([company['id']
-                      for company in known_companies[offset:offset + limit]
-                      if 'id' in company]))
+    :param company_ids: the ids of the companies
+    :return: the list of companies
+    """
+    return list(API.iter_company_data(
+        "only_last_snapshot=true&company_id__in=%s" % ','.join(company_ids)))
 
 
-def get_similar(known_companies):
+def group_by_company(resources):
     """
-    This method is responsible for obtain from Similar companies of the
-    companies we have in the known_companies parameter
+    Groups the resources by the company_id field
 
-    :param known_companies: the companies from which we want to obtain the data
-    :return: a map with all the competitors by company id
+    :param resources: the resources to group
+    :return: a map with the list of resources by company id
     """
+    by_company = {}
 
-    offset = 0
-    limit = 10
+    for resource in resources:
+        if resource["company_id"] not in by_company:
+            by_company[resource["company_id"]] = []
 
-    companies_filter_template = "limit=%d&company_id__in=%s"
+        by_company[resource["company_id"]].append(resource)
 
-    companies_filter = companies_filter_template % (
-        limit * 10,
-        ','.join([company['id']
-                  for company in known_companies[offset:offset+limit]
-                  if 'id' in company]))
+    return by_company
 
-    by_company = {}
 
-    while True:
-        response = API.get_companies_similar(companies_filter)
+def iter_tasks(function, items, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Calls the function with each item from a pool of <concurrency> threads
 
-        for resource in response["resources"]:
-            if resource["company_id"] not in by_company:
-                by_company[resource["company_id"]] = []
+    :return: a generator of the results, in the same order of the items,
+        each one yielded as soon as it is available
+    """
+    if concurrency > 1 and len(items) > 1:
+        pool = ThreadPool(concurrency)
+        try:
+            for result in pool.imap(function, items):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for item in items:
+            yield function(item)
+
+
+def find_changed_companies(company_ids, snapshots,
+                           batch_size=COMPANIES_BATCH_SIZE,
+                           concurrency=DEFAULT_CONCURRENCY):
+    """
+    Compares the version of the last data of each company in PreSeries with
+    the version of its details kept in the snapshots, requesting the data
+    without the expensive details
+
+    :param company_ids: the ids of the companies
+    :param snapshots: the SnapshotStore of the previous executions
+    :param batch_size: the number of companies requested in each query
+    :param concurrency: the maximum number of requests in flight
+    :return: a tuple with the list of ids of the companies whose details
+        must be downloaded again and the map of the current version of
+        each company
+    """
+    batches = list(PreSeriesUtils.chunks(
+        company_ids, batch_size, max_length=MAX_IDS_LENGTH))
 
-            by_company[resource["company_id"]].append(resource)
+    versions = {}
+    for summaries in iter_tasks(fetch_company_summaries, batches,
+                                concurrency):
+        for summary in summaries:
+            versions['%s' % summary['company_id']] = snapshot_version(summary)
 
-        # check if there are more companies to be queried
-        if offset + limit >= len(known_companies):
-            return by_company
+    changed = [company_id for company_id in company_ids
+               if versions.get('%s' % company_id) is None or
+               versions['%s' % company_id] != snapshots.version(company_id)]
+    return changed, versions
 
-        # Next page
-        offset = offset + limit
 
-        # Check the limits
-        limit = limit \
-            if len(known_companies) - len(by_company) >= limit \
-            else len(known_companies) - len(by_company)
+def iter_companies_data(known_companies, batch_size=COMPANIES_BATCH_SIZE,
+                        concurrency=DEFAULT_CONCURRENCY, checkpoint=None,
+                        snapshots=None):
+    """
+    This method obtains from PreSeries the details, the competitors and the
+    similar companies of the known companies, all at the same time, and
+    yields the data of each batch as soon as it is received.
+
+    The batches of the three endpoints are interleaved and sent from a pool
+    of <concurrency> threads, so the whole process takes as much time as the
+    slowest endpoint instead of the sum of the three.
 
-        companies_filter = companies_filter_template % (
-            limit * 10,
-            ','.join([company['id']
-                      for company in known_companies[offset:offset + limit]
-                      if 'id' in company]))
+    :param known_companies: the companies from which we want to obtain the data
+    :param batch_size: the number of companies requested in each query
+    :param concurrency: the maximum number of requests in flight
+    :param checkpoint: the CheckpointJournal where each fetched batch is
+        recorded. The batches already recorded are not requested again.
+    :param snapshots: the SnapshotStore with the data downloaded by the
+        previous executions. If informed, the details, competitors and
+        similar companies are only downloaded for the companies updated in
+        PreSeries since then, or missing in the store. The data of the rest
+        is taken from the store in a last batch, and the store is updated
+        and saved once all the batches are yielded.
+    :return: a generator of tuples with the details of the companies, the
+        map of competitors by company id and the map of similar by company
+        id of each batch. Each company is in only one batch of each kind.
+    """
+    batches = get_batches(known_companies, batch_size)
+
+    # The kind of related companies kept in the snapshots for each fetch
+    related_kinds = {fetch_competitors: 'competitors',
+                     fetch_similar: 'similar'}
+
+    fetch_batches = {
+        fetch_company_details: batches,
+        fetch_competitors: batches,
+        fetch_similar: batches}
+    if snapshots is not None:
+        company_ids = ['%s' % company_id
+                       for company_id in get_company_ids(known_companies)]
+        changed, versions = find_changed_companies(
+            company_ids, snapshots, batch_size=batch_size,
+            concurrency=concurrency)
+        logging.info("Incremental refresh: %d of %d companies changed" %
+                     (len(changed), len(company_ids)))
+        fetch_batches[fetch_company_details] = list(PreSeriesUtils.chunks(
+            changed, batch_size, max_length=MAX_IDS_LENGTH))
+
+        changed = set(changed)
+        for fetch, kind in related_kinds.items():
+            fetch_batches[fetch] = list(PreSeriesUtils.chunks(
+                [company_id for company_id in company_ids
+                 if company_id in changed or
+                 snapshots.get_related(company_id, kind) is None],
+                batch_size, max_length=MAX_IDS_LENGTH))
+
+    tasks = []
+    for index in range(max(len(fetch_batches[fetch])
+                           for fetch in fetch_batches)):
+        for fetch in (fetch_company_details, fetch_competitors,
+                      fetch_similar):
+            if index < len(fetch_batches[fetch]):
+                tasks.append((fetch, fetch_batches[fetch][index]))
+
+    def run(task):
+        fetch, company_ids = task
+        if checkpoint is None:
+            return fetch, company_ids, fetch(company_ids)
+
+        key = '%s:%s' % (fetch.__name__, ','.join(company_ids))
+        if checkpoint.has(BATCH_CHECKPOINT, key):
+            return fetch, company_ids, checkpoint.get(BATCH_CHECKPOINT, key)
+
+        resources = fetch(company_ids)
+        checkpoint.record(BATCH_CHECKPOINT, key, resources)
+        return fetch, company_ids, resources
+
+    downloaded = set()
+    fetched = dict((kind, set()) for kind in related_kinds.values())
+    for fetch, batch_ids, resources in iter_tasks(run, tasks, concurrency):
+        if fetch is fetch_company_details:
+            if snapshots is not None:
+                for company in resources:
+                    company_id = '%s' % company['company_id']
+                    snapshots.put(company_id, versions.get(company_id),
+                                  company)
+                    downloaded.add(company_id)
+            yield resources, {}, {}
+            continue
+
+        by_company = group_by_company(resources)
+        if snapshots is not None:
+            kind = related_kinds[fetch]
+            related = dict(('%s' % company_id, company_resources)
+                           for company_id, company_resources in
+                           by_company.items())
+            for company_id in batch_ids:
+                snapshots.put_related(company_id, kind,
+                                      related.get(company_id, []))
+                fetched[kind].add(company_id)
+
+        if fetch is fetch_competitors:
+            yield [], by_company, {}
+        else:
+            yield [], {}, by_company
+
+    if snapshots is not None:
+        # The data of the companies that didn't change is the one kept
+        kept = dict((kind, dict(
+            (company_id, snapshots.get_related(company_id, kind))
+            for company_id in company_ids
+            if company_id not in fetched[kind] and
+            snapshots.get_related(company_id, kind)))
+            for kind in fetched)
+        yield [snapshots.get(company_id) for company_id in company_ids
+               if company_id not in downloaded and
+               company_id in snapshots], \
+            kept['competitors'], kept['similar']
+        snapshots.save()
 
 
 def dump_company_objects(companies_details):
     """ This methods generates s CSV-like version of the Company objects, a
-    list of rows with columns
+    generator of rows with columns
     """
 
     # These are the basic fields of the companies that we want to export
@@ -286,12 +424,12 @@ def dump_company_objects(companies_details):
         "updated_on",
     ]
 
-    return PreSeriesUtils.dump_opbjects(headers, fields, companies_details)
+    return PreSeriesUtils.iter_objects(headers, fields, companies_details)
 
 
 def dump_person_objects(founders):
     """ This methods generates s CSV-like version of the Company persons, a
-    list of rows with columns
+    generator of rows with columns
     """
 
     # These are the basic fields of the companies that we want to export
@@ -328,12 +466,12 @@ def dump_person_objects(founders):
         "updated",
     ]
 
-    return PreSeriesUtils.dump_opbjects(headers, fields, founders)
+    return PreSeriesUtils.iter_objects(headers, fields, founders)
 
 
 def dump_stages_objects(founders):
     """ This methods generates s CSV-like version of the Company stages, a
-    list of rows with columns
+    generator of rows with columns
     """
 
     # These are the basic fields of the companies that we want to export
@@ -360,12 +498,12 @@ def dump_stages_objects(founders):
         "total_rounds"
     ]
 
-    return PreSeriesUtils.dump_opbjects(headers, fields, founders)
+    return PreSeriesUtils.iter_objects(headers, fields, founders)
 
 
 def dump_rounds_objects(founders):
     """ This methods generates s CSV-like version of the Company objects, a
-    list of rows with columns
+    generator of rows with columns
     """
 
     # These are the basic fields of the companies that we want to export
@@ -388,7 +526,7 @@ def dump_rounds_objects(founders):
         "amount"
     ]
 
-    return PreSeriesUtils.dump_opbjects(headers, fields, founders)
+    return PreSeriesUtils.iter_objects(headers, fields, founders)
 
 
 def dump_competitors_objects(competitors_by_company):
@@ -418,11 +556,11 @@ def dump_competitors_objects(competitors_by_company):
         "similarity"
     ]
 
-    resources = []
-    [resources.extend(competitors)
-     for competitors in competitors_by_company.values()]
+    resources = (competitor
+                 for competitors in competitors_by_company.values()
+                 for competitor in competitors)
 
-    return PreSeriesUtils.dump_opbjects(headers, fields, resources)
+    return PreSeriesUtils.iter_objects(headers, fields, resources)
 
 
 def dump_similar_objects(similar_by_company):
@@ -452,111 +590,175 @@ def dump_similar_objects(similar_by_company):
         "similarity"
     ]
 
-    resources = []
-    [resources.extend(similar) for similar in similar_by_company.values()]
+    resources = (similar
+                 for similars in similar_by_company.values()
+                 for similar in similars)
 
-    return PreSeriesUtils.dump_opbjects(headers, fields, resources)
+    return PreSeriesUtils.iter_objects(headers, fields, resources)
 
 
-def write_export(file_name, companies, competitors, similar):
+def iter_people(companies, field):
     """
-    This method is responsible for export the information available in the
-    companies structure, competitors list, and similar list, with the data
-    requested to PreSeries in the <file_name> Excel file.
+    Iterates over the people (founders, board_members) of the companies,
+    adding to each one the id and the name of its company
 
-    :param file_name: the name of the file to be generated
-    :param companies: all the data requested to PreSeries for each company
-    :param competitors: the list of competitors per company
-    :param similar: the list of similar companies per company
+    :param companies: the data requested to PreSeries for each company
+    :param field: the field of the company with the people
+    :return: a generator of people
     """
+    for company in companies:
+        for person in company.get(field) or []:
+            # A copy, the companies can be kept in the snapshots
+            person = dict(person)
+            person["company_id"] = company["company_id"]
+            person["company_name"] = company["name"]
+            yield person
 
-    # Prepare the Excel file
-    workbook = Workbook()
 
-    companies_sheet = workbook.add_sheet('Companies')
-    company_details_rows = dump_company_objects(companies)
-    for index, company in enumerate(company_details_rows):
-        [companies_sheet.write(index, value_index, value)
-         for value_index, value in enumerate(company)]
-
-    # Export Founders
-    founders_sheet = workbook.add_sheet('Founders')
-    founders = []
-    for company in companies:
-        if "founders" in company:
-            for person in company["founders"]:
-                person["company_id"] = company["company_id"]
-                person["company_name"] = company["name"]
-                founders.append(person)
-    founders_rows = dump_person_objects(founders)
-    for index, person in enumerate(founders_rows):
-        [founders_sheet.write(index, value_index, value)
-         for value_index, value in enumerate(person)]
-
-    # Export Board Members
-    board_members_sheet = workbook.add_sheet('Board Members')
-    board_members = []
-    for company in companies:
-        if "board_members" in company:
-            for person in company["board_members"]:
-                person["company_id"] = company["company_id"]
-                person["company_name"] = company["name"]
-                board_members.append(person)
-    board_members_rows = dump_person_objects(board_members)
-    for index, person in enumerate(board_members_rows):
-        [board_members_sheet.write(index, value_index, value)
-         for value_index, value in enumerate(person)]
-
-    # Export Stages
-    stages_sheet = workbook.add_sheet('Stages')
-    stages = []
+def iter_stages(companies):
+    """
+    Iterates over the stages of the companies, adding to each one the id and
+    the name of its company
+
+    :param companies: the data requested to PreSeries for each company
+    :return: a generator of stages
+    """
     for company in companies:
-        if "stages" in company:
-            for stage_name, stage in company["stages"].iteritems():
-                stage["company_id"] = company["company_id"]
-                stage["company_name"] = company["name"]
-                stages.append(stage)
-    stages_rows = dump_stages_objects(stages)
-    for index, stage in enumerate(stages_rows):
-        [stages_sheet.write(index, value_index, value)
-         for value_index, value in enumerate(stage)]
-
-    # Export Rounds
-    rounds_sheet = workbook.add_sheet('Rounds')
-    rounds = []
+        for stage_name, stage in (company.get("stages") or {}).iteritems():
+            # A copy, the companies can be kept in the snapshots
+            stage = dict(stage)
+            stage["company_id"] = company["company_id"]
+            stage["company_name"] = company["name"]
+            yield stage
+
+
+def iter_rounds(companies):
+    """
+    Iterates over the funding rounds of the companies, adding to each one
+    the id and the name of its company and the name of its stage
+
+    :param companies: the data requested to PreSeries for each company
+    :return: a generator of rounds
+    """
     for company in companies:
-        if "stages" in company:
-            for stage_name, stage in company["stages"].iteritems():
-                if "rounds" in stage:
-                    for round in stage["rounds"]:
-                        round["company_id"] = company["company_id"]
-                        round["company_name"] = company["name"]
-                        round["stage"] = stage_name
-                        rounds.append(round)
-    rounds_rows = dump_rounds_objects(rounds)
-    for index, round in enumerate(rounds_rows):
-        [rounds_sheet.write(index, value_index, value)
-         for value_index, value in enumerate(round)]
-
-    # Export Competitors
-    competitors_sheet = workbook.add_sheet('Competitors')
-    competitors_details_rows = dump_competitors_objects(competitors)
-    for index, competitor in enumerate(competitors_details_rows):
-        [competitors_sheet.write(index, value_index, value)
-         for value_index, value in enumerate(competitor)]
-
-    # Export Similar
-    similar_sheet = workbook.add_sheet('Similar')
-    similar_details_rows = dump_similar_objects(similar)
-    for index, similar_record in enumerate(similar_details_rows):
-        [similar_sheet.write(index, value_index, value)
-         for value_index, value in enumerate(similar_record)]
-
-    # Save the Excel file
-    workbook.save(file_name)
+        for stage_name, stage in (company.get("stages") or {}).iteritems():
+            for round in stage.get("rounds") or []:
+                # A copy, the companies can be kept in the snapshots
+                round = dict(round)
+                round["company_id"] = company["company_id"]
+                round["company_name"] = company["name"]
+                round["stage"] = stage_name
+                yield round
+
+
+def write_export(file_name, batches):
+    """
+    This method is responsible for export the information available in the
+    companies structure, competitors list, and similar list, with the data
+    requested to PreSeries in the <file_name> file.
+
+    The format of the file depends on its extension: xls, xlsx, csv (one
+    file per sheet) or parquet (one file per sheet). All the sheets are
+    opened at the beginning, and the rows of each batch are written as soon
+    as the batch is consumed, so only one batch is in memory at a time.
 
+    :param file_name: the name of the file to be generated
+    :param batches: the data requested to PreSeries, an iterable of tuples
+        with the details of the companies, the map of competitors by company
+        id and the map of similar by company id of each batch, as generated
+        by iter_companies_data
+    """
+    writer = get_writer(file_name)
+
+    sheets = [
+        ('Companies',
+         lambda companies, competitors, similar:
+         dump_company_objects(companies)),
+        ('Founders',
+         lambda companies, competitors, similar:
+         dump_person_objects(iter_people(companies, "founders"))),
+        ('Board Members',
+         lambda companies, competitors, similar:
+         dump_person_objects(iter_people(companies, "board_members"))),
+        ('Stages',
+         lambda companies, competitors, similar:
+         dump_stages_objects(iter_stages(companies))),
+        ('Rounds',
+         lambda companies, competitors, similar:
+         dump_rounds_objects(iter_rounds(companies))),
+        ('Competitors',
+         lambda companies, competitors, similar:
+         dump_competitors_objects(competitors)),
+        ('Similar',
+         lambda companies, competitors, similar:
+         dump_similar_objects(similar))]
+
+    opened = []
+    try:
+        # The header is the first row of the dump of an empty batch
+        for name, dump in sheets:
+            sheet = writer.open_sheet(name)
+            opened.append((sheet, dump))
+            sheet.append(next(dump([], {}, {})))
+
+        for batch in batches:
+            for sheet, dump in opened:
+                rows = dump(*batch)
+                next(rows)
+                for row in rows:
+                    sheet.append(row)
+    finally:
+        for sheet, dump in opened:
+            sheet.close()
+
+    # Save the file
+    writer.close()
+
+
+def dump_json(batches):
+    """
+    Writes the data of each batch in the companies.json, competitors.json
+    and similar.json files as it goes through, without keeping it
 
-def write_to_file(file_name, companies, summary_columns, wb_sheet):
+    :param batches: the tuples of the details of the companies, the map of
+        competitors by company id and the map of similar by company id of
+        each batch, as generated by iter_companies_data
+    :return: a generator of the same batches
+    """
+    companies_file = open('companies.json', 'w')
+    competitors_file = open('competitors.json', 'w')
+    similar_file = open('similar.json', 'w')
+    try:
+        companies_file.write('[')
+        competitors_file.write('{')
+        similar_file.write('{')
+        separators = {}
+
+        def write(json_file, text):
+            json_file.write(separators.get(json_file, '') + text)
+            separators[json_file] = ', '
+
+        for companies, competitors, similar in batches:
+            for company in companies:
+                write(companies_file, json.dumps(company))
+            for json_file, by_company in ((competitors_file, competitors),
+                                          (similar_file, similar)):
+                for company_id, resources in by_company.items():
+                    write(json_file, '%s: %s' % (
+                        json.dumps('%s' % company_id),
+                        json.dumps(resources)))
+            yield companies, competitors, similar
+
+        companies_file.write(']')
+        competitors_file.write('}')
+        similar_file.write('}')
+    finally:
+        companies_file.close()
+        competitors_file.close()
+        similar_file.close()
+
+
+def write_to_file(file_name, companies, summary_columns):
     """
     This method generates a new Excel file with the name <file_name> that will
     contains the data found in PreSeries for each entry in the original excel
@@ -567,8 +769,8 @@ def write_to_file(file_name, companies, summary_columns, wb_sheet):
     :param companies: a list of companies with the basic data found in PreSeries
     :param summary_columns: the columns in the original file that will be
         used in the new file to give more information about the companies.
-    :param wb_sheet: the excel sheet of the original file where we will find
-        the summary fields of the companies.
+        Their values were read with the search data, in the "summary" field
+        of each company.
     """
     workbook = Workbook()
     companies_sheet = workbook.add_sheet('Companies')
@@ -591,19 +793,9 @@ def write_to_file(file_name, companies, summary_columns, wb_sheet):
         companies_sheet.write(
             1 + index, 3, company_data["domain"]
             if "domain" in company_data else "")
-        for index2, summary_column in enumerate(summary_columns):
-            try:
-                columnvalue = wb_sheet.cell_value(
-                    company_data["row"],
-                    PreSeriesUtils.excel2num(summary_column)).encode('cp1252')
-            except UnicodeEncodeError:
-                columnvalue = wb_sheet.cell_value(
-                    company_data["row"],
-                    PreSeriesUtils.excel2num(summary_column)).encode('utf-8')
-                pass
-
-            companies_sheet.write(1 + index, 4 + index2,
-                                  columnvalue.decode('utf-8', 'ignore'))
+        for index2, summary_value in enumerate(
+                company_data.get("summary", [])):
+            companies_sheet.write(1 + index, 4 + index2, summary_value)
     workbook.save(file_name)
 
 
@@ -706,49 +898,202 @@ def main(args=sys.argv[1:]):
                                  " access to the data"
                                  "Ex. 1")
 
+        # The number of search requests we can have in flight at the same time
+        parser.add_argument('--concurrency',
+                            required=False,
+                            type=int,
+                            action='store',
+                            dest='concurrency',
+                            default=DEFAULT_CONCURRENCY,
+                            help="The maximum number of requests to PreSeries"
+                                 " running at the same time while searching"
+                                 " the companies and requesting their data."
+                                 "Ex. 8")
+
+        # The number of companies requested to PreSeries in each query
+        parser.add_argument('--batch-size',
+                            required=False,
+                            type=int,
+                            action='store',
+                            dest='batch_size',
+                            default=COMPANIES_BATCH_SIZE,
+                            help="The maximum number of companies requested"
+                                 " in each query for details, competitors"
+                                 " and similar companies. The batches are"
+                                 " also limited by the length of the url."
+                                 "Ex. 20")
+
+        # The directory where the responses of PreSeries will be cached
+        parser.add_argument('--cache-dir',
+                            required=False,
+                            type=str,
+                            action='store',
+                            dest='cache_dir',
+                            default=None,
+                            help="The directory used to cache the responses"
+                                 " of PreSeries between executions. Without"
+                                 " it nothing is cached."
+                                 "Ex. '$HOME/.preseries_cache'")
+
+        # The journal where the completed work is recorded
+        parser.add_argument('--checkpoint',
+                            required=False,
+                            type=str,
+                            action='store',
+                            dest='checkpoint',
+                            default=None,
+                            help="The file where each completed search and"
+                                 " each fetched batch of data are recorded,"
+                                 " so an interrupted execution can be"
+                                 " resumed with --resume."
+                                 "Ex. 'checkpoint.jsonl'")
+
+        # Skip the work recorded in the checkpoint by a previous execution
+        parser.add_argument('--resume',
+                            required=False,
+                            action='store_true',
+                            dest='resume',
+                            default=False,
+                            help="Skip the searches and batches recorded in"
+                                 " the --checkpoint file by a previous"
+                                 " execution.")
+
+        # The file with the details downloaded by the previous executions
+        parser.add_argument('--incremental',
+                            required=False,
+                            type=str,
+                            action='store',
+                            dest='snapshots_file',
+                            default=None,
+                            help="The file where the details of the"
+                                 " companies are kept between executions."
+                                 " Only the details of the companies updated"
+                                 " in PreSeries since the previous execution"
+                                 " are downloaded again."
+                                 "Ex. 'snapshots.jsonl'")
+
+        # The file where the data of the companies is exported
+        parser.add_argument('--export-file',
+                            required=False,
+                            type=str,
+                            action='store',
+                            dest='export_file',
+                            default=DEFAULT_EXPORT_FILE,
+                            help="The file where the data of the companies"
+                                 " is exported. Its extension sets the"
+                                 " format: %s. The csv and parquet formats"
+                                 " write one file per sheet."
+                                 "Ex. 'Companies_export.xlsx'" %
+                                 ', '.join(sorted(WRITERS)))
+
+        # The maximum number of requests per second sent to PreSeries
+        parser.add_argument('--max-rate',
+                            required=False,
+                            type=float,
+                            action='store',
+                            dest='max_rate',
+                            default=None,
+                            help="The maximum number of requests per second"
+                                 " sent to PreSeries by all the threads. The"
+                                 " rate is reduced if PreSeries throttles the"
+                                 " requests. Without it there is no limit."
+                                 "Ex. 10")
+
+        # Send a duplicate of the slowest requests to cut the latency tail
+        parser.add_argument('--hedge',
+                            required=False,
+                            action='store_true',
+                            dest='hedge',
+                            default=False,
+                            help="Send a duplicate of the requests for data"
+                                 " that take longer than the 95th percentile"
+                                 " of their endpoint, and use the first"
+                                 " response. At most 5% of the requests are"
+                                 " duplicated.")
+
+        # Where the metrics of the requests are written
+        parser.add_argument('--metrics-file',
+                            required=False,
+                            action='store',
+                            dest='metrics_file',
+                            default=None,
+                            help="The file where the metrics of the requests"
+                                 " sent to PreSeries (requests, errors,"
+                                 " retries, bytes and latency histograms by"
+                                 " endpoint) are written at the end, in the"
+                                 " Prometheus text format.")
+
         args, unknown = parser.parse_known_args(args)
 
+        if args.resume and not args.checkpoint:
+            parser.error("--resume requires a --checkpoint file")
+
+        snapshots = None
+        if args.snapshots_file:
+            snapshots = SnapshotStore(args.snapshots_file)
+
+        checkpoint = None
+        if args.checkpoint:
+            checkpoint = CheckpointJournal(args.checkpoint,
+                                           resume=args.resume)
+
+        if args.hedge:
+            API.hedging = HedgingPolicy()
+
+        if args.max_rate:
+            API.rate_limiter = RateLimiter(rate=args.max_rate)
+
+        if args.cache_dir:
+            API.cache = ResponseCache(args.cache_dir)
+
+        metrics = None
+        if args.metrics_file:
+            metrics = MetricsAggregator()
+            API.add_hook(metrics)
+
         searcher = PreSeriesSearcher(preseries_api=API)
 
         searcher.read_search_data_from_excel(
             args.file_name, column_id=args.column_id,
             column_name=args.column_name, column_country=args.column_country,
-            column_domain=args.column_domain, skip_rows=args.skip_rows)
+            column_domain=args.column_domain, skip_rows=args.skip_rows,
+            summary_columns=args.summary_columns)
 
-        known_companies, unknown_companies = searcher.search_companies()
+        known_companies, unknown_companies = searcher.search_companies(
+            concurrency=args.concurrency, checkpoint=checkpoint)
 
-        companies_details = get_company_details(known_companies)
+        # The data is written in the json files and in the export as each
+        # batch is received, without keeping it in memory
+        batches = iter_companies_data(
+            known_companies, batch_size=args.batch_size,
+            concurrency=args.concurrency, checkpoint=checkpoint,
+            snapshots=snapshots)
 
-        competitors_by_company = get_competitors(known_companies)
+        write_export(args.export_file, dump_json(batches))
 
-        similars_by_company = get_similar(known_companies)
-
-        import json
-        with open('companies.json', 'w') as outfile:
-            json.dump(companies_details, outfile)
-        with open('competitors.json', 'w') as outfile:
-            json.dump(competitors_by_company, outfile)
-        with open('similar.json', 'w') as outfile:
-            json.dump(similars_by_company, outfile)
-
-        write_export("Companies_export.xls", companies_details,
-                     competitors_by_company, similars_by_company)
-
-        # Reading the sheet that contains all the details about the companies
-        # to be found. We will use this sheet to extract the summary fields
-        # of each company for enrich the final Excel file.
-        wb = open_workbook(args.file_name)
-        wb_sheet = wb.sheets()[0]
+        if checkpoint is not None:
+            logging.info("Checkpoint: %d tasks skipped" % checkpoint.skipped)
+            checkpoint.close()
 
         write_to_file('Unknown_companies.xls',
-                      unknown_companies, args.summary_columns, wb_sheet)
+                      unknown_companies, args.summary_columns)
 
         write_to_file('Known_companies.xls',
-                      known_companies, args.summary_columns, wb_sheet)
+                      known_companies, args.summary_columns)
 
         logging.info("Unknown companies: %d" % len(unknown_companies))
         logging.info("Known companies: %d" % len(known_companies))
 
+        if API.cache is not None:
+            logging.info("Cache: %s" % API.cache_stats())
+
+        if API.hedging is not None:
+            logging.info("Hedging: %s" % API.hedging_stats())
+
+        if metrics is not None:
+            PrometheusExporter(metrics).write(args.metrics_file)
+            logging.info("Requests: %s" % metrics.stats())
+
     except Exception as ex:
         logging.exception("ERROR processing the task. Exception: [%s]" % ex)
         logging.exception("Stacktrace [%s]" % traceback.format_exc())
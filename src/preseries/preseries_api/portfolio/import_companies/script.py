@@ -7,16 +7,16 @@ import logging
 import traceback
 
 from common.api import PreSeriesAPI
-from common.utils import PreSeriesUtils
-from common.searcher import PreSeriesSearcher
+from common.importer import PortfolioImporter, DEFAULT_CHUNK_SIZE
+from common.throttle import RateLimiter
+from common.searcher import PreSeriesSearcher, DEFAULT_CONCURRENCY
 
-from xlrd import open_workbook
 from xlwt import Workbook
 
 API = PreSeriesAPI()
 
 
-def write_to_file(file_name, companies, summary_columns, wb_sheet):
+def write_to_file(file_name, companies, summary_columns):
     """
     This method generates a new Excel file the name <file_name> with
     the data associated to all the companies passed as parameter in companies
@@ -27,8 +27,8 @@ def write_to_file(file_name, companies, summary_columns, wb_sheet):
         its reference to the row num of the original file
     :param summary_columns: the columns in the original file that will be
         used in the new file to give more information about the companies.
-    :param wb_sheet: the excel sheet of the original file where we will find
-        the summary fields of the companies.
+        Their values were read with the search data, in the "summary" field
+        of each company.
     """
     workbook = Workbook()
     sheet = workbook.add_sheet('Companies')
@@ -47,19 +47,9 @@ def write_to_file(file_name, companies, summary_columns, wb_sheet):
                     if "country_code" in company_data else "")
         sheet.write(1 + index, 3, company_data["domain"]
                     if "domain" in company_data else "")
-        for index2, summary_column in enumerate(summary_columns):
-            try:
-                columnvalue = wb_sheet.cell_value(
-                    company_data["row"],
-                    PreSeriesUtils.excel2num(summary_column)).encode('cp1252')
-            except UnicodeEncodeError:
-                columnvalue = wb_sheet.cell_value(
-                    company_data["row"],
-                    PreSeriesUtils.excel2num(summary_column)).encode('utf-8')
-                pass
-
-            sheet.write(1 + index, 4 + index2,
-                        columnvalue.decode('utf-8', 'ignore'))
+        for index2, summary_value in enumerate(
+                company_data.get("summary", [])):
+            sheet.write(1 + index, 4 + index2, summary_value)
     workbook.save(file_name)
 
 
@@ -173,38 +163,95 @@ def main(args=sys.argv[1:]):
                                  " access to the data"
                                  "Ex. 1")
 
+        # The number of search requests we can have in flight at the same time
+        parser.add_argument('--concurrency',
+                            required=False,
+                            type=int,
+                            action='store',
+                            dest='concurrency',
+                            default=DEFAULT_CONCURRENCY,
+                            help="The maximum number of requests to PreSeries"
+                                 " running at the same time while searching"
+                                 " the companies and adding the chunks to"
+                                 " the portfolio."
+                                 "Ex. 8")
+
+        # The number of companies added to the portfolio in each chunk
+        parser.add_argument('--chunk-size',
+                            required=False,
+                            type=int,
+                            action='store',
+                            dest='chunk_size',
+                            default=DEFAULT_CHUNK_SIZE,
+                            help="The number of companies of each chunk."
+                                 " The portfolio is created with the first"
+                                 " chunk, and the progress is saved after"
+                                 " each next chunk is added."
+                                 "Ex. 200")
+
+        # The file where the progress of the import is kept to resume it
+        parser.add_argument('--state-file',
+                            required=False,
+                            type=str,
+                            action='store',
+                            dest='state_file',
+                            default=None,
+                            help="The file where the progress of the import"
+                                 " is saved. If the import is interrupted,"
+                                 " running it again with the same file adds"
+                                 " only the chunks not done yet."
+                                 "Ex. 'import_state.json'")
+
+        # The maximum number of requests per second sent to PreSeries
+        parser.add_argument('--max-rate',
+                            required=False,
+                            type=float,
+                            action='store',
+                            dest='max_rate',
+                            default=None,
+                            help="The maximum number of requests per second"
+                                 " sent to PreSeries by all the threads. The"
+                                 " rate is reduced if PreSeries throttles the"
+                                 " requests. Without it there is no limit."
+                                 "Ex. 10")
+
         args, unknown = parser.parse_known_args(args)
 
+        if args.max_rate:
+            API.rate_limiter = RateLimiter(rate=args.max_rate)
+
         searcher = PreSeriesSearcher(preseries_api=API)
 
         searcher.read_search_data_from_excel(
             args.file_name, column_id=args.column_id,
             column_name=args.column_name, column_country=args.column_country,
-            column_domain=args.column_domain, skip_rows=args.skip_rows)
+            column_domain=args.column_domain, skip_rows=args.skip_rows,
+            summary_columns=args.summary_columns)
 
-        known_companies, unknown_companies = searcher.search_companies()
+        known_companies, unknown_companies = searcher.search_companies(
+            concurrency=args.concurrency)
 
         # We create a portfolio with the companies that were found during
         # the search, that are the ones that contains the PreSeries ID (id) in
-        # the data structure
-        portfolio_id = API.create_portfolio(
+        # the data structure. They are added in chunks, saving the progress.
+        importer = PortfolioImporter(
+            API, chunk_size=args.chunk_size, concurrency=args.concurrency,
+            state_file=args.state_file)
+        imported = importer.run(
             args.portfolio_name,
             [company["id"] for company in known_companies if "id" in company])
-
-        # Reading the sheet that contains all the details about the companies
-        # to be found. We will use this sheet to extract the summary fields
-        # of each company for enrich the final Excel file.
-        wb = open_workbook(args.file_name)
-        wb_sheet = wb.sheets()[0]
+        portfolio_id = imported['portfolio']
 
         write_to_file('Unknown_companies.xls',
-                      unknown_companies, args.summary_columns, wb_sheet)
+                      unknown_companies, args.summary_columns)
 
         write_to_file('Known_companies.xls',
-                      known_companies, args.summary_columns, wb_sheet)
+                      known_companies, args.summary_columns)
 
         logging.info("Unknown companies: %d" % len(unknown_companies))
         logging.info("Known companies: %d" % len(known_companies))
+        logging.info("Companies not added to the portfolio: %d" %
+                     len(imported['errors']))
 
         logging.info(
             "Portfolio: http://preseries.com/dashboard/portfolio/"
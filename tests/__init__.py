@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""Unit tests of the common modules.
+
+The modules import each other as "common.<module>", as the scripts do, so
+their directory is added to the path.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'src', 'preseries', 'preseries_api'))
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from common import breaker
+from common.breaker import (
+    CircuitBreaker, CircuitBreakerRegistry, CLOSED, OPEN, HALF_OPEN)
+
+
+class FakeClock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.real_time = breaker.time
+        breaker.time = self.clock
+        self.breaker = CircuitBreaker(
+            name='company_data', failure_rate=0.5, min_requests=4,
+            window=60.0, reset_timeout=30.0, half_open_probes=1)
+
+    def tearDown(self):
+        breaker.time = self.real_time
+
+    def fail(self, times):
+        for _ in range(times):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record(True)
+
+    def succeed(self, times):
+        for _ in range(times):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record(False)
+
+    def test_opens_at_the_failure_rate(self):
+        self.succeed(2)
+        self.fail(1)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.fail(1)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.stats()['rejected'], 1)
+
+    def test_not_opened_below_min_requests(self):
+        self.fail(3)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_old_outcomes_leave_the_window(self):
+        self.fail(3)
+        self.clock.now += 61
+        self.succeed(3)
+        self.fail(1)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_successful_probe_closes(self):
+        self.fail(4)
+        self.clock.now += 30
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+        # Only one probe in flight
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_opens_again(self):
+        self.fail(4)
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(True)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertEqual(self.breaker.stats()['opened'], 2)
+        self.clock.now += 29
+        self.assertFalse(self.breaker.allow())
+
+    def test_registry_has_one_breaker_per_endpoint(self):
+        registry = CircuitBreakerRegistry(min_requests=1)
+        registry.get('company_data').record(True)
+        self.assertIs(registry.get('company_data'),
+                      registry.get('company_data'))
+        self.assertEqual(registry.states(), {'company_data': OPEN})
+        self.assertTrue(registry.get('company_search').allow())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from common import cache
+from common.cache import ResponseCache
+
+
+class FakeClock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.clock = FakeClock()
+        self.real_time = cache.time
+        cache.time = self.clock
+
+    def tearDown(self):
+        cache.time = self.real_time
+        shutil.rmtree(self.directory)
+
+    def test_key_ignores_credentials_and_param_order(self):
+        self.assertEqual(
+            ResponseCache.make_key(
+                'https://preseries.io:443/zion/company_data',
+                '?username=a;api_key=b;id=1&name=x'),
+            ResponseCache.make_key('/zion/company_data/', 'name=x&id=1'))
+
+    def test_expired_response_is_removed(self):
+        responses = ResponseCache(self.directory,
+                                  ttls={'company_data': 60})
+        responses.set('/zion/company_data/', 'id=1', b'{"id": 1}')
+        self.clock.now += 60
+        self.assertEqual(responses.get('/zion/company_data/', 'id=1'),
+                         b'{"id": 1}')
+
+        self.clock.now += 1
+        self.assertIsNone(responses.get('/zion/company_data/', 'id=1'))
+        self.assertEqual(responses.stats()['entries'], 0)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_endpoint_without_ttl_is_not_cached(self):
+        responses = ResponseCache(self.directory)
+        responses.set('/zion/portfolio/', '', b'[]')
+        self.assertIsNone(responses.get('/zion/portfolio/', ''))
+
+    def test_least_recently_used_is_evicted(self):
+        responses = ResponseCache(self.directory, max_bytes=20)
+        responses.set('/zion/company_data/', 'id=1', b'1' * 10)
+        responses.set('/zion/company_data/', 'id=2', b'2' * 10)
+        # The first response is used, so the second is the least recent
+        self.assertIsNotNone(responses.get('/zion/company_data/', 'id=1'))
+
+        responses.set('/zion/company_data/', 'id=3', b'3' * 10)
+        self.assertIsNone(responses.get('/zion/company_data/', 'id=2'))
+        self.assertIsNotNone(responses.get('/zion/company_data/', 'id=1'))
+        self.assertIsNotNone(responses.get('/zion/company_data/', 'id=3'))
+        stats = responses.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['bytes'], 20)
+
+    def test_index_is_rebuilt_from_the_directory(self):
+        responses = ResponseCache(self.directory)
+        responses.set('/zion/company_data/', 'id=1', b'{"id": 1}')
+
+        responses = ResponseCache(self.directory)
+        self.assertEqual(responses.get('/zion/company_data/', 'id=1'),
+                         b'{"id": 1}')
+
+
+if __name__ == '__main__':
+    unittest.main()
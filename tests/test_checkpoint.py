@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from common.checkpoint import (
+    CheckpointJournal, SEARCH_CHECKPOINT, BATCH_CHECKPOINT)
+
+
+class CheckpointJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, 'journal.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_record_and_get(self):
+        with CheckpointJournal(self.file_name) as journal:
+            journal.record(SEARCH_CHECKPOINT, 'acme', ['c1', 'c2'])
+            journal.record(BATCH_CHECKPOINT, '0', {'companies': 2})
+            self.assertEqual(len(journal), 2)
+            self.assertTrue(journal.has(SEARCH_CHECKPOINT, 'acme'))
+            self.assertFalse(journal.has(BATCH_CHECKPOINT, 'acme'))
+            self.assertEqual(journal.get(SEARCH_CHECKPOINT, 'acme'),
+                             ['c1', 'c2'])
+            self.assertEqual(journal.get(BATCH_CHECKPOINT, '0'),
+                             {'companies': 2})
+            self.assertEqual(journal.get(BATCH_CHECKPOINT, '1', 'none'),
+                             'none')
+            self.assertEqual(journal.skipped, 2)
+
+    def test_without_resume_starts_again(self):
+        with CheckpointJournal(self.file_name) as journal:
+            journal.record(SEARCH_CHECKPOINT, 'acme', ['c1'])
+        with CheckpointJournal(self.file_name) as journal:
+            self.assertEqual(len(journal), 0)
+        self.assertEqual(os.path.getsize(self.file_name), 0)
+
+    def test_resume(self):
+        with CheckpointJournal(self.file_name) as journal:
+            journal.record(SEARCH_CHECKPOINT, 'acme', ['c1'])
+            journal.record(SEARCH_CHECKPOINT, 'acme', ['c1', 'c2'])
+        with CheckpointJournal(self.file_name, resume=True) as journal:
+            self.assertEqual(len(journal), 1)
+            # The last entry of a key wins
+            self.assertEqual(journal.get(SEARCH_CHECKPOINT, 'acme'),
+                             ['c1', 'c2'])
+            journal.record(SEARCH_CHECKPOINT, 'globex', ['c3'])
+            self.assertEqual(journal.get(SEARCH_CHECKPOINT, 'globex'),
+                             ['c3'])
+        with CheckpointJournal(self.file_name, resume=True) as journal:
+            self.assertEqual(len(journal), 2)
+            self.assertEqual(journal.get(SEARCH_CHECKPOINT, 'globex'),
+                             ['c3'])
+
+    def test_resume_after_cut_line(self):
+        with CheckpointJournal(self.file_name) as journal:
+            journal.record(SEARCH_CHECKPOINT, 'acme', ['c1'])
+        line = json.dumps({'kind': SEARCH_CHECKPOINT, 'key': 'globex',
+                           'value': ['c2']})
+        with open(self.file_name, 'ab') as journal_file:
+            journal_file.write(line[:len(line) // 2].encode('utf-8'))
+
+        with CheckpointJournal(self.file_name, resume=True) as journal:
+            self.assertEqual(len(journal), 1)
+            self.assertFalse(journal.has(SEARCH_CHECKPOINT, 'globex'))
+            journal.record(SEARCH_CHECKPOINT, 'globex', ['c2'])
+            self.assertEqual(journal.get(SEARCH_CHECKPOINT, 'globex'),
+                             ['c2'])
+
+        # The new entry is not appended to the cut line
+        with CheckpointJournal(self.file_name, resume=True) as journal:
+            self.assertEqual(len(journal), 2)
+            self.assertEqual(journal.get(SEARCH_CHECKPOINT, 'acme'), ['c1'])
+            self.assertEqual(journal.get(SEARCH_CHECKPOINT, 'globex'),
+                             ['c2'])
+
+    def test_malformed_line_ignored(self):
+        with open(self.file_name, 'wb') as journal_file:
+            journal_file.write(b'not json\n')
+            journal_file.write(json.dumps(
+                {'kind': BATCH_CHECKPOINT, 'key': '0',
+                 'value': 3}).encode('utf-8') + b'\n')
+        with CheckpointJournal(self.file_name, resume=True) as journal:
+            self.assertEqual(len(journal), 1)
+            self.assertEqual(journal.get(BATCH_CHECKPOINT, '0'), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from common.api import PreSeriesAPIError
+from common.importer import PortfolioImporter
+
+
+class Crash(Exception):
+    pass
+
+
+class FakeAPI(object):
+    """The portfolio requests of the PreSeriesAPI used by the importer
+    """
+
+    def __init__(self, failing=(), crash_after=None, create_error=None):
+        self.failing = set(failing)
+        self.crash_after = crash_after
+        self.create_error = create_error
+        self.created = []
+        self.added = []
+        self._lock = threading.Lock()
+
+    def create_portfolio(self, name, company_ids):
+        self.created.append((name, list(company_ids)))
+        return {'id': 'p1', 'error': self.create_error}
+
+    def portfolio_add_company(self, portfolio, company_id):
+        with self._lock:
+            if self.crash_after is not None and \
+                    len(self.added) >= self.crash_after:
+                raise Crash()
+            if company_id in self.failing:
+                return {'error': 'Not found'}
+            self.added.append(company_id)
+            return {'error': None}
+
+
+class PortfolioImporterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.directory, 'state.json')
+        self.ids = ['c%d' % index for index in range(23)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_chunks(self):
+        api = FakeAPI()
+        calls = []
+        importer = PortfolioImporter(
+            api, chunk_size=5, concurrency=3,
+            progress=lambda confirmed, total: calls.append(
+                (confirmed, total)))
+        result = importer.run('Fintech', self.ids + ['c1'])
+
+        self.assertEqual(api.created, [('Fintech', self.ids[:5])])
+        # Each company is added once, only the ones not in the first chunk
+        self.assertEqual(sorted(api.added), sorted(self.ids[5:]))
+        self.assertEqual(result, {'portfolio': 'p1', 'total': 23,
+                                  'confirmed': 23, 'errors': {}})
+        # After the creation and after each of the 4 chunks
+        self.assertEqual(len(calls), 5)
+        self.assertEqual(calls[0], (5, 23))
+        self.assertEqual(calls[-1], (23, 23))
+
+    def test_errors(self):
+        api = FakeAPI(failing=['c7', 'c20'])
+        result = PortfolioImporter(api, chunk_size=5).run(
+            'Fintech', self.ids)
+        self.assertEqual(result['errors'],
+                         {'c7': 'Not found', 'c20': 'Not found'})
+        self.assertEqual(len(api.added), 16)
+
+    def test_create_error(self):
+        api = FakeAPI(create_error='Forbidden')
+        with self.assertRaises(PreSeriesAPIError):
+            PortfolioImporter(api, chunk_size=5).run('Fintech', self.ids)
+        self.assertEqual(api.added, [])
+
+    def test_resume(self):
+        api = FakeAPI(crash_after=7)
+        importer = PortfolioImporter(api, chunk_size=5, concurrency=1,
+                                     state_file=self.state_file)
+        with self.assertRaises(Crash):
+            importer.run('Fintech', self.ids)
+        with open(self.state_file) as state_file:
+            state = json.load(state_file)
+        self.assertEqual(state['done'], [5])
+        self.assertEqual(state['confirmed'], 10)
+
+        # The chunks of the first run are kept with another chunk size
+        api.crash_after = None
+        importer = PortfolioImporter(api, chunk_size=3, concurrency=2,
+                                     state_file=self.state_file)
+        result = importer.run('Fintech', self.ids)
+        self.assertEqual(len(api.created), 1)
+        self.assertEqual(sorted(set(api.added)), sorted(self.ids[5:]))
+        # Only the chunk in flight when it crashed is added again
+        self.assertEqual(len(api.added), 18 + 2)
+        self.assertEqual(result['confirmed'], 23)
+        with open(self.state_file) as state_file:
+            self.assertEqual(sorted(json.load(state_file)['done']),
+                             [5, 10, 15, 20])
+
+    def test_resume_retries_errors(self):
+        api = FakeAPI(failing=['c7', 'c20'])
+        importer = PortfolioImporter(api, chunk_size=5,
+                                     state_file=self.state_file)
+        importer.run('Fintech', self.ids)
+
+        api.failing = set(['c20'])
+        api.added = []
+        result = importer.run('Fintech', self.ids)
+        self.assertEqual(api.added, ['c7'])
+        self.assertEqual(result['errors'], {'c20': 'Not found'})
+        self.assertEqual(result['confirmed'], 23)
+
+    def test_state_of_another_import(self):
+        importer = PortfolioImporter(FakeAPI(), chunk_size=5,
+                                     state_file=self.state_file)
+        importer.run('Fintech', self.ids)
+        with self.assertRaises(ValueError):
+            importer.run('Fintech', self.ids[:10])
+        with self.assertRaises(ValueError):
+            importer.run('Insurtech', self.ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import errno
+import socket
+import unittest
+
+import httplib2
+
+from common.retry import RetryPolicy
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = RetryPolicy(max_retries=3, base_delay=1.0,
+                                  max_delay=5.0, total_budget=60.0,
+                                  jitter=False)
+
+    def test_exponential_backoff_is_capped(self):
+        self.assertEqual([self.policy.backoff(retries)
+                          for retries in range(1, 6)],
+                         [1.0, 2.0, 4.0, 5.0, 5.0])
+
+    def test_jitter_is_within_the_backoff(self):
+        policy = RetryPolicy(base_delay=1.0, max_delay=5.0)
+        for _ in range(100):
+            delay = policy.backoff(3)
+            self.assertTrue(0 <= delay <= 4.0)
+
+    def test_transient_statuses_of_idempotent_methods(self):
+        for status in (429, 500, 502, 503, 504):
+            self.assertEqual(
+                self.policy.next_delay('GET', 0, 0, status=status), 1.0)
+        for status in (400, 401, 404):
+            self.assertIsNone(self.policy.next_delay('GET', 0, 0,
+                                                     status=status))
+
+    def test_post_only_retried_if_not_processed(self):
+        self.assertIsNone(self.policy.next_delay('POST', 0, 0, status=500))
+        self.assertIsNone(self.policy.next_delay(
+            'POST', 0, 0, error=socket.timeout()))
+        self.assertEqual(self.policy.next_delay('POST', 0, 0, status=503),
+                         1.0)
+        self.assertEqual(self.policy.next_delay(
+            'POST', 0, 0, error=socket.error(errno.ECONNREFUSED, 'refused')),
+            1.0)
+        self.assertEqual(self.policy.next_delay(
+            'POST', 0, 0, error=httplib2.ServerNotFoundError('unknown')),
+            1.0)
+
+        policy = RetryPolicy(jitter=False, retry_post=True)
+        self.assertIsNotNone(policy.next_delay('POST', 0, 0, status=500))
+
+    def test_other_errors_are_not_retried(self):
+        self.assertIsNone(self.policy.next_delay(
+            'GET', 0, 0, error=ValueError('malformed')))
+
+    def test_max_retries(self):
+        self.assertEqual(self.policy.next_delay('GET', 2, 0, status=503), 4.0)
+        self.assertIsNone(self.policy.next_delay('GET', 3, 0, status=503))
+
+    def test_total_budget(self):
+        self.assertEqual(self.policy.next_delay('GET', 0, 59.0, status=503),
+                         1.0)
+        self.assertIsNone(self.policy.next_delay('GET', 0, 59.5, status=503))
+
+    def test_min_delay_asked_by_the_server(self):
+        self.assertEqual(self.policy.next_delay('GET', 0, 0, status=429,
+                                                min_delay=10.0), 10.0)
+        self.assertIsNone(self.policy.next_delay('GET', 0, 55.0, status=429,
+                                                 min_delay=10.0))
+
+
+if __name__ == '__main__':
+    unittest.main()